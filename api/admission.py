@@ -0,0 +1,194 @@
+"""Защита от перегрузки: лимит одновременных запросов, дедлайн запроса, быстрые 503.
+
+Когда Postgres тормозит, запросы копятся в очереди пула, и латентность растёт у всех
+(а клиент Telegram ещё и повторяет запросы). Вместо этого воркер отвечает сразу:
+
+- запросов к /api/* в работе больше ADMISSION_MAX_READS (GET/HEAD) или
+  ADMISSION_MAX_WRITES (остальные) — 503 overloaded + Retry-After;
+- ожидание соединения из пула за последнюю секунду дольше ADMISSION_MAX_POOL_WAIT_SECONDS —
+  503 db_saturated, пока ожидание не спадёт;
+- запрос не ответил за REQUEST_DEADLINE_SECONDS — 503 deadline_exceeded;
+- пул не выдал соединение за DB_POOL_TIMEOUT — 503 db_busy; запрос к БД прерван
+  statement_timeout (DB_STATEMENT_TIMEOUT_MS или остаток дедлайна) — 503 db_timeout.
+
+Лимиты — на воркер. Health, /metrics и /api/admin не ограничиваются.
+"""
+import os
+import time
+import asyncio
+import logging
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+
+from . import db
+
+
+_POOL_CAPACITY = db.DB_POOL_SIZE + db.DB_MAX_OVERFLOW
+MAX_READS = int(os.getenv("ADMISSION_MAX_READS", str(4 * _POOL_CAPACITY)))  # 0 — без лимита
+MAX_WRITES = int(os.getenv("ADMISSION_MAX_WRITES", str(2 * _POOL_CAPACITY)))
+MAX_POOL_WAIT = float(os.getenv("ADMISSION_MAX_POOL_WAIT_SECONDS", "0.5"))  # 0 — не смотреть на пул
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE_SECONDS", "10"))  # 0 — без дедлайна
+RETRY_AFTER = os.getenv("ADMISSION_RETRY_AFTER", "1")
+EXEMPT_PREFIXES = ("/api/health", "/api/admin")
+
+# SQLSTATE query_canceled: statement_timeout (или отмена запроса)
+QUERY_CANCELED = "57014"
+
+logger = logging.getLogger("uvicorn.error")
+
+# Момент (time.monotonic), после которого запрос уже не нужен клиенту
+deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+_inflight = {"read": 0, "write": 0}
+_shed = {"overloaded": 0, "db_saturated": 0, "deadline_exceeded": 0, "db_busy": 0, "db_timeout": 0}
+
+
+class _RecentMax:
+    """Максимум ожидания пула за текущую и предыдущую секунду."""
+
+    def __init__(self) -> None:
+        self.second = 0
+        self.current = 0.0
+        self.previous = 0.0
+
+    def observe(self, value: float) -> None:
+        self._roll()
+        self.current = max(self.current, value)
+
+    def value(self) -> float:
+        self._roll()
+        return max(self.current, self.previous)
+
+    def _roll(self) -> None:
+        now = int(time.monotonic())
+        if now != self.second:
+            self.previous = self.current if now == self.second + 1 else 0.0
+            self.current = 0.0
+            self.second = now
+
+
+_pool_wait = _RecentMax()
+
+
+def remaining() -> Optional[float]:
+    """Секунд до дедлайна текущего запроса (None — дедлайна нет)."""
+    until = deadline.get()
+    return None if until is None else until - time.monotonic()
+
+
+async def _reject(send, reason: str) -> None:
+    body = f'{{"detail":"{reason}"}}'.encode()
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+        (b"retry-after", RETRY_AFTER.encode()),
+    ]
+    await send({"type": "http.response.start", "status": 503, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "") if scope["type"] == "http" else ""
+        if not path.startswith("/api/") or path.startswith(EXEMPT_PREFIXES):
+            return await self.app(scope, receive, send)
+
+        kind = "read" if scope.get("method") in ("GET", "HEAD") else "write"
+        limit = MAX_READS if kind == "read" else MAX_WRITES
+        reason = None
+        if limit and _inflight[kind] >= limit:
+            reason = "overloaded"
+        elif MAX_POOL_WAIT and _pool_wait.value() > MAX_POOL_WAIT:
+            reason = "db_saturated"
+        if reason:
+            _shed[reason] += 1
+            return await _reject(send, reason)
+
+        started = False
+
+        async def send_wrapper(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        _inflight[kind] += 1
+        token = deadline.set(time.monotonic() + REQUEST_DEADLINE if REQUEST_DEADLINE else None)
+        try:
+            if REQUEST_DEADLINE:
+                await asyncio.wait_for(self.app(scope, receive, send_wrapper), REQUEST_DEADLINE)
+            else:
+                await self.app(scope, receive, send_wrapper)
+        except asyncio.TimeoutError:
+            _shed["deadline_exceeded"] += 1
+            logger.warning("request deadline exceeded: %s %s", scope.get("method"), path)
+            if not started:
+                await _reject(send, "deadline_exceeded")
+        except OperationalError as exc:
+            # только отмена по statement_timeout; остальные ошибки БД — обычный 500
+            if started or getattr(exc.orig, "sqlstate", None) != QUERY_CANCELED:
+                raise
+            _shed["db_timeout"] += 1
+            await _reject(send, "db_timeout")
+        finally:
+            deadline.reset(token)
+            _inflight[kind] -= 1
+
+
+async def _pool_timeout_handler(request: Request, exc: PoolTimeoutError) -> JSONResponse:
+    _shed["db_busy"] += 1
+    return JSONResponse({"detail": "db_busy"}, status_code=503, headers={"Retry-After": RETRY_AFTER})
+
+
+# -------------------------------
+# statement_timeout
+# -------------------------------
+
+
+def _on_begin(conn) -> None:
+    base_ms = db.DB_STATEMENT_TIMEOUT_MS  # без PgBouncer уже задан при подключении (options)
+    left = remaining()
+    left_ms = None if left is None else max(1, int(left * 1000))
+    if left_ms is not None and (not base_ms or left_ms < base_ms):
+        timeout_ms = left_ms  # до дедлайна запроса осталось меньше постоянного таймаута
+    elif db.DB_PGBOUNCER and base_ms:
+        timeout_ms = base_ms  # PgBouncer не передаёт options: задаём на каждую транзакцию
+    else:
+        return
+    # SET LOCAL живёт до конца транзакции — безопасно и за PgBouncer
+    conn.exec_driver_sql(f"SET LOCAL statement_timeout = {timeout_ms}")
+
+
+def install_engine(engine) -> None:
+    if engine.dialect.name == "postgresql":
+        event.listen(engine.sync_engine, "begin", _on_begin)
+
+
+def install(app) -> None:
+    from . import metrics
+
+    for engine in {id(e): e for e in (*db.shard_engines, *db.replica_engines)}.values():
+        install_engine(engine)
+    if _pool_wait.observe not in db.pool_checkout_listeners:
+        db.pool_checkout_listeners.append(_pool_wait.observe)
+    app.add_exception_handler(PoolTimeoutError, _pool_timeout_handler)
+    for kind in ("read", "write"):
+        metrics.register_value(
+            f"romance_admission_{kind}s_inflight", f"In-flight /api/* {kind} requests in this worker.", lambda kind=kind: _inflight[kind]
+        )
+    for reason in _shed:
+        metrics.register_value(
+            f"romance_admission_shed_{reason}_total", f"Requests answered 503 {reason}.", lambda reason=reason: _shed[reason], "counter"
+        )
+    metrics.register_value(
+        "romance_db_pool_wait_recent_seconds", "Longest pool checkout wait over the last 1-2 seconds.", _pool_wait.value
+    )
+    app.add_middleware(AdmissionMiddleware)
@@ -0,0 +1,200 @@
+"""Запись обезличенного трафика /api/* для воспроизведения (tools/replay.py).
+
+Включается CAPTURE_DIR=<каталог>: каждая строка capture-<pid>.jsonl — один запрос:
+время, метод, шаблон роута, путь, безопасные параметры и поля тела, форма остальных
+полей, статус, длительность и псевдоним пользователя (HMAC от tg_id с CAPTURE_SALT).
+initData, токены и прочие значения не пишутся. Для StateOut-ответов сохраняется
+состояние (сцена, кошелёк, предметы) — по нему replay сеет локальную БД.
+
+CAPTURE_SAMPLE — доля пользователей (выбор по псевдониму, поэтому сессия пишется целиком).
+Запись идёт через ту же неблокирующую очередь, что и логи: при переполнении строка теряется.
+"""
+from typing import Any, Optional
+import os
+import json
+import hmac
+import time
+import queue
+import hashlib
+import logging
+import secrets
+from logging.handlers import QueueListener
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+from .logs import DroppingQueueHandler
+
+
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "")
+SAMPLE = float(os.getenv("CAPTURE_SAMPLE", "1"))
+# Без CAPTURE_SALT псевдонимы стабильны только в пределах процесса
+SALT = (os.getenv("CAPTURE_SALT") or secrets.token_hex(16)).encode()
+MAX_BODY = 64 * 1024
+
+# Значения этих полей — коды контента и флаги, не персональные данные: их можно повторить
+SAFE_FIELDS = frozenset({
+    "story", "story_code", "choice_code", "item_code", "lang", "codes",
+    "agree", "price_gems", "energy", "gems", "premium", "premium_days",
+})
+SKIP_PREFIXES = ("/api/admin", "/api/dev", "/api/telemetry")
+
+_logger = logging.getLogger("romance.capture")
+_listener: Optional[QueueListener] = None
+
+
+def pseudonym(tg_id: Any) -> str:
+    return hmac.new(SALT, str(tg_id).encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def _sampled(user: str) -> bool:
+    return SAMPLE >= 1.0 or int(user[:8], 16) / 0xFFFFFFFF < SAMPLE
+
+
+def _shape(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: (v if k in SAFE_FIELDS else _shape(v)) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_shape(value[0]), len(value)] if value else []
+    if isinstance(value, str):
+        return f"str:{len(value)}"
+    return type(value).__name__
+
+
+def _tg_id(headers: dict, query: dict, body: Any) -> Optional[str]:
+    # подпись не проверяем: нужен только стабильный ключ для псевдонима
+    debug = headers.get(b"x-debug-tg-id")
+    if debug:
+        return debug.decode("latin-1")
+    init_data = headers.get(b"x-telegram-init-data", b"").decode("latin-1") or query.get("init_data")
+    if not init_data and isinstance(body, dict):
+        init_data = body.get("init_data")
+    if not init_data:
+        return None
+    try:
+        return str(json.loads(dict(parse_qsl(init_data)).get("user", "{}")).get("id"))
+    except (ValueError, AttributeError):
+        return None
+
+
+def _state_of(payload: Any) -> Optional[dict]:
+    if not isinstance(payload, dict) or "scene" not in payload or "wallet" not in payload:
+        return None
+    wallet = payload["wallet"]
+    return {
+        "scene": payload["scene"].get("code"),
+        "energy": wallet.get("energy"),
+        "gems": wallet.get("gems"),
+        "premium": wallet.get("is_premium"),
+        "age": payload.get("age_confirmed"),
+        "items": payload.get("items") or [],
+    }
+
+
+class CaptureMiddleware:
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or not path.startswith("/api/") or path.startswith(SKIP_PREFIXES):
+            return await self.app(scope, receive, send)
+
+        request_body = bytearray()
+        response_body = bytearray()
+        status_code = 500
+        is_json = False
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request" and len(request_body) < MAX_BODY:
+                request_body.extend(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status_code, is_json
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                is_json = any(k == b"content-type" and v.startswith(b"application/json") for k, v in message.get("headers") or ())
+            elif message["type"] == "http.response.body" and is_json and len(response_body) < MAX_BODY:
+                response_body.extend(message.get("body", b""))
+            await send(message)
+
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            try:
+                self._record(scope, started_at, elapsed_ms, status_code, bytes(request_body), bytes(response_body))
+            except Exception:
+                logging.getLogger("uvicorn.error").debug("capture failed", exc_info=True)
+
+    def _record(self, scope, started_at: float, elapsed_ms: float, status_code: int, raw_body: bytes, raw_response: bytes) -> None:
+        headers = dict(scope.get("headers") or ())
+        query = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        try:
+            body = json.loads(raw_body) if raw_body else None
+        except ValueError:
+            body = None
+        tg_id = _tg_id(headers, query, body)
+        user = pseudonym(tg_id) if tg_id else "anon"
+        if user != "anon" and not _sampled(user):
+            return
+        entry = {
+            "t": round(started_at, 4),
+            "u": user,
+            "m": scope.get("method"),
+            "r": getattr(scope.get("route"), "path", None),
+            "p": scope.get("path"),
+            "q": {k: v for k, v in query.items() if k in SAFE_FIELDS},
+            "b": {k: v for k, v in body.items() if k in SAFE_FIELDS} if isinstance(body, dict) else None,
+            "shape": _shape(body) if body is not None else None,
+            "s": status_code,
+            "ms": round(elapsed_ms, 3),
+        }
+        if raw_response and status_code == 200:
+            try:
+                state = _state_of(json.loads(raw_response))
+            except ValueError:
+                state = None
+            if state is not None:
+                entry["state"] = state
+        _logger.info(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+
+
+def install(app) -> None:
+    global _listener
+    if not CAPTURE_DIR or _listener is not None:
+        return
+    directory = Path(CAPTURE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    file_handler = logging.FileHandler(directory / f"capture-{os.getpid()}.jsonl", encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+    handler = DroppingQueueHandler(queue.Queue(maxsize=10_000))
+    _listener = QueueListener(handler.queue, file_handler)
+    _listener.start()
+    os.register_at_fork(after_in_child=lambda: _restart_in_child(handler, directory))
+    _logger.handlers = [handler]
+    _logger.setLevel(logging.INFO)
+    _logger.propagate = False
+    app.add_middleware(CaptureMiddleware)
+
+
+def _restart_in_child(handler: DroppingQueueHandler, directory: Path) -> None:
+    # у каждого воркера свой файл и свой поток записи
+    global _listener
+    if _listener is None:
+        return
+    file_handler = logging.FileHandler(directory / f"capture-{os.getpid()}.jsonl", encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.queue = queue.Queue(maxsize=10_000)
+    _listener = QueueListener(handler.queue, file_handler)
+    _listener.start()
+
+
+def shutdown() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
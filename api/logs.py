@@ -0,0 +1,231 @@
+"""Структурные логи без блокировки event loop'а.
+
+Все логгеры (включая uvicorn.*) пишут в QueueHandler: на loop'е только сборка записи и
+put_nowait в ограниченную очередь, форматирование в JSON и запись в поток — в отдельном
+потоке QueueListener. При переполнении запись отбрасывается и считается (метрика
+romance_log_records_dropped_total), а не тормозит запросы.
+
+LOG_FORMAT — json (по умолчанию) или text; LOG_LEVEL — уровень; LOG_QUEUE_SIZE — ёмкость
+очереди; LOG_SAMPLE — доли для объёмных событий: "access=0.1,init_data=0.01";
+LOG_ACCESS=1 — строка на каждый запрос (event=access). Каждая запись получает request_id
+(заголовок X-Request-Id или сгенерированный) и trace_id, если запрос трассируется.
+
+Уровень меняется на лету: POST /api/admin/log-level {"level": "DEBUG", "minutes": 15} —
+по истечении срока он сам возвращается к LOG_LEVEL.
+"""
+from typing import Optional
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import atexit
+import logging
+import threading
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+from .tracing import current_span
+
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+ACCESS_LOG = os.getenv("LOG_ACCESS") == "1"
+
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# Атрибуты LogRecord, которые не считаются пользовательскими полями (extra=...)
+_STD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName", "color_message"}
+
+
+def _parse_sample(raw: str) -> dict[str, float]:
+    rates: dict[str, float] = {}
+    for part in raw.split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            rates[name.strip()] = min(max(float(value), 0.0), 1.0)
+    return rates
+
+
+SAMPLE = _parse_sample(os.getenv("LOG_SAMPLE", ""))
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю записей с extra={"event": ...}, указанную в LOG_SAMPLE; предупреждения — всегда."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = SAMPLE.get(getattr(record, "event", ""), 1.0)
+        return rate >= 1.0 or record.levelno >= logging.WARNING or random.random() < rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler, который не ждёт места в очереди, а отбрасывает запись."""
+
+    def __init__(self, q: queue.Queue) -> None:
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Контекст запроса снимаем здесь — в потоке слушателя contextvars уже не те.
+        # Сообщение подставляем сразу (args могут измениться), но без форматирования в JSON.
+        record.request_id = request_id.get()
+        record.trace_id = _trace_id()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _trace_id() -> Optional[str]:
+    span = current_span()
+    return span.trace_id if span is not None else None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, "request_id"):
+            record.request_id = None
+        return super().format(record)
+
+
+_handler: Optional[DroppingQueueHandler] = None
+_listener: Optional[QueueListener] = None
+_level_reset: Optional[threading.Timer] = None
+
+
+def dropped() -> int:
+    return _handler.dropped if _handler is not None else 0
+
+
+def set_level(level: str, minutes: float = 0) -> None:
+    """Сменить уровень корневого логгера; minutes > 0 — вернуть LOG_LEVEL по таймеру."""
+    global _level_reset
+    logging.getLogger().setLevel(level.upper())
+    if _level_reset is not None:
+        _level_reset.cancel()
+        _level_reset = None
+    if minutes > 0:
+        _level_reset = threading.Timer(minutes * 60, logging.getLogger().setLevel, args=(LOG_LEVEL,))
+        _level_reset.daemon = True
+        _level_reset.start()
+
+
+def install() -> None:
+    """Перенаправить корневой логгер и uvicorn.* в очередь. Повторный вызов ничего не делает."""
+    global _handler, _listener
+    if _handler is not None:
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=QUEUE_SIZE))
+    _handler.addFilter(SamplingFilter())
+    _listener = QueueListener(_handler.queue, stream, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown)
+    # после fork (gunicorn --preload) потока слушателя в дочернем процессе нет — поднимаем заново
+    os.register_at_fork(after_in_child=_restart_in_child)
+
+    root = logging.getLogger()
+    root.handlers = [_handler]
+    root.setLevel(LOG_LEVEL)
+    route_uvicorn_loggers()
+
+
+def route_uvicorn_loggers() -> None:
+    """uvicorn/gunicorn вешают свои (синхронные) обработчики — пусть всё идёт через корневой."""
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uv_logger = logging.getLogger(name)
+        uv_logger.handlers = []
+        uv_logger.propagate = True
+        uv_logger.setLevel(logging.NOTSET)
+
+
+def _restart_in_child() -> None:
+    global _listener
+    if _handler is None or _listener is None:
+        return
+    handlers = _listener.handlers
+    _handler.queue = queue.Queue(maxsize=QUEUE_SIZE)  # очередь родителя могла остаться с захваченной блокировкой
+    _listener = QueueListener(_handler.queue, *handlers, respect_handler_level=False)
+    _listener.start()
+
+
+def shutdown() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()  # дописывает всё, что осталось в очереди
+        _listener = None
+
+
+class RequestContextMiddleware:
+    """Проставляет request_id в contextvar и заголовок ответа; при LOG_ACCESS=1 пишет access-строку."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.logger = logging.getLogger("romance.access")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        rid = None
+        for key, value in scope.get("headers") or ():
+            if key == b"x-request-id":
+                rid = value.decode("latin-1")[:64]
+                break
+        rid = rid or uuid.uuid4().hex
+        token = request_id.set(rid)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = list(message.get("headers") or []) + [(b"x-request-id", rid.encode())]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if ACCESS_LOG:
+                route = getattr(scope.get("route"), "path", None) or "unmatched"
+                self.logger.info(
+                    "%s %s %s", scope.get("method"), route, status_code,
+                    extra={
+                        "event": "access",
+                        "route": route,
+                        "status": status_code,
+                        "ms": round((time.perf_counter() - start) * 1000, 2),
+                    },
+                )
+            request_id.reset(token)
@@ -6,27 +6,26 @@ from pathlib import Path
 import hmac
 import hashlib
 import json
+import time
 from urllib.parse import parse_qsl
 from datetime import datetime, timezone, timedelta
 
-from fastapi import FastAPI, Depends, Header, HTTPException, status, Query
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Depends, Header, HTTPException, status, Query, Response
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import logging
-from sqlalchemy import select
+from sqlalchemy import Row, and_, select
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .db import Base, engine, get_session
+from .db import SQLITE_BEGIN, SQLITE_READ, AsyncSessionLocal, engine, get_session, shard_engines, sqlite_begin, sqlite_write_refused, warm_pool
+from . import telemetry, metrics, slowlog, profiling, tracing, logs, capture, schema, replicas, shards, pipeline, queries, admission, userlock
 from .models import (
     User,
     Wallet,
     Story,
-    Scene,
-    SceneI18n,
-    Choice,
-    ChoiceI18n,
     Progress,
     ProgressMeta,
     GemUnlock,
@@ -37,6 +36,20 @@ from .models import (
 
 app = FastAPI(title="Romance MiniApp API")
 logger = logging.getLogger("uvicorn.error")
+logs.install()
+metrics.install()
+metrics.register_value(
+    "romance_log_records_dropped_total", "Log records dropped on a full log queue.", logs.dropped, "counter"
+)
+slowlog.install()
+if shards.enabled():
+    # шарды 1..N инструментируются так же, как основной движок (statement_timeout — в admission.install)
+    for shard_engine in shard_engines[1:]:
+        metrics.install(shard_engine)
+        slowlog.install(shard_engine)
+        tracing.instrument_engine(shard_engine)
+        profiling.instrument_engine(shard_engine)
+    metrics.register_value("romance_shard_moving_buckets", "User buckets being moved between shards.", shards.moving_buckets)
 # Simple in-memory catalog for demo (to be replaced with DB/YAML items)
 ITEM_CATALOG: dict[str, dict[str, int]] = {
     "office_flirt": {
@@ -48,6 +61,66 @@ ITEM_CATALOG: dict[str, dict[str, int]] = {
 }
 
 
+# Старт: verify — только сверить версию схемы (DDL делает tools/db_migrate.py),
+# create — создать таблицы при старте (локальная разработка), off — не проверять
+DB_SCHEMA = os.getenv("DB_SCHEMA", "verify")
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", str(engine.pool.size())))
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "2"))
+
+app.state.ready = False
+app.state.not_ready_reason = "starting"
+
+
+async def _warm_up() -> bool:
+    """Схема → пул → истории и компиляция горячих запросов; затем воркер готов.
+
+    False — схема ещё не та (миграция не закончилась): _warm_up_loop проверит снова.
+    """
+    if DB_SCHEMA == "create":
+        await schema.migrate()
+    elif DB_SCHEMA == "verify":
+        reason = await schema.check()
+        if reason:
+            app.state.not_ready_reason = reason
+            logger.error(
+                "database schema check failed: %s (expected version %s, run tools/db_migrate.py), retrying in %.0fs",
+                reason, schema.SCHEMA_VERSION, WARMUP_RETRY_SECONDS,
+            )
+            return False
+    if shards.enabled():
+        await shards.load_map()
+    opened = await warm_pool(DB_POOL_WARM)
+    async with AsyncSessionLocal() as session:
+        sqlite_begin(session, SQLITE_READ)
+        stories = await _preload_stories(session)
+        for story in stories:
+            # первый проход по запросам стартовой сцены кладёт их в кэш компиляции SQLAlchemy
+            await _get_scene_by_code(session, story.id, story.start_scene)
+            await _fetch_scene_state(session, 0, story.id, story.start_scene)
+            await _load_scene_contents(session, story.id, "ru", [story.start_scene])
+    app.state.ready = True
+    app.state.not_ready_reason = None
+    logger.info("warm-up done: %d pool connections, %d stories", opened, len(stories))
+    return True
+
+
+async def _warm_up_loop() -> None:
+    while True:
+        try:
+            if await _warm_up():
+                return
+        except HTTPException:
+            # стартовая сцена истории не найдена — контент битый, но воркер обслуживать может
+            app.state.ready = True
+            app.state.not_ready_reason = None
+            logger.exception("warm-up: story content incomplete")
+            return
+        except Exception as exc:
+            app.state.not_ready_reason = "database_unavailable"
+            logger.warning("warm-up failed, retrying in %.0fs: %s", WARMUP_RETRY_SECONDS, exc)
+        await asyncio.sleep(WARMUP_RETRY_SECONDS)
+
+
 @app.on_event("startup")
 async def on_startup():
     # Windows event loop policy for psycopg async
@@ -56,8 +129,38 @@ async def on_startup():
             asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     except Exception:
         pass
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # прогрев в фоне: liveness отвечает сразу, readiness — после прогрева
+    app.state.warmup_task = asyncio.create_task(_warm_up_loop())
+    app.state.telemetry_task = asyncio.create_task(telemetry.flush_loop())
+    if replicas.enabled():
+        app.state.replica_task = asyncio.create_task(replicas.monitor_loop())
+    if shards.enabled():
+        app.state.shard_map_task = asyncio.create_task(shards.refresh_loop())
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.ready = False
+    app.state.not_ready_reason = "shutting_down"
+    for name in ("warmup_task", "replica_task", "shard_map_task"):
+        task = getattr(app.state, name, None)
+        if task:
+            task.cancel()
+    task = getattr(app.state, "telemetry_task", None)
+    if task:
+        task.cancel()
+    try:
+        await telemetry.flush_rollups()
+    except Exception:
+        logger.exception("telemetry flush on shutdown failed")
+    tracing.shutdown()
+    capture.shutdown()
+
+# Запросы одного пользователя — по очереди (самый внутренний слой: в одной задаче с хендлером)
+userlock.install(app)
+# Лимиты одновременных запросов, дедлайн и 503 при перегрузке БД. Снаружи очереди
+# пользователя, но внутри CORS: отказ проходит через CORS и попадает в метрики и логи
+admission.install(app)
 
 # CORS (конфигурируется через env)
 ALLOWED_ORIGINS = [
@@ -71,6 +174,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Метрики снаружи CORS: латентность включает всю обработку запроса
+app.add_middleware(metrics.MetricsMiddleware)
+# Профилирование по запросу (ENABLE_PROFILING=1 + X-Profile: 1 + X-Admin-Token)
+profiling.install(app)
+# request_id для логов и заголовка X-Request-Id (+ access-лог при LOG_ACCESS=1)
+app.add_middleware(logs.RequestContextMiddleware)
+# Запись обезличенного трафика для tools/replay.py (CAPTURE_DIR=...)
+capture.install(app)
+# Трассировка (TRACE_SAMPLE_RATIO > 0): спаны запроса, хелперов и SQL
+tracing.install(app)
+# Чтения на реплики (DATABASE_REPLICA_URLS) + cookie read-your-writes на ответах записи
+replicas.install(app)
+
 # Статика фронтенда (если собран dist) + контент
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 DIST_DIR = PROJECT_ROOT / "frontend" / "dist"
@@ -82,10 +198,48 @@ if CONTENT_DIR.exists():
 
 
 @app.get("/api/health")
+@tracing.traced()
 async def health():
     return {"ok": True}
 
 
+@app.get("/api/health/live")
+async def health_live():
+    # процесс жив и event loop отвечает; БД не трогаем
+    return {"ok": True}
+
+
+@app.get("/api/health/ready")
+async def health_ready(response: Response):
+    # балансировщик шлёт трафик только после прогрева и перестаёт — с началом остановки
+    if not app.state.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"ready": False, "reason": app.state.not_ready_reason}
+    return {"ready": True}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    # METRICS_TOKEN задан — скрейпер должен прислать Authorization: Bearer <token>
+    token = os.getenv("METRICS_TOKEN")
+    if token and not hmac.compare_digest(authorization or "", f"Bearer {token}"):
+        raise HTTPException(status_code=404, detail="not_found")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/sw.js")
+async def service_worker():
+    # sw.js не хэшируется: браузер должен перепроверять его при каждом открытии
+    sw_path = DIST_DIR / "sw.js"
+    if not sw_path.exists():
+        raise HTTPException(status_code=404, detail="not_found")
+    return FileResponse(
+        sw_path,
+        media_type="application/javascript",
+        headers={"Cache-Control": "no-cache", "Service-Worker-Allowed": "/"},
+    )
+
+
 @app.get("/")
 async def index_root():
     if DIST_DIR.exists():
@@ -143,6 +297,15 @@ class StoriesOut(BaseModel):
     stories: List[str]
 
 
+class SceneContentOut(BaseModel):
+    scene: SceneOut
+    choices: List[ChoiceOut]
+
+
+class ScenesContentOut(BaseModel):
+    scenes: List[SceneContentOut]
+
+
 class ChooseIn(BaseModel):
     story_code: str
     choice_code: str
@@ -172,6 +335,7 @@ def _is_premium_active(user: User, wallet: Wallet) -> bool:
     return bool(user.is_premium or (wallet.premium_until and len(wallet.premium_until) > 0))
 
 
+@tracing.traced()
 def _verify_telegram_init_data(init_data: Optional[str]) -> Optional[int]:
     """Проверка подписи Telegram WebApp initData. Возвращает tg_id или None."""
     if not init_data:
@@ -218,12 +382,30 @@ def _verify_telegram_init_data(init_data: Optional[str]) -> Optional[int]:
         return None
 
 
+def _route_ending(heat: int) -> str:
+    """Роутер концовок по heat_score."""
+    if heat <= 0:
+        return "ending_soft"
+    if heat <= 2:
+        return "ending_hot"
+    return "ending_max"
+
+
+@tracing.traced()
 async def _get_or_create_user(
     session: AsyncSession, tg_id: int, lang: str
 ) -> tuple[User, Wallet]:
-    user = (
-        await session.execute(select(User).where(User.tg_id == tg_id))
-    ).scalar_one_or_none()
+    # первый запрос сессии в каждом пользовательском хендлере: здесь запрос встаёт в очередь
+    # пользователя и выбирается шард
+    await userlock.hold(session, tg_id)
+    await shards.route(session, tg_id)
+    # пользователь и кошелёк одним round-trip'ом
+    row = (
+        await session.execute(
+            select(User, Wallet).outerjoin(Wallet, Wallet.user_id == User.id).where(User.tg_id == tg_id)
+        )
+    ).first()
+    user, wallet = row if row else (None, None)
     if not user:
         user = User(tg_id=tg_id, lang=lang)
         session.add(user)
@@ -233,9 +415,6 @@ async def _get_or_create_user(
         await session.flush()
         await session.commit()
         return user, wallet
-    wallet = (
-        await session.execute(select(Wallet).where(Wallet.user_id == user.id))
-    ).scalar_one_or_none()
     if not wallet:
         wallet = Wallet(user_id=user.id)
         session.add(wallet)
@@ -248,6 +427,7 @@ def _now_ts() -> int:
     return int(datetime.now(tz=timezone.utc).timestamp())
 
 
+@tracing.traced()
 def _regenerate_energy(wallet: Wallet, now_ts: int, cap: int = 7, step_seconds: int = 30 * 60) -> int:
     """Ленивая регенерация энергии. Возвращает секунд до следующего +1."""
     try:
@@ -278,36 +458,81 @@ def _regenerate_energy(wallet: Wallet, now_ts: int, cap: int = 7, step_seconds:
     return max(1, step_seconds - max(0, now_ts - last_ts))
 
 
+# Истории меняются только импортом: держим (id, code, start_scene) в памяти воркера.
+# Объекты кэша не привязаны к сессии — из них читаются только поля. Импорт сохраняет id
+# истории, а перед созданием прогресса (единственная запись со story_id из кэша, пока у
+# пользователя ничего нет) запись истории перечитывается — см. _refresh_story.
+STORY_CACHE_TTL = float(os.getenv("STORY_CACHE_TTL", "60"))
+_story_cache: dict[str, tuple[float, Story]] = {}
+_story_cache_stats = [0, 0]  # hits, misses
+metrics.register_cache("story", lambda: (_story_cache_stats[0], _story_cache_stats[1]))
+
+
+def _cache_story(row: Row) -> Story:
+    story = Story(id=row.id, code=row.code, start_scene=row.start_scene)
+    _story_cache[story.code] = (time.monotonic(), story)
+    return story
+
+
+async def _preload_stories(session: AsyncSession) -> List[Story]:
+    return [_cache_story(row) for row in await queries.all_rows(session, queries.ALL_STORIES)]
+
+
+@tracing.traced()
 async def _get_story(session: AsyncSession, code: str) -> Story:
-    story = (
-        await session.execute(select(Story).where(Story.code == code))
-    ).scalar_one_or_none()
-    if not story:
+    cached = _story_cache.get(code)
+    if cached is not None and time.monotonic() - cached[0] < STORY_CACHE_TTL:
+        _story_cache_stats[0] += 1
+        return cached[1]
+    _story_cache_stats[1] += 1
+    row = await queries.first_row(session, queries.STORY_BY_CODE, {"code": code})
+    if row is None:
         raise HTTPException(status_code=404, detail="story_not_found")
-    return story
+    return _cache_story(row)
 
 
+async def _refresh_story(session: AsyncSession, story: Story) -> bool:
+    """Перечитать историю из БД в объект кэша (на месте). True — id сменился."""
+    row = await queries.first_row(session, queries.STORY_BY_CODE, {"code": story.code})
+    if row is None:
+        _story_cache.pop(story.code, None)
+        raise HTTPException(status_code=404, detail="story_not_found")
+    changed = row.id != story.id
+    story.id, story.start_scene = row.id, row.start_scene
+    _story_cache[story.code] = (time.monotonic(), story)
+    return changed
+
+
+@tracing.traced()
 async def _get_or_create_progress(
     session: AsyncSession, user: User, story: Story
 ) -> tuple[Progress, ProgressMeta]:
-    progress = (
+    # прогресс и мета одним round-trip'ом; отдельный запрос меты — только для нового прогресса
+    row = (
         await session.execute(
-            select(Progress).where(
-                Progress.user_id == user.id, Progress.story_id == story.id
+            select(Progress, ProgressMeta)
+            .outerjoin(
+                ProgressMeta,
+                and_(ProgressMeta.user_id == Progress.user_id, ProgressMeta.story_id == Progress.story_id),
             )
+            .where(Progress.user_id == user.id, Progress.story_id == story.id)
         )
-    ).scalar_one_or_none()
+    ).first()
+    progress, meta = row if row else (None, None)
     if not progress:
+        # стартовая сцена и id — из БД, а не из кэша: импорт мог их поменять
+        if await _refresh_story(session, story):
+            return await _get_or_create_progress(session, user, story)
         progress = Progress(user_id=user.id, story_id=story.id, current_scene=story.start_scene)
         session.add(progress)
         await session.flush()
-    meta = (
-        await session.execute(
-            select(ProgressMeta).where(
-                ProgressMeta.user_id == user.id, ProgressMeta.story_id == story.id
+        meta = (
+            await session.execute(
+                select(ProgressMeta).where(
+                    ProgressMeta.user_id == user.id, ProgressMeta.story_id == story.id
+                )
             )
-        )
-    ).scalar_one_or_none()
+        ).scalar_one_or_none()
     if not meta:
         meta = ProgressMeta(user_id=user.id, story_id=story.id, heat_score=0)
         session.add(meta)
@@ -316,82 +541,58 @@ async def _get_or_create_progress(
     return progress, meta
 
 
+@tracing.traced()
 async def _get_scene_by_code(
     session: AsyncSession, story_id: int, scene_code: str
-) -> Scene:
-    scene = (
-        await session.execute(
-            select(Scene).where(Scene.story_id == story_id, Scene.code == scene_code)
-        )
-    ).scalar_one_or_none()
-    if not scene:
+) -> Row:
+    scene = await queries.first_row(session, queries.SCENE_BY_CODE, {"story_id": story_id, "scene_code": scene_code})
+    if scene is None:
         raise HTTPException(status_code=404, detail="scene_not_found")
     return scene
 
 
-async def _get_scene_text(session: AsyncSession, scene_id: int, lang: str) -> str:
-    row = (
-        await session.execute(
-            select(SceneI18n.text).where(SceneI18n.scene_id == scene_id, SceneI18n.lang == lang)
-        )
-    ).scalar_one_or_none()
-    if row is None:
-        # fallback: любой язык
-        row = (
-            await session.execute(
-                select(SceneI18n.text).where(SceneI18n.scene_id == scene_id)
-            )
-        ).scalar_one_or_none()
-    return row or ""
-
-
-async def _get_choices(
-    session: AsyncSession, scene_id: int, lang: str
-) -> List[ChoiceOut]:
-    choices = (
-        await session.execute(select(Choice).where(Choice.scene_id == scene_id))
-    ).scalars().all()
-    result: List[ChoiceOut] = []
-    for ch in choices:
-        label = (
-            await session.execute(
-                select(ChoiceI18n.label).where(
-                    ChoiceI18n.choice_id == ch.id, ChoiceI18n.lang == lang
-                )
-            )
-        ).scalar_one_or_none()
-        if label is None:
-            label = (
-                await session.execute(
-                    select(ChoiceI18n.label).where(ChoiceI18n.choice_id == ch.id)
-                )
-            ).scalar_one_or_none() or ch.code
-        result.append(
-            ChoiceOut(
-                code=ch.code,
-                label=label,
-                leads_to=ch.leads_to,
-                gem_cost=ch.gem_cost,
-                heat_points=ch.heat_points,
-                requires_item=ch.requires_item,
-                is_premium=ch.is_premium,
-            )
-        )
-    return result
+async def _fetch_scene_state(session: AsyncSession, user_id: int, story_id: int, scene_code: str) -> list:
+    scene_key = {"story_id": story_id, "scene_code": scene_code}
+    return await pipeline.fetch(
+        session,
+        (queries.STATE_SCENE, scene_key),
+        (queries.STATE_TEXTS, scene_key),
+        (queries.STATE_CHOICES, scene_key),
+        (queries.STATE_LABELS, scene_key),
+        (queries.STATE_AGE, {"user_id": user_id}),
+        (queries.STATE_ITEMS, {"user_id": user_id, "story_id": story_id}),
+    )
 
 
+@tracing.traced()
 async def _build_state(
     session: AsyncSession, user: User, wallet: Wallet, story: Story, scene_code: str, lang: str
 ) -> StateOut:
-    scene = await _get_scene_by_code(session, story.id, scene_code)
-    text = await _get_scene_text(session, scene.id, lang)
-    choices = await _get_choices(session, scene.id, lang)
-    age = (
-        await session.execute(select(AgeConsent).where(AgeConsent.user_id == user.id))
-    ).scalar_one_or_none()
-    owned_items = (
-        await session.execute(select(UserItem.item_code).where(UserItem.user_id == user.id, UserItem.story_id == story.id))
-    ).scalars().all()
+    scenes, texts, choice_rows, label_rows, age, item_rows = await _fetch_scene_state(
+        session, user.id, story.id, scene_code
+    )
+    if not scenes:
+        raise HTTPException(status_code=404, detail="scene_not_found")
+    scene = scenes[0]
+    # нужный язык, иначе любой (как в _load_scene_contents)
+    text = next((value for text_lang, value in texts if text_lang == lang), texts[0].text if texts else "")
+    labels: dict[int, str] = {}
+    for choice_id, label_lang, label in label_rows:
+        if label_lang == lang or choice_id not in labels:
+            labels[choice_id] = label
+    choices = [
+        ChoiceOut(
+            code=ch.code,
+            label=labels.get(ch.id, ch.code),
+            leads_to=ch.leads_to,
+            gem_cost=ch.gem_cost,
+            heat_points=ch.heat_points,
+            requires_item=ch.requires_item,
+            is_premium=ch.is_premium,
+        )
+        for ch in choice_rows
+    ]
+    owned_items = [code for (code,) in item_rows]
     catalog = ITEM_CATALOG.get(story.code, {})
     shop_list = [
         ShopItemOut(code=icode, price_gems=price, owned=(icode in owned_items))
@@ -411,7 +612,7 @@ async def _build_state(
             gems=wallet.gems,
             is_premium=_is_premium_active(user, wallet),
         ),
-        age_confirmed=bool(age is not None),
+        age_confirmed=bool(age),
         items=list(owned_items),
         shop=shop_list,
     )
@@ -426,6 +627,7 @@ DEFAULT_STORY_CODE = os.getenv("DEFAULT_STORY_CODE", "campus_arc1_v7")
 
 
 @app.get("/api/state", response_model=StateOut)
+@tracing.traced()
 async def get_state(
     story: Optional[str] = Query(None),
     lang: str = "ru",
@@ -441,6 +643,7 @@ async def get_state(
                 len(x_telegram_init_data or ""),
                 len(init_data_q or ""),
                 bool(x_debug_tg_id),
+                extra={"event": "init_data"},
             )
         except Exception:
             pass
@@ -456,22 +659,144 @@ async def get_state(
         except ValueError:
             raise HTTPException(status_code=400, detail="invalid_tg_id")
 
+    story_code = story or DEFAULT_STORY_CODE
+    # повторный /api/state, пока такой же ещё в очереди или выполняется, получает его ответ
+    return await userlock.coalesce(
+        tg_id, ("state", story_code, lang), lambda: _load_state(session, tg_id, story_code, lang)
+    )
+
+
+@tracing.traced()
+async def _load_state(session: AsyncSession, tg_id: int, story_code: str, lang: str) -> StateOut:
+    # на SQLite чтение не берёт блокировку записи: она нужна только на flush/commit ниже
+    sqlite_begin(session, SQLITE_READ)
+    try:
+        user, wallet, story_row, progress, next_energy_in = await _touch_state(session, tg_id, story_code, lang)
+    except OperationalError as exc:
+        if not sqlite_write_refused(exc):
+            raise
+        # запись занята другим писателем или он закоммитил после нашего чтения — повтор с BEGIN IMMEDIATE
+        await session.rollback()
+        sqlite_begin(session, SQLITE_BEGIN)
+        user, wallet, story_row, progress, next_energy_in = await _touch_state(session, tg_id, story_code, lang)
+        sqlite_begin(session, SQLITE_READ)
+    state = await _build_state(session, user, wallet, story_row, progress.current_scene, lang)
+    state.next_energy_in = next_energy_in
+    return state
+
+
+async def _touch_state(session: AsyncSession, tg_id: int, story_code: str, lang: str):
+    """Пользователь, кошелёк с восстановленной энергией и прогресс — закоммичены."""
     user, wallet = await _get_or_create_user(session, tg_id, lang)
     # ленивое восстановление энергии
     next_energy_in = _regenerate_energy(wallet, _now_ts())
-    story_code = story or DEFAULT_STORY_CODE
     story_row = await _get_story(session, story_code)
     progress, _ = await _get_or_create_progress(session, user, story_row)
     await session.commit()
-    state = await _build_state(session, user, wallet, story_row, progress.current_scene, lang)
-    state.next_energy_in = next_energy_in
-    return state
+    return user, wallet, story_row, progress, next_energy_in
 
 
 @app.get("/api/stories", response_model=StoriesOut)
-async def list_stories(session: AsyncSession = Depends(get_session)):
-    rows = (await session.execute(select(Story.code))).scalars().all()
-    return StoriesOut(stories=rows)
+@tracing.traced()
+async def list_stories(session: AsyncSession = Depends(replicas.get_read_session)):
+    rows = await queries.all_rows(session, queries.STORY_CODES)
+    return StoriesOut(stories=[row.code for row in rows])
+
+
+# -------------------------------
+# API: /api/content/* — статический контент сцен для предзагрузки на клиенте
+# -------------------------------
+
+
+MAX_PREFETCH_SCENES = 16
+
+
+@tracing.traced()
+async def _load_scene_contents(
+    session: AsyncSession, story_id: int, lang: str, codes: Optional[List[str]] = None
+) -> List[SceneContentOut]:
+    """Пакетная загрузка сцен с текстами и выборами (4 запроса вместо N+1).
+
+    Premium-сцены не отдаются: клиент рендерит их только после ответа сервера.
+    """
+    if codes is None:
+        scenes = await queries.all_rows(session, queries.CONTENT_SCENES, {"story_id": story_id})
+    else:
+        scenes = await queries.all_rows(session, queries.CONTENT_SCENES_BY_CODES, {"story_id": story_id, "codes": codes})
+    if not scenes:
+        return []
+    scene_ids = [s.id for s in scenes]
+
+    texts: dict[int, str] = {}
+    for scene_id, text_lang, text in await queries.all_rows(session, queries.CONTENT_TEXTS, {"scene_ids": scene_ids}):
+        # нужный язык важнее любого другого (fallback как в _build_state)
+        if text_lang == lang or scene_id not in texts:
+            texts[scene_id] = text
+
+    choices = await queries.all_rows(session, queries.CONTENT_CHOICES, {"scene_ids": scene_ids})
+    labels: dict[int, str] = {}
+    if choices:
+        choice_ids = [c.id for c in choices]
+        for choice_id, label_lang, label in await queries.all_rows(session, queries.CONTENT_LABELS, {"choice_ids": choice_ids}):
+            if label_lang == lang or choice_id not in labels:
+                labels[choice_id] = label
+
+    by_scene: dict[int, List[ChoiceOut]] = {sid: [] for sid in scene_ids}
+    for ch in choices:
+        by_scene[ch.scene_id].append(
+            ChoiceOut(
+                code=ch.code,
+                label=labels.get(ch.id, ch.code),
+                leads_to=ch.leads_to,
+                gem_cost=ch.gem_cost,
+                heat_points=ch.heat_points,
+                requires_item=ch.requires_item,
+                is_premium=ch.is_premium,
+            )
+        )
+    return [
+        SceneContentOut(
+            scene=SceneOut(
+                code=scene.code,
+                image_url=scene.image_url,
+                is_premium=scene.is_premium,
+                energy_cost=scene.energy_cost,
+                text=texts.get(scene.id, ""),
+            ),
+            choices=by_scene[scene.id],
+        )
+        for scene in scenes
+    ]
+
+
+@app.get("/api/content/scenes", response_model=ScenesContentOut)
+@tracing.traced()
+async def get_content_scenes(
+    story: str = Query(...),
+    codes: str = Query(...),
+    lang: str = "ru",
+    session: AsyncSession = Depends(replicas.get_read_session),
+):
+    """Контент нескольких сцен (обычно все leads_to текущей) для оптимистичных переходов."""
+    scene_codes = [c.strip() for c in codes.split(",") if c.strip()][:MAX_PREFETCH_SCENES]
+    story_row = await _get_story(session, story)
+    if not scene_codes:
+        return ScenesContentOut(scenes=[])
+    return ScenesContentOut(
+        scenes=await _load_scene_contents(session, story_row.id, lang, scene_codes)
+    )
+
+
+@app.get("/api/content/bundle", response_model=ScenesContentOut)
+@tracing.traced()
+async def get_content_bundle(
+    story: str = Query(...),
+    lang: str = "ru",
+    session: AsyncSession = Depends(replicas.get_read_session),
+):
+    """Весь бесплатный контент истории одним ответом — кэшируется service worker'ом."""
+    story_row = await _get_story(session, story)
+    return ScenesContentOut(scenes=await _load_scene_contents(session, story_row.id, lang))
 
 
 # -------------------------------
@@ -480,6 +805,7 @@ async def list_stories(session: AsyncSession = Depends(get_session)):
 
 
 @app.post("/api/choose", response_model=StateOut)
+@tracing.traced()
 async def post_choose(
     body: ChooseIn,
     x_telegram_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data"),
@@ -493,6 +819,7 @@ async def post_choose(
                 len(body.init_data or ""),
                 len(x_telegram_init_data or ""),
                 bool(x_debug_tg_id),
+                extra={"event": "init_data"},
             )
         except Exception:
             pass
@@ -516,25 +843,19 @@ async def post_choose(
     current_scene = await _get_scene_by_code(session, story_row.id, progress.current_scene)
 
     # выбор
-    choice = (
-        await session.execute(
-            select(Choice).where(Choice.scene_id == current_scene.id, Choice.code == body.choice_code)
-        )
-    ).scalar_one_or_none()
-    if not choice:
+    choice = await queries.first_row(
+        session, queries.CHOICE_BY_CODE, {"scene_id": current_scene.id, "choice_code": body.choice_code}
+    )
+    if choice is None:
         raise HTTPException(status_code=400, detail="invalid_choice")
 
     # проверки: предмет
     if choice.requires_item:
-        have_item = (
-            await session.execute(
-                select(UserItem).where(
-                    UserItem.user_id == user.id,
-                    UserItem.story_id == story_row.id,
-                    UserItem.item_code == choice.requires_item,
-                )
-            )
-        ).scalar_one_or_none()
+        have_item = await queries.exists(
+            session,
+            queries.HAS_ITEM,
+            {"user_id": user.id, "story_id": story_row.id, "item_code": choice.requires_item},
+        )
         if not have_item:
             price = ITEM_CATALOG.get(story_row.code, {}).get(choice.requires_item, 0)
             raise HTTPException(status_code=400, detail={"code": "item_required", "item_code": choice.requires_item, "price_gems": price})
@@ -546,15 +867,11 @@ async def post_choose(
 
     # проверка/списание: гемы (разовый анлок на сцену)
     if choice.gem_cost and choice.gem_cost > 0:
-        already_unlocked = (
-            await session.execute(
-                select(GemUnlock).where(
-                    GemUnlock.user_id == user.id,
-                    GemUnlock.story_id == story_row.id,
-                    GemUnlock.scene_code == current_scene.code,
-                )
-            )
-        ).scalar_one_or_none()
+        already_unlocked = await queries.exists(
+            session,
+            queries.HAS_GEM_UNLOCK,
+            {"user_id": user.id, "story_id": story_row.id, "scene_code": current_scene.code},
+        )
         if not already_unlocked:
             if wallet.gems < choice.gem_cost:
                 raise HTTPException(status_code=400, detail="gems_required")
@@ -564,14 +881,7 @@ async def post_choose(
     # определить следующую сцену
     next_scene_code: Optional[str] = choice.leads_to
     if not next_scene_code:
-        # Роутер концовок по heat_score
-        heat = meta.heat_score
-        if heat <= 0:
-            next_scene_code = "ending_soft"
-        elif heat <= 2:
-            next_scene_code = "ending_hot"
-        else:
-            next_scene_code = "ending_max"
+        next_scene_code = _route_ending(meta.heat_score)
 
     # целевая сцена
     target_scene = await _get_scene_by_code(session, story_row.id, next_scene_code)
@@ -594,15 +904,9 @@ async def post_choose(
     # Для простоты: если choice.code начинается с 'give_' — item_code = после префикса
     if choice.code.startswith("give_"):
         item_code = choice.code.removeprefix("give_")
-        exists = (
-            await session.execute(
-                select(UserItem).where(
-                    UserItem.user_id == user.id,
-                    UserItem.story_id == story_row.id,
-                    UserItem.item_code == item_code,
-                )
-            )
-        ).scalar_one_or_none()
+        exists = await queries.exists(
+            session, queries.HAS_ITEM, {"user_id": user.id, "story_id": story_row.id, "item_code": item_code}
+        )
         if not exists:
             session.add(UserItem(user_id=user.id, story_id=story_row.id, item_code=item_code))
 
@@ -617,6 +921,76 @@ async def post_choose(
     return state
 
 
+# -------------------------------
+# API: /api/admin/* (только с ADMIN_TOKEN)
+# -------------------------------
+
+
+def _require_admin(x_admin_token: Optional[str]) -> None:
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or not hmac.compare_digest(x_admin_token or "", admin_token):
+        raise HTTPException(status_code=404, detail="not_found")
+
+
+@app.get("/api/admin/slow-queries")
+@tracing.traced()
+async def get_admin_slow_queries(
+    limit: int = Query(20, ge=1, le=200),
+    x_admin_token: Optional[str] = Header(None, alias="X-Admin-Token"),
+):
+    _require_admin(x_admin_token)
+    return {
+        "threshold_ms": slowlog.SLOW_QUERY_MS,
+        "window_seconds": slowlog.WINDOW_SECONDS,
+        "top": slowlog.top(limit),
+    }
+
+
+@app.get("/api/admin/profiles/{profile_id}")
+@tracing.traced()
+async def get_admin_profile(
+    profile_id: str,
+    x_admin_token: Optional[str] = Header(None, alias="X-Admin-Token"),
+):
+    _require_admin(x_admin_token)
+    profile = profiling.load(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="profile_not_found")
+    return profile
+
+
+class LogLevelIn(BaseModel):
+    level: str
+    minutes: float = 15  # 0 — без автоматического возврата
+
+
+@app.post("/api/admin/log-level")
+@tracing.traced()
+async def post_admin_log_level(
+    body: LogLevelIn,
+    x_admin_token: Optional[str] = Header(None, alias="X-Admin-Token"),
+):
+    _require_admin(x_admin_token)
+    level = body.level.upper()
+    if level not in ("DEBUG", "INFO", "WARNING", "ERROR"):
+        raise HTTPException(status_code=400, detail="invalid_level")
+    logs.set_level(level, body.minutes)
+    return {"ok": True, "level": level, "revert_to": logs.LOG_LEVEL if body.minutes > 0 else None}
+
+
+# -------------------------------
+# API: /api/telemetry — тайминги клиента (батчи через sendBeacon)
+# -------------------------------
+
+
+@app.post("/api/telemetry", status_code=status.HTTP_204_NO_CONTENT)
+@tracing.traced()
+async def post_telemetry(body: telemetry.TelemetryIn):
+    # Без записи в БД на запрос: только агрегация в памяти, сброс — в telemetry.flush_loop
+    telemetry.ingest(body)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
 # -------------------------------
 # API: /api/purchase/mock (MVP stub)
 # -------------------------------
@@ -628,6 +1002,7 @@ class PurchaseMockIn(BaseModel):
 
 
 @app.post("/api/purchase/mock")
+@tracing.traced()
 async def post_purchase_mock(
     body: PurchaseMockIn,
     x_telegram_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data"),
@@ -663,6 +1038,7 @@ class RestartIn(BaseModel):
 
 
 @app.post("/api/restart", response_model=StateOut)
+@tracing.traced()
 async def post_restart(
     body: RestartIn,
     x_telegram_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data"),
@@ -675,6 +1051,7 @@ async def post_restart(
                 "restart: header len=%s, has_debug=%s",
                 len(x_telegram_init_data or ""),
                 bool(x_debug_tg_id),
+                extra={"event": "init_data"},
             )
         except Exception:
             pass
@@ -695,9 +1072,6 @@ async def post_restart(
     progress.current_scene = story_row.start_scene
     meta.heat_score = 0
     # очистить разовые анлоки (предметы сохраняем между прохождениями)
-    await session.execute(
-        select(GemUnlock)  # pragma: no cover
-    )
     await session.execute(
         GemUnlock.__table__.delete().where(
             GemUnlock.user_id == user.id, GemUnlock.story_id == story_row.id
@@ -723,6 +1097,7 @@ class BuyItemIn(BaseModel):
 
 
 @app.post("/api/item/buy", response_model=StateOut)
+@tracing.traced()
 async def post_item_buy(
     body: BuyItemIn,
     x_telegram_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data"),
@@ -735,6 +1110,7 @@ async def post_item_buy(
                 "item_buy: header len=%s, has_debug=%s",
                 len(x_telegram_init_data or ""),
                 bool(x_debug_tg_id),
+                extra={"event": "init_data"},
             )
         except Exception:
             pass
@@ -751,15 +1127,9 @@ async def post_item_buy(
     story_row = await _get_story(session, body.story_code)
 
     # уже есть?
-    exist = (
-        await session.execute(
-            select(UserItem).where(
-                UserItem.user_id == user.id,
-                UserItem.story_id == story_row.id,
-                UserItem.item_code == body.item_code,
-            )
-        )
-    ).scalar_one_or_none()
+    exist = await queries.exists(
+        session, queries.HAS_ITEM, {"user_id": user.id, "story_id": story_row.id, "item_code": body.item_code}
+    )
     if exist:
         # просто вернуть состояние
         progress, _ = await _get_or_create_progress(session, user, story_row)
@@ -786,6 +1156,7 @@ async def post_item_buy(
 
 
 @app.post("/api/dev/grant")
+@tracing.traced()
 async def post_dev_grant(
     body: DevGrantIn,
     x_telegram_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data"),
@@ -800,6 +1171,7 @@ async def post_dev_grant(
                 "dev_grant: header len=%s, has_debug=%s",
                 len(x_telegram_init_data or ""),
                 bool(x_debug_tg_id),
+                extra={"event": "init_data"},
             )
         except Exception:
             pass
@@ -822,6 +1194,7 @@ async def post_dev_grant(
 
 
 @app.post("/api/age/confirm")
+@tracing.traced()
 async def post_age_confirm(
     body: AgeConfirmIn,
     x_telegram_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data"),
@@ -837,6 +1210,7 @@ async def post_age_confirm(
                 len(x_telegram_init_data or ""),
                 len(init_data_q or ""),
                 bool(x_debug_tg_id),
+                extra={"event": "init_data"},
             )
         except Exception:
             pass
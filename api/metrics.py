@@ -0,0 +1,242 @@
+"""Метрики в формате Prometheus: латентность по роутам, SQL на запрос, пул соединений, кэши.
+
+Сбор дешёвый (perf_counter + инкременты словарей), поэтому включён всегда.
+"""
+from typing import Any, Callable, Optional
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from . import db, pipeline, userlock
+
+
+LATENCY_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS: tuple[float, ...] = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последний — +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class RequestStats:
+    """Счётчики БД текущего запроса (живут в contextvar на время запроса)."""
+
+    __slots__ = ("scope", "statements", "db_time", "checkout_wait", "lock_wait")
+
+    def __init__(self, scope) -> None:
+        self.scope = scope
+        self.statements = 0
+        self.db_time = 0.0
+        self.checkout_wait = 0.0
+        self.lock_wait: Optional[float] = None  # None — запрос не вставал в очередь пользователя
+
+    @property
+    def route(self) -> str:
+        # роутер заполняет scope до вызова обработчика, так что внутри запроса шаблон уже известен
+        return _route_of(self.scope)
+
+
+def _route_of(scope) -> str:
+    # FastAPI кладёт сматченный APIRoute в scope["route"]: шаблон пути, а не сырой URL
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+_latency: dict[tuple[str, str], Histogram] = {}
+_responses: dict[tuple[str, str, int], int] = {}
+_statements: dict[str, Histogram] = {}
+_db_time: dict[str, Histogram] = {}
+_checkout_wait: dict[str, Histogram] = {}
+_lock_wait: dict[str, Histogram] = {}
+_statements_total = 0
+_caches: dict[str, Callable[[], tuple[int, int]]] = {}
+_extra: dict[str, tuple[str, str, Callable[[], float]]] = {}
+
+
+def register_cache(name: str, stats: Callable[[], tuple[int, int]]) -> None:
+    """Зарегистрировать in-process кэш: stats() -> (hits, misses)."""
+    _caches[name] = stats
+
+
+def register_value(name: str, help_: str, value: Callable[[], float], kind: str = "gauge") -> None:
+    """Зарегистрировать произвольную метрику другого модуля (считывается при рендере)."""
+    _extra[name] = (help_, kind, value)
+
+
+def _hist(store: dict, key, bounds: tuple[float, ...]) -> Histogram:
+    hist = store.get(key)
+    if hist is None:
+        hist = store[key] = Histogram(bounds)
+    return hist
+
+
+class MetricsMiddleware:
+    """ASGI-мидлварь: латентность и статусы по шаблону роута + агрегаты БД на запрос."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request.reset(token)
+            route = stats.route
+            method = scope.get("method", "")
+            _hist(_latency, (route, method), LATENCY_BUCKETS).observe(elapsed)
+            key = (route, method, status_code)
+            _responses[key] = _responses.get(key, 0) + 1
+            if stats.statements or stats.checkout_wait:
+                _hist(_statements, route, STATEMENT_BUCKETS).observe(stats.statements)
+                _hist(_db_time, route, LATENCY_BUCKETS).observe(stats.db_time)
+                _hist(_checkout_wait, route, LATENCY_BUCKETS).observe(stats.checkout_wait)
+            if stats.lock_wait is not None:
+                _hist(_lock_wait, route, LATENCY_BUCKETS).observe(stats.lock_wait)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["metrics_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    global _statements_total
+    started = conn.info.pop("metrics_start", None)
+    _statements_total += 1
+    stats = current_request.get()
+    if stats is not None and started is not None:
+        stats.statements += 1
+        stats.db_time += time.perf_counter() - started
+
+
+def _on_batch(conn, statements: list[tuple[str, Any]], seconds: float) -> None:
+    # пакет api/pipeline.py: все запросы за один round-trip
+    global _statements_total
+    _statements_total += len(statements)
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements += len(statements)
+        stats.db_time += seconds
+
+
+def _on_checkout_wait(seconds: float) -> None:
+    stats = current_request.get()
+    if stats is not None:
+        stats.checkout_wait += seconds
+
+
+def _on_user_lock_wait(seconds: float) -> None:
+    # очередь пользователя в воркере и pg_advisory_xact_lock, см. api/userlock.py
+    stats = current_request.get()
+    if stats is not None:
+        stats.lock_wait = (stats.lock_wait or 0.0) + seconds
+
+
+def install(engine=db.engine) -> None:
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    if _on_checkout_wait not in db.pool_checkout_listeners:  # общий список для всех движков
+        db.pool_checkout_listeners.append(_on_checkout_wait)
+    if _on_batch not in pipeline.batch_listeners:
+        pipeline.batch_listeners.append(_on_batch)
+    if _on_user_lock_wait not in userlock.wait_listeners:
+        userlock.wait_listeners.append(_on_user_lock_wait)
+
+
+# -------------------------------
+# Экспозиция
+# -------------------------------
+
+
+def _labels(**labels) -> str:
+    parts = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _render_histograms(out: list[str], name: str, help_: str, store: dict, label_names: tuple[str, ...]) -> None:
+    out.append(f"# HELP {name} {help_}")
+    out.append(f"# TYPE {name} histogram")
+    for key, hist in sorted(store.items()):
+        labels = dict(zip(label_names, key if isinstance(key, tuple) else (key,)))
+        cumulative = 0
+        for bound, count in zip(hist.bounds, hist.counts):
+            cumulative += count
+            out.append(f"{name}_bucket{_labels(**labels, le=bound)} {cumulative}")
+        out.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {hist.count}")
+        out.append(f"{name}_sum{_labels(**labels)} {hist.sum}")
+        out.append(f"{name}_count{_labels(**labels)} {hist.count}")
+
+
+def _gauge(out: list[str], name: str, help_: str, value, kind: str = "gauge") -> None:
+    out.append(f"# HELP {name} {help_}")
+    out.append(f"# TYPE {name} {kind}")
+    out.append(f"{name} {value}")
+
+
+def render() -> str:
+    out: list[str] = []
+    _render_histograms(out, "romance_http_request_duration_seconds", "Request latency by route.", _latency, ("route", "method"))
+    out.append("# HELP romance_http_responses_total Responses by route and status code.")
+    out.append("# TYPE romance_http_responses_total counter")
+    for (route, method, code), count in sorted(_responses.items()):
+        out.append(f"romance_http_responses_total{_labels(route=route, method=method, status=code)} {count}")
+    _render_histograms(out, "romance_db_statements_per_request", "SQL statements per request.", _statements, ("route",))
+    _render_histograms(out, "romance_db_time_per_request_seconds", "Time spent in SQL per request.", _db_time, ("route",))
+    _render_histograms(out, "romance_db_checkout_wait_seconds", "Pool checkout wait per request.", _checkout_wait, ("route",))
+    _render_histograms(
+        out, "romance_user_lock_wait_seconds", "Wait behind earlier requests of the same user.", _lock_wait, ("route",)
+    )
+    _gauge(out, "romance_db_statements_total", "SQL statements executed.", _statements_total, "counter")
+
+    pool = db.engine.sync_engine.pool
+    for name, attr, help_ in (
+        ("romance_db_pool_size", "size", "Configured pool size."),
+        ("romance_db_pool_checked_out", "checkedout", "Connections currently checked out."),
+        ("romance_db_pool_checked_in", "checkedin", "Idle connections in the pool."),
+        ("romance_db_pool_overflow", "overflow", "Current overflow (negative: unopened slots)."),
+    ):
+        getter = getattr(pool, attr, None)
+        if getter is not None:
+            _gauge(out, name, help_, getter())
+
+    if _caches:
+        out.append("# HELP romance_cache_requests_total In-process cache lookups by result.")
+        out.append("# TYPE romance_cache_requests_total counter")
+        for name, stats in sorted(_caches.items()):
+            hits, misses = stats()
+            out.append(f"romance_cache_requests_total{_labels(cache=name, result='hit')} {hits}")
+            out.append(f"romance_cache_requests_total{_labels(cache=name, result='miss')} {misses}")
+    for name, (help_, kind, value) in sorted(_extra.items()):
+        _gauge(out, name, help_, value(), kind)
+    return "\n".join(out) + "\n"
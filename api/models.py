@@ -1,5 +1,5 @@
 ﻿from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import BigInteger, String, Boolean, Integer, ForeignKey, Text, UniqueConstraint
+from sqlalchemy import BigInteger, String, Boolean, Integer, ForeignKey, Text, UniqueConstraint, Index
 from .db import Base
 
 # Пользователи
@@ -34,6 +34,7 @@ class Scene(Base):
     image_url: Mapped[str] = mapped_column(Text, default="")
     is_premium: Mapped[bool] = mapped_column(Boolean, default=False)
     energy_cost: Mapped[int] = mapped_column(Integer, default=0)
+    __table_args__ = (Index("ix_scenes_story_code", "story_id", "code"),)
 
 class SceneI18n(Base):
     __tablename__ = "scene_i18n"
@@ -41,6 +42,7 @@ class SceneI18n(Base):
     scene_id: Mapped[int] = mapped_column(ForeignKey("scenes.id", ondelete="CASCADE"))
     lang: Mapped[str] = mapped_column(String(5))
     text: Mapped[str] = mapped_column(Text)
+    __table_args__ = (Index("ix_scene_i18n_scene_lang", "scene_id", "lang"),)
 
 class Choice(Base):
     __tablename__ = "choices"
@@ -52,6 +54,7 @@ class Choice(Base):
     gem_cost: Mapped[int] = mapped_column(Integer, default=0)
     heat_points: Mapped[int] = mapped_column(Integer, default=0)
     requires_item: Mapped[str | None] = mapped_column(String(100), nullable=True)
+    __table_args__ = (Index("ix_choices_scene_code", "scene_id", "code"),)
 
 class ChoiceI18n(Base):
     __tablename__ = "choice_i18n"
@@ -59,6 +62,7 @@ class ChoiceI18n(Base):
     choice_id: Mapped[int] = mapped_column(ForeignKey("choices.id", ondelete="CASCADE"))
     lang: Mapped[str] = mapped_column(String(5))
     label: Mapped[str] = mapped_column(Text)
+    __table_args__ = (Index("ix_choice_i18n_choice_lang", "choice_id", "lang"),)
 
 # Прогресс и мета
 class Progress(Base):
@@ -67,6 +71,7 @@ class Progress(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     story_id: Mapped[int] = mapped_column(ForeignKey("stories.id", ondelete="CASCADE"))
     current_scene: Mapped[str] = mapped_column(String(100))
+    __table_args__ = (Index("ix_progress_user_story", "user_id", "story_id"),)
 
 class ProgressMeta(Base):
     __tablename__ = "progress_meta"
@@ -121,3 +126,29 @@ class UserItem(Base):
     story_id: Mapped[int] = mapped_column(ForeignKey("stories.id", ondelete="CASCADE"))
     item_code: Mapped[str] = mapped_column(String(100))
     __table_args__ = (UniqueConstraint("user_id", "story_id", "item_code", name="uq_user_item"),)
+
+# Клиентская телеметрия: роллапы гистограмм таймингов (см. api/telemetry.py)
+class TelemetryRollup(Base):
+    __tablename__ = "telemetry_rollups"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    period_start: Mapped[str] = mapped_column(String(32))
+    metric: Mapped[str] = mapped_column(String(32))
+    story_code: Mapped[str] = mapped_column(String(100), default="")
+    scene_code: Mapped[str] = mapped_column(String(100), default="")
+    net: Mapped[str] = mapped_column(String(16), default="unknown")
+    count: Mapped[int] = mapped_column(Integer, default=0)
+    sum_ms: Mapped[int] = mapped_column(BigInteger, default=0)
+    buckets: Mapped[str] = mapped_column(Text, default="[]")
+
+# Применённые версии схемы (см. api/schema.py)
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    applied_at: Mapped[str] = mapped_column(String(32))
+
+# Карта шардов: бакет (tg_id % SHARD_BUCKETS) → номер шарда (см. api/shards.py)
+class ShardBucket(Base):
+    __tablename__ = "shard_buckets"
+    bucket: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    shard: Mapped[int] = mapped_column(Integer)
+    state: Mapped[str] = mapped_column(String(16), default="active")  # active | moving
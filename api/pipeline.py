@@ -0,0 +1,83 @@
+"""Пакетное выполнение независимых чтений за один round-trip (psycopg pipeline mode).
+
+fetch(session, (STMT, params), ...) отправляет все запросы на соединение сессии подряд,
+не дожидаясь ответов, и возвращает списки строк (поля доступны по имени) в том же порядке.
+Для БД в соседней зоне доступности (~1 мс на round-trip) группа из N чтений стоит ~1 мс
+вместо N.
+
+Запросы — Core-константы уровня модуля с bindparam(): SQL компилируется один раз на
+запрос и диалект. Выполнение идёт в текущей транзакции сессии (шард и реплика — как у
+неё). Не Postgres/psycopg, libpq без pipeline или DB_PIPELINE=0 — те же запросы
+выполняются по очереди на том же соединении.
+"""
+import os
+import time
+from typing import Any, Callable, Sequence
+
+from sqlalchemy.engine import Compiled
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import Executable
+
+
+DB_PIPELINE = os.getenv("DB_PIPELINE", "1") == "1"
+
+# Подписчики на выполненный пакет: (синхронное соединение, [(SQL, параметры драйвера)], секунды).
+# Пакет минует before/after_cursor_execute движка, поэтому метрики, лог медленных запросов,
+# трассировка и профилировщик (api/metrics.py, slowlog.py, tracing.py, profiling.py)
+# подписаны ещё и сюда. Ответы пакета приходят вместе: время — у пакета целиком.
+batch_listeners: list[Callable[[Any, list[tuple[str, Any]], float], None]] = []
+
+# (id(statement), диалект) -> (statement, скомпилированный); statement держим, чтобы id не переиспользовался
+_compiled: dict[tuple[int, str], tuple[Executable, Compiled]] = {}
+
+
+def _supported(session: AsyncSession) -> bool:
+    bind = session.get_bind()
+    if not DB_PIPELINE or bind.dialect.driver != "psycopg":
+        return False
+    from psycopg import Pipeline
+
+    return Pipeline.is_supported()
+
+
+def _compile(statement: Executable, dialect) -> Compiled:
+    key = (id(statement), dialect.name)
+    cached = _compiled.get(key)
+    if cached is None:
+        cached = _compiled[key] = (statement, statement.compile(dialect=dialect))
+    return cached[1]
+
+
+async def fetch(session: AsyncSession, *queries: tuple[Executable, dict]) -> list[list[Sequence]]:
+    """Результаты queries (все строки каждого) в том же порядке."""
+    conn = await session.connection()
+    if len(queries) < 2 or not _supported(session):
+        return [(await conn.execute(statement, params)).all() for statement, params in queries]
+
+    dialect = conn.dialect
+    compiled = [(_compile(statement, dialect), params) for statement, params in queries]
+
+    from psycopg.rows import namedtuple_row
+
+    raw = await conn.get_raw_connection()
+    aconn = raw.driver_connection
+    bound = [(item.string, item.construct_params(params)) for item, params in compiled]
+    started = time.perf_counter()
+    sql = ""
+    try:
+        cursors = []
+        async with aconn.pipeline():
+            for sql, driver_params in bound:
+                cursor = aconn.cursor(row_factory=namedtuple_row)  # поля по имени, как у Row
+                await cursor.execute(sql, driver_params)
+                cursors.append(cursor)
+        results = [await cursor.fetchall() for cursor in cursors]
+    except dialect.loaded_dbapi.Error as exc:
+        if aconn.closed:
+            await conn.invalidate(exc)
+        raise DBAPIError.instance(sql, None, exc, dialect.loaded_dbapi.Error) from exc
+    elapsed = time.perf_counter() - started
+    for listener in batch_listeners:
+        listener(conn.sync_connection, bound, elapsed)
+    return results
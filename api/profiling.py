@@ -0,0 +1,188 @@
+"""Профилирование одного запроса по требованию (ENABLE_PROFILING=1).
+
+Запрос с заголовком X-Profile: 1 (или ?__profile=1) и валидным X-Admin-Token выполняется
+под сэмплирующим профайлером потока event loop'а; стеки сохраняются в folded-формате
+(flamegraph.pl / speedscope), рядом — тайминги каждого SQL этого запроса. Id профиля
+возвращается в заголовке X-Profile-Id, сам профиль — GET /api/admin/profiles/{id}.
+
+Без ENABLE_PROFILING мидлварь и SQL-хуки не устанавливаются вовсе.
+"""
+from typing import Any, Optional
+import os
+import sys
+import json
+import time
+import uuid
+import hmac
+import tempfile
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from sqlalchemy import event
+
+from . import db, pipeline
+
+
+ENABLED = os.getenv("ENABLE_PROFILING") == "1"
+INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_MS", "2")) / 1000
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR") or Path(tempfile.gettempdir()) / "romance-profiles")
+
+_db_calls: ContextVar[Optional[list]] = ContextVar("profile_db_calls", default=None)
+_busy = threading.Lock()  # одновременно профилируем один запрос: сэмплер видит весь поток loop'а
+
+
+class StackSampler(threading.Thread):
+    """Раз в interval снимает стек заданного потока и копит счётчики свёрнутых стеков."""
+
+    def __init__(self, thread_id: int, interval: float) -> None:
+        super().__init__(name="request-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            parts = []
+            while frame is not None:
+                code = frame.f_code
+                parts.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(parts))] += 1
+            self.samples += 1
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+def _requested(scope) -> bool:
+    headers = dict(scope.get("headers") or ())
+    if headers.get(b"x-profile") == b"1":
+        return True
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return query.get("__profile") == ["1"]
+
+
+def _authorized(scope) -> bool:
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        return False
+    supplied = dict(scope.get("headers") or ()).get(b"x-admin-token", b"").decode("latin-1")
+    return hmac.compare_digest(supplied, admin_token)
+
+
+def _save(profile_id: str, sampler: StackSampler, db_calls: list, scope, elapsed: float) -> None:
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    folded = "\n".join(f"{stack} {count}" for stack, count in sampler.stacks.most_common())
+    (PROFILE_DIR / f"{profile_id}.folded").write_text(folded + "\n", encoding="utf-8")
+    summary = {
+        "id": profile_id,
+        "method": scope.get("method"),
+        "path": scope.get("path"),
+        "elapsed_ms": round(elapsed * 1000, 2),
+        "samples": sampler.samples,
+        "interval_ms": INTERVAL_SECONDS * 1000,
+        "db_ms": round(sum(c["ms"] for c in db_calls), 2),
+        "db_calls": db_calls,
+    }
+    (PROFILE_DIR / f"{profile_id}.json").write_text(json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+def load(profile_id: str) -> Optional[dict]:
+    try:
+        uuid.UUID(profile_id)  # не даём выйти за пределы PROFILE_DIR
+    except ValueError:
+        return None
+    meta_path = PROFILE_DIR / f"{profile_id}.json"
+    if not meta_path.exists():
+        return None
+    summary = json.loads(meta_path.read_text(encoding="utf-8"))
+    summary["folded"] = (PROFILE_DIR / f"{profile_id}.folded").read_text(encoding="utf-8")
+    return summary
+
+
+class ProfilingMiddleware:
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _requested(scope) or not _authorized(scope):
+            return await self.app(scope, receive, send)
+        if not _busy.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        profile_id = str(uuid.uuid4())
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        db_calls: list = []
+        token = _db_calls.set(db_calls)
+        sampler = StackSampler(threading.get_ident(), INTERVAL_SECONDS)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop()
+            elapsed = time.perf_counter() - start
+            _db_calls.reset(token)
+            try:
+                _save(profile_id, sampler, db_calls, scope, elapsed)
+            finally:
+                _busy.release()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _db_calls.get() is not None:
+        conn.info["profile_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    calls = _db_calls.get()
+    started = conn.info.pop("profile_start", None)
+    if calls is None or started is None:
+        return
+    calls.append({
+        "ms": round((time.perf_counter() - started) * 1000, 3),
+        "sql": " ".join(statement.split())[:300],
+    })
+
+
+def _on_batch(conn, statements: list[tuple[str, Any]], seconds: float) -> None:
+    # пакет api/pipeline.py — одна запись: ответы приходят вместе, db_ms не задваивается
+    calls = _db_calls.get()
+    if calls is None:
+        return
+    calls.append({
+        "ms": round(seconds * 1000, 3),
+        "sql": [" ".join(statement.split())[:300] for statement, _ in statements],
+    })
+
+
+def instrument_engine(engine) -> None:
+    """SQL-тайминги для движка (шарды, реплики)."""
+    if not ENABLED:
+        return
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    if _on_batch not in pipeline.batch_listeners:  # общий список для всех движков
+        pipeline.batch_listeners.append(_on_batch)
+
+
+def install(app, engine=db.engine) -> None:
+    if not ENABLED:
+        return
+    app.add_middleware(ProfilingMiddleware)
+    instrument_engine(engine)
@@ -0,0 +1,150 @@
+"""Горячие чтения: готовые Core-запросы над таблицами и лёгкие строки вместо ORM-сущностей.
+
+Запросы собираются один раз при импорте, параметры — bindparam(). Ключ кэша компиляции
+у неизменяемого запроса мемоизирован, поэтому на каждый вызов нет ни сборки select(),
+ни обхода дерева для ключа, ни ORM-контекста и заполнения identity map: только поиск в
+кэше SQL и кортежи Row. Поля доступны по имени (row.code), но объекты не отслеживаются
+сессией — менять их бессмысленно.
+
+ORM (select(Model)) остаётся там, где объект меняется и сохраняется при commit:
+пользователь, кошелёк, прогресс и мета (api/main.py), согласие в /api/age/confirm.
+"""
+from typing import Any, Optional, Sequence
+
+from sqlalchemy import Row, bindparam, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import Executable
+
+from .models import AgeConsent, Choice, ChoiceI18n, GemUnlock, Scene, SceneI18n, Story, UserItem
+
+
+stories = Story.__table__
+scenes = Scene.__table__
+scene_texts = SceneI18n.__table__
+choices = Choice.__table__
+choice_labels = ChoiceI18n.__table__
+user_items = UserItem.__table__
+gem_unlocks = GemUnlock.__table__
+age_consent = AgeConsent.__table__
+
+
+# -------------------------------
+# Истории и сцены
+# -------------------------------
+
+STORY_BY_CODE = select(stories.c.id, stories.c.code, stories.c.start_scene).where(stories.c.code == bindparam("code"))
+ALL_STORIES = select(stories.c.id, stories.c.code, stories.c.start_scene)
+STORY_CODES = select(stories.c.code)
+
+_SCENE_COLUMNS = (scenes.c.id, scenes.c.code, scenes.c.image_url, scenes.c.is_premium, scenes.c.energy_cost)
+_SCENE_KEY = (scenes.c.story_id == bindparam("story_id"), scenes.c.code == bindparam("scene_code"))
+SCENE_BY_CODE = select(*_SCENE_COLUMNS).where(*_SCENE_KEY)
+
+_CHOICE_COLUMNS = (
+    choices.c.id,
+    choices.c.scene_id,
+    choices.c.code,
+    choices.c.leads_to,
+    choices.c.gem_cost,
+    choices.c.heat_points,
+    choices.c.requires_item,
+    choices.c.is_premium,
+)
+CHOICE_BY_CODE = select(*_CHOICE_COLUMNS).where(
+    choices.c.scene_id == bindparam("scene_id"), choices.c.code == bindparam("choice_code")
+)
+
+
+# -------------------------------
+# Состояние сцены для пользователя (_build_state): один пакет api/pipeline.py
+# -------------------------------
+
+# Сцена, тексты и выборы ищутся по (story_id, scene_code) через join, а не по id сцены,
+# поэтому шесть чтений не зависят друг от друга.
+STATE_SCENE = SCENE_BY_CODE
+STATE_TEXTS = (
+    select(scene_texts.c.lang, scene_texts.c.text)
+    .join(scenes, scenes.c.id == scene_texts.c.scene_id)
+    .where(*_SCENE_KEY)
+)
+STATE_CHOICES = (
+    select(*_CHOICE_COLUMNS).join(scenes, scenes.c.id == choices.c.scene_id).where(*_SCENE_KEY).order_by(choices.c.id)
+)
+STATE_LABELS = (
+    select(choice_labels.c.choice_id, choice_labels.c.lang, choice_labels.c.label)
+    .join(choices, choices.c.id == choice_labels.c.choice_id)
+    .join(scenes, scenes.c.id == choices.c.scene_id)
+    .where(*_SCENE_KEY)
+)
+STATE_AGE = select(age_consent.c.user_id).where(age_consent.c.user_id == bindparam("user_id"))
+STATE_ITEMS = select(user_items.c.item_code).where(
+    user_items.c.user_id == bindparam("user_id"), user_items.c.story_id == bindparam("story_id")
+)
+
+
+# -------------------------------
+# Контент нескольких сцен (/api/content/*)
+# -------------------------------
+
+_FREE_SCENES = (scenes.c.story_id == bindparam("story_id"), scenes.c.is_premium.is_(False))
+CONTENT_SCENES = select(*_SCENE_COLUMNS).where(*_FREE_SCENES).order_by(scenes.c.id)
+CONTENT_SCENES_BY_CODES = (
+    select(*_SCENE_COLUMNS)
+    .where(*_FREE_SCENES, scenes.c.code.in_(bindparam("codes", expanding=True)))
+    .order_by(scenes.c.id)
+)
+CONTENT_TEXTS = select(scene_texts.c.scene_id, scene_texts.c.lang, scene_texts.c.text).where(
+    scene_texts.c.scene_id.in_(bindparam("scene_ids", expanding=True))
+)
+CONTENT_CHOICES = (
+    select(*_CHOICE_COLUMNS)
+    .where(choices.c.scene_id.in_(bindparam("scene_ids", expanding=True)))
+    .order_by(choices.c.id)
+)
+CONTENT_LABELS = select(choice_labels.c.choice_id, choice_labels.c.lang, choice_labels.c.label).where(
+    choice_labels.c.choice_id.in_(bindparam("choice_ids", expanding=True))
+)
+
+
+# -------------------------------
+# Проверки пользователя
+# -------------------------------
+
+HAS_ITEM = (
+    select(user_items.c.id)
+    .where(
+        user_items.c.user_id == bindparam("user_id"),
+        user_items.c.story_id == bindparam("story_id"),
+        user_items.c.item_code == bindparam("item_code"),
+    )
+    .limit(1)
+)
+HAS_GEM_UNLOCK = (
+    select(gem_unlocks.c.id)
+    .where(
+        gem_unlocks.c.user_id == bindparam("user_id"),
+        gem_unlocks.c.story_id == bindparam("story_id"),
+        gem_unlocks.c.scene_code == bindparam("scene_code"),
+    )
+    .limit(1)
+)
+
+
+# -------------------------------
+# Выполнение
+# -------------------------------
+
+
+async def all_rows(session: AsyncSession, statement: Executable, params: Optional[dict[str, Any]] = None) -> Sequence[Row]:
+    # через соединение сессии: та же транзакция и шард, но без ORM-пути session.execute
+    conn = await session.connection()
+    return (await conn.execute(statement, params or {})).all()
+
+
+async def first_row(session: AsyncSession, statement: Executable, params: Optional[dict[str, Any]] = None) -> Optional[Row]:
+    conn = await session.connection()
+    return (await conn.execute(statement, params or {})).first()
+
+
+async def exists(session: AsyncSession, statement: Executable, params: dict[str, Any]) -> bool:
+    return await first_row(session, statement, params) is not None
@@ -0,0 +1,172 @@
+"""Маршрутизация чистых чтений на реплики (DATABASE_REPLICA_URLS) с защитой read-your-writes.
+
+- Лаг каждой реплики опрашивается в фоне (REPLICA_CHECK_SECONDS). Реплика с лагом выше
+  REPLICA_MAX_LAG_SECONDS или недоступная выводится из ротации до следующего опроса.
+- Ответ на любой не-GET запрос к /api/* ставит cookie rw_at со временем записи. Чтение
+  идёт на реплику, только если её лаг (с запасом на интервал опроса) меньше возраста
+  последней записи пользователя. Иначе оно уходит на primary.
+- Не удалось соединиться с репликой — то же чтение уходит на primary.
+
+Без DATABASE_REPLICA_URLS get_read_session — это обычная сессия primary.
+"""
+import os
+import math
+import time
+import random
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import AsyncGenerator, Optional
+
+from fastapi import Request
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from . import db
+
+
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "2"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_SECONDS", "1"))
+RYW_COOKIE = "rw_at"
+# Telegram Web открывает мини-приложение в iframe: cookie без SameSite=None туда не дойдёт
+RYW_COOKIE_ATTRS = os.getenv("REPLICA_RYW_COOKIE_ATTRS", "Path=/api; HttpOnly; Secure; SameSite=None")
+
+# Не в рекавери (промоутнутая реплика) или всё полученное применено — лаг 0;
+# иначе — возраст последней применённой транзакции
+LAG_SQL = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 1e9) END"
+)
+
+logger = logging.getLogger("uvicorn.error")
+
+
+@dataclass
+class Replica:
+    engine: object
+    sessionmaker: async_sessionmaker
+    lag: Optional[float] = None  # None — ещё не опрошена или недоступна
+    reads: int = 0
+
+
+_replicas = [
+    Replica(engine=e, sessionmaker=async_sessionmaker(e, expire_on_commit=False, class_=AsyncSession))
+    for e in db.replica_engines
+]
+_primary_reads = 0
+
+
+def enabled() -> bool:
+    return bool(_replicas)
+
+
+def replica_reads() -> int:
+    return sum(r.reads for r in _replicas)
+
+
+def primary_reads() -> int:
+    return _primary_reads
+
+
+def max_lag() -> float:
+    lags = [r.lag for r in _replicas if r.lag is not None]
+    return max(lags) if lags else -1.0
+
+
+def _pick(last_write_at: Optional[float]) -> Optional[Replica]:
+    age = time.time() - last_write_at if last_write_at else math.inf
+    candidates = [
+        r for r in _replicas
+        if r.lag is not None and r.lag <= REPLICA_MAX_LAG and r.lag + REPLICA_CHECK_INTERVAL < age
+    ]
+    return random.choice(candidates) if candidates else None
+
+
+async def _check(replica: Replica) -> None:
+    try:
+        async with replica.engine.connect() as conn:
+            replica.lag = float((await conn.exec_driver_sql(LAG_SQL)).scalar_one())
+    except Exception as exc:
+        if replica.lag is not None:
+            logger.warning("replica %s unavailable: %s", replica.engine.url.host, exc)
+        replica.lag = None
+
+
+async def monitor_loop() -> None:
+    while True:
+        await asyncio.gather(*(_check(r) for r in _replicas))
+        await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+
+
+def _last_write(request: Request) -> Optional[float]:
+    try:
+        return float(request.cookies.get(RYW_COOKIE, ""))
+    except ValueError:
+        return None
+
+
+async def get_read_session(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    """Сессия для эндпоинтов без записи: реплика, если она догнала последнюю запись пользователя."""
+    global _primary_reads
+    session: Optional[AsyncSession] = None
+    replica = _pick(_last_write(request)) if _replicas else None
+    if replica is not None:
+        session = replica.sessionmaker()
+        try:
+            await session.connection()
+            replica.reads += 1
+        except (DBAPIError, PoolTimeoutError):
+            await session.close()
+            replica.lag = None  # до следующего успешного опроса
+            session = None
+    if session is None:
+        _primary_reads += 1
+        session = db.AsyncSessionLocal()
+        db.sqlite_begin(session, db.SQLITE_READ)
+    async with session:
+        yield session
+
+
+class ReadYourWritesMiddleware:
+    """Отмечает время записи в cookie на ответах не-GET запросов к /api/*."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.max_age = math.ceil(REPLICA_MAX_LAG + REPLICA_CHECK_INTERVAL) + 1
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope.get("method") in ("GET", "HEAD", "OPTIONS")
+            or not scope.get("path", "").startswith("/api/")
+            or scope.get("path") == "/api/telemetry"
+        ):
+            return await self.app(scope, receive, send)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                cookie = f"{RYW_COOKIE}={time.time():.3f}; Max-Age={self.max_age}; {RYW_COOKIE_ATTRS}"
+                message["headers"] = [*message.get("headers", []), (b"set-cookie", cookie.encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def install(app) -> None:
+    if not _replicas:
+        return
+    from . import metrics, profiling, slowlog, tracing
+
+    for replica in _replicas:
+        metrics.install(replica.engine)
+        slowlog.install(replica.engine)
+        tracing.instrument_engine(replica.engine)
+        profiling.instrument_engine(replica.engine)
+    metrics.register_value(
+        "romance_db_replica_lag_seconds", "Worst lag among healthy replicas (-1: none healthy).", max_lag
+    )
+    metrics.register_value("romance_db_replica_reads_total", "Read sessions served by replicas.", replica_reads, "counter")
+    metrics.register_value(
+        "romance_db_primary_reads_total", "Read sessions that stayed on or fell back to primary.", primary_reads, "counter"
+    )
+    app.add_middleware(ReadYourWritesMiddleware)
@@ -0,0 +1,63 @@
+"""Версия схемы БД: DDL выполняется миграцией (tools/db_migrate.py), а не при старте API.
+
+Таблица schema_version хранит применённые версии. Воркер при старте только сверяет
+версию (один SELECT) и не держит блокировки каталога, как create_all на каждом буте.
+SCHEMA_VERSION увеличивается вместе с изменением моделей в api/models.py.
+"""
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import func, inspect, select
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .db import Base, shard_engines
+from .models import SchemaVersion
+
+
+SCHEMA_VERSION = 2
+
+
+def _create_all(sync_conn) -> None:
+    Base.metadata.create_all(sync_conn)
+    # create_all не добавляет индексы в уже существующие таблицы
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+async def migrate() -> int:
+    """Создать недостающие таблицы/индексы и отметить текущую версию на всех шардах. Идемпотентно."""
+    from . import shards
+
+    for shard_engine in shard_engines:
+        async with shard_engine.begin() as conn:
+            await conn.run_sync(_create_all)
+            current = await _db_version(conn)
+            if current is None or current < SCHEMA_VERSION:
+                await conn.execute(
+                    SchemaVersion.__table__.insert().values(
+                        version=SCHEMA_VERSION, applied_at=datetime.now(timezone.utc).isoformat()
+                    )
+                )
+    await shards.ensure_map()
+    return SCHEMA_VERSION
+
+
+async def _db_version(conn: AsyncConnection) -> Optional[int]:
+    exists = await conn.run_sync(lambda c: inspect(c).has_table(SchemaVersion.__tablename__))
+    if not exists:
+        return None
+    return (await conn.execute(select(func.max(SchemaVersion.version)))).scalar_one_or_none()
+
+
+async def check() -> Optional[str]:
+    """None — схема подходит; иначе код причины для /api/health/ready."""
+    for shard_engine in shard_engines:
+        async with shard_engine.connect() as conn:
+            version = await _db_version(conn)
+        if version is None:
+            return "schema_missing"
+        # более новая схема допустима: при выкатке миграция идёт раньше новых воркеров
+        if version < SCHEMA_VERSION:
+            return "schema_outdated"
+    return None
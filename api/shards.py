@@ -0,0 +1,283 @@
+"""Шардирование пользовательских таблиц по tg_id между несколькими Postgres.
+
+Пользователь попадает в бакет tg_id % SHARD_BUCKETS, бакет — на шард по карте
+shard_buckets в домашней БД (шард 0). Все таблицы пользователя (PER_USER_TABLES)
+живут на его шарде. Контент историй импортируется на все шарды с одинаковыми id,
+поэтому кэш историй и story_id одинаково верны на любом шарде.
+
+Воркеры перечитывают карту раз в SHARD_MAP_REFRESH_SECONDS. Перенос бакета
+(tools/shard_rebalance.py) помечает его moving: пока идёт копирование, запросы его
+пользователей получают 503 с Retry-After, а не пишут в старый шард. Карта старше
+SHARD_MAP_MAX_AGE_SECONDS (не удалось перечитать) — 503 shard_map_stale: по ней запрос мог бы
+писать в бакет, который уже переносится. Пауза переноса (--settle) поэтому не меньше
+SHARD_MAP_MAX_AGE_SECONDS + REQUEST_DEADLINE_SECONDS.
+
+Без DATABASE_SHARD_URLS шард один, и route() ничего не делает.
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import delete, func, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import db
+from .models import (
+    AgeConsent,
+    Choice,
+    ChoiceI18n,
+    GemUnlock,
+    Progress,
+    ProgressMeta,
+    Scene,
+    SceneI18n,
+    ShardBucket,
+    Story,
+    User,
+    UserItem,
+    Wallet,
+)
+
+
+SHARD_BUCKETS = int(os.getenv("SHARD_BUCKETS", "256"))
+SHARD_MAP_REFRESH = float(os.getenv("SHARD_MAP_REFRESH_SECONDS", "2"))
+SHARD_MAP_MAX_AGE = float(os.getenv("SHARD_MAP_MAX_AGE_SECONDS", str(SHARD_MAP_REFRESH * 2 + 1)))
+MOVING_RETRY_AFTER = os.getenv("SHARD_MOVING_RETRY_AFTER", "1")
+
+# Дочерние таблицы пользователя (users — отдельно). affiliates/referrals/ref_payouts
+# ссылаются на двух пользователей сразу и пока не шардируются.
+PER_USER_TABLES = (Wallet, Progress, ProgressMeta, GemUnlock, UserItem, AgeConsent)
+STATIC_TABLES = (Story, Scene, SceneI18n, Choice, ChoiceI18n)
+
+logger = logging.getLogger("uvicorn.error")
+
+# bucket -> (shard, state); None — карта ещё не загружена
+_map: Optional[dict[int, tuple[int, str]]] = None
+_loaded_at = 0.0  # time.monotonic() последней успешной load_map
+
+
+def enabled() -> bool:
+    return len(db.shard_engines) > 1
+
+
+def bucket_of(tg_id: int) -> int:
+    return tg_id % SHARD_BUCKETS
+
+
+def default_map(shards: int) -> dict[int, int]:
+    return {b: b % shards for b in range(SHARD_BUCKETS)}
+
+
+def moving_buckets() -> int:
+    return sum(1 for _, state in (_map or {}).values() if state == "moving")
+
+
+async def ensure_map() -> None:
+    """Записать начальную карту, если её нет (db_migrate). Существующую не трогает:
+    новый шард получает бакеты только через tools/shard_rebalance.py."""
+    async with db.engine.begin() as conn:
+        have = (await conn.execute(select(func.count()).select_from(ShardBucket))).scalar_one()
+        if have:
+            return
+        await conn.execute(
+            ShardBucket.__table__.insert(),
+            [{"bucket": b, "shard": s, "state": "active"} for b, s in default_map(len(db.shard_engines)).items()],
+        )
+
+
+async def load_map() -> None:
+    global _map, _loaded_at
+    started = time.monotonic()
+    async with db.engine.connect() as conn:
+        rows = (await conn.execute(select(ShardBucket.bucket, ShardBucket.shard, ShardBucket.state))).all()
+    if not rows:
+        raise RuntimeError("shard_buckets is empty: run tools/db_migrate.py")
+    if any(shard >= len(db.shard_engines) for _, shard, _ in rows):
+        raise RuntimeError("shard_buckets refers to a shard missing from DATABASE_SHARD_URLS")
+    _map = {bucket: (shard, state) for bucket, shard, state in rows}
+    _loaded_at = started  # возраст — от начала чтения: строки могли измениться сразу после него
+
+
+def shard_of(tg_id: int) -> int:
+    """Шард пользователя по загруженной карте (load_map) — для tools/, которые пишут
+    пользователей напрямую, минуя route(). Бакет в переносе — ошибка: запись потерялась бы."""
+    if not enabled():
+        return 0
+    if _map is None:
+        raise RuntimeError("shard map is not loaded: call load_map() first")
+    shard, state = _map[bucket_of(tg_id)]
+    if state == "moving":
+        raise RuntimeError(f"bucket {bucket_of(tg_id)} is being moved: retry after tools/shard_rebalance.py finishes")
+    return shard
+
+
+def buckets_on(shard: int) -> list[int]:
+    """Бакеты шарда по загруженной карте (load_map)."""
+    if _map is None:
+        raise RuntimeError("shard map is not loaded: call load_map() first")
+    return sorted(b for b, (s, _) in _map.items() if s == shard)
+
+
+async def refresh_loop() -> None:
+    while True:
+        await asyncio.sleep(SHARD_MAP_REFRESH)
+        try:
+            await load_map()
+        except Exception:
+            logger.exception("shard map refresh failed, keeping the previous map")
+
+
+async def route(session: AsyncSession, tg_id: int) -> None:
+    """Привязать сессию запроса к шарду пользователя. Вызывать до первого запроса сессии."""
+    if not enabled():
+        return
+    if _map is None:
+        # обычно карту грузит прогрев; без lifespan (ASGITransport в tools/) — первый запрос
+        try:
+            await load_map()
+        except Exception:
+            logger.exception("shard map load failed")
+            raise HTTPException(status_code=503, detail="shard_map_not_loaded", headers={"Retry-After": MOVING_RETRY_AFTER})
+    elif time.monotonic() - _loaded_at > SHARD_MAP_MAX_AGE:
+        # refresh_loop не смог перечитать карту (или его нет — tools/): бакет мог уйти в moving
+        try:
+            await load_map()
+        except Exception:
+            logger.exception("shard map is stale and reload failed")
+            raise HTTPException(status_code=503, detail="shard_map_stale", headers={"Retry-After": MOVING_RETRY_AFTER})
+    shard, state = _map[bucket_of(tg_id)]
+    if state == "moving":
+        raise HTTPException(status_code=503, detail="user_moving", headers={"Retry-After": MOVING_RETRY_AFTER})
+    if session.in_transaction():
+        raise RuntimeError("shards.route() must be called before the session runs any statement")
+    session.sync_session.bind = db.shard_engines[shard].sync_engine
+
+
+# -------------------------------
+# Контент на всех шардах
+# -------------------------------
+
+
+async def replicate_story(code: str) -> None:
+    """Скопировать историю из шарда 0 на остальные с теми же id (после tools/story_import.py).
+
+    Как и импорт, история сохраняет id, а сцены и выборы заменяются; прогресс на исчезнувших
+    сценах переводится на старт.
+    """
+    if not enabled():
+        return
+    async with db.engine.connect() as conn:
+        story = (await conn.execute(select(Story.__table__).where(Story.code == code))).mappings().one()
+        scenes = (await conn.execute(select(Scene.__table__).where(Scene.story_id == story["id"]))).mappings().all()
+        scene_ids = [s["id"] for s in scenes]
+        scene_texts = (await conn.execute(select(SceneI18n.__table__).where(SceneI18n.scene_id.in_(scene_ids)))).mappings().all()
+        choices = (await conn.execute(select(Choice.__table__).where(Choice.scene_id.in_(scene_ids)))).mappings().all()
+        labels = (
+            await conn.execute(select(ChoiceI18n.__table__).where(ChoiceI18n.choice_id.in_([c["id"] for c in choices])))
+        ).mappings().all()
+    rows = {Story: [story], Scene: scenes, SceneI18n: scene_texts, Choice: choices, ChoiceI18n: labels}
+
+    for shard_engine in db.shard_engines[1:]:
+        async with shard_engine.begin() as conn:
+            current = (await conn.execute(select(Story.id).where(Story.code == code))).scalar_one_or_none()
+            if current is not None and current != story["id"]:
+                # копия с другим id (до стабильных id импорта) удаляется целиком, каскадом
+                await conn.execute(delete(Story).where(Story.id == current))
+                current = None
+            old_scenes = select(Scene.id).where(Scene.story_id == story["id"])
+            old_choices = select(Choice.id).where(Choice.scene_id.in_(old_scenes))
+            await conn.execute(delete(ChoiceI18n).where(ChoiceI18n.choice_id.in_(old_choices)))
+            await conn.execute(delete(Choice).where(Choice.scene_id.in_(old_scenes)))
+            await conn.execute(delete(SceneI18n).where(SceneI18n.scene_id.in_(old_scenes)))
+            await conn.execute(delete(Scene).where(Scene.story_id == story["id"]))
+            if current is None:
+                await conn.execute(Story.__table__.insert(), [dict(story)])
+            else:
+                await conn.execute(update(Story).where(Story.id == current).values(start_scene=story["start_scene"]))
+            for model in STATIC_TABLES[1:]:
+                if rows[model]:
+                    await conn.execute(model.__table__.insert(), [dict(r) for r in rows[model]])
+            await conn.execute(reset_stale_progress(story["id"], story["start_scene"]))
+            if shard_engine.dialect.name == "postgresql":
+                # id пришли извне — сдвигаем последовательности, чтобы локальные вставки не пересеклись
+                for model in STATIC_TABLES:
+                    table = model.__tablename__
+                    await conn.execute(
+                        text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT max(id) FROM {table}), 1))")
+                    )
+
+
+def reset_stale_progress(story_id: int, start_scene: str):
+    """UPDATE: прогресс истории на сцене, которой больше нет, — на стартовую сцену."""
+    progress = Progress.__table__
+    codes = select(Scene.code).where(Scene.story_id == story_id)
+    return (
+        update(progress)
+        .where(progress.c.story_id == story_id, progress.c.current_scene.not_in(codes))
+        .values(current_scene=start_scene)
+    )
+
+
+# -------------------------------
+# Перенос бакета между шардами
+# -------------------------------
+
+
+async def copy_bucket(bucket: int, source: int, target: int) -> int:
+    """Скопировать пользователей бакета с source на target (id пользователей на target — новые).
+
+    Повторный запуск идемпотентен: всё, что уже лежит на target для этого бакета, заменяется.
+    """
+    src, dst = db.shard_engines[source], db.shard_engines[target]
+    in_bucket = (User.tg_id % SHARD_BUCKETS) == bucket
+    async with src.connect() as conn:
+        users = (await conn.execute(select(User.__table__).where(in_bucket))).mappings().all()
+        user_ids = [u["id"] for u in users]
+        children = {}
+        for model in PER_USER_TABLES:
+            children[model] = (await conn.execute(select(model.__table__).where(model.user_id.in_(user_ids)))).mappings().all()
+        src_story_codes = dict((await conn.execute(select(Story.id, Story.code))).all())
+
+    async with dst.begin() as conn:
+        stale = select(User.id).where(in_bucket)
+        for model in PER_USER_TABLES:
+            await conn.execute(delete(model).where(model.user_id.in_(stale)))
+        await conn.execute(delete(User).where(in_bucket))
+        if not users:
+            return 0
+        dst_story_ids = {code: story_id for story_id, code in (await conn.execute(select(Story.id, Story.code))).all()}
+        new_ids: dict[int, int] = {}
+        for user in users:
+            values = {k: v for k, v in user.items() if k != "id"}
+            new_ids[user["id"]] = (await conn.execute(User.__table__.insert().values(**values).returning(User.id))).scalar_one()
+        for model, items in children.items():
+            batch = []
+            for row in items:
+                values = dict(row)
+                values.pop("id", None)  # суррогатные ключи target выдаёт сам
+                values["user_id"] = new_ids[values["user_id"]]
+                if "story_id" in values:
+                    values["story_id"] = dst_story_ids[src_story_codes[values["story_id"]]]
+                batch.append(values)
+            if batch:
+                await conn.execute(model.__table__.insert(), batch)
+    return len(users)
+
+
+async def delete_bucket(bucket: int, shard: int) -> None:
+    in_bucket = (User.tg_id % SHARD_BUCKETS) == bucket
+    async with db.shard_engines[shard].begin() as conn:
+        ids = select(User.id).where(in_bucket)
+        for model in PER_USER_TABLES:
+            await conn.execute(delete(model).where(model.user_id.in_(ids)))
+        await conn.execute(delete(User).where(in_bucket))
+
+
+async def set_bucket(bucket: int, shard: int, state: str) -> None:
+    async with db.engine.begin() as conn:
+        await conn.execute(
+            ShardBucket.__table__.update().where(ShardBucket.bucket == bucket).values(shard=shard, state=state)
+        )
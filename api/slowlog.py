@@ -0,0 +1,203 @@
+"""Лог медленных SQL с сэмплированным EXPLAIN и скользящим топом для админки.
+
+SLOW_QUERY_MS — порог (мс, 0 — выключено), SLOW_QUERY_EXPLAIN_SAMPLE — доля медленных
+запросов, для которых снимается план (только SELECT на Postgres, без ANALYZE, в фоне).
+Запросы пакета api/pipeline.py получают время всего пакета: ответы приходят вместе.
+"""
+from typing import Any, Optional
+import os
+import time
+import random
+import asyncio
+import logging
+
+from sqlalchemy import event
+
+from . import db, pipeline
+from .metrics import current_request
+
+
+logger = logging.getLogger("uvicorn.error")
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "250"))
+EXPLAIN_SAMPLE = float(os.getenv("SLOW_QUERY_EXPLAIN_SAMPLE", "0.1"))
+EXPLAIN_MIN_INTERVAL = 60.0  # не чаще раза в минуту на один запрос
+WINDOW_SECONDS = int(os.getenv("SLOW_QUERY_WINDOW_SECONDS", "3600"))
+MAX_FINGERPRINTS = 500
+
+
+class SlowStat:
+    __slots__ = ("sql", "count", "total_ms", "max_ms", "route", "param_shape", "plan", "plan_at", "last_seen")
+
+    def __init__(self, sql: str) -> None:
+        self.sql = sql
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.route = ""
+        self.param_shape: Any = None
+        self.plan: Optional[str] = None
+        self.plan_at = 0.0
+        self.last_seen = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "sql": self.sql,
+            "count": self.count,
+            "total_ms": round(self.total_ms, 1),
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 1),
+            "route": self.route,
+            "param_shape": self.param_shape,
+            "plan": self.plan,
+            "last_seen": int(self.last_seen),
+        }
+
+
+# Два окна: текущее и предыдущее — топ считается по обоим, старое отбрасывается при ротации
+_current: dict[str, SlowStat] = {}
+_previous: dict[str, SlowStat] = {}
+_window_started = time.monotonic()
+# (url БД, fingerprint) -> (когда снят, план): у шардов и реплик свои данные и статистика
+_plan_cache: dict[tuple[str, str], tuple[float, str]] = {}
+_explain_in_flight = False
+_tasks: set[asyncio.Task] = set()
+
+
+def param_shape(params: Any) -> Any:
+    """Форма параметров без значений: {'name': 'int'} / ['str', ...]."""
+    if isinstance(params, dict):
+        return {k: type(v).__name__ for k, v in params.items()}
+    if isinstance(params, (list, tuple)):
+        if params and isinstance(params[0], (dict, list, tuple)):
+            return [f"{len(params)} rows", param_shape(params[0])]
+        return [type(v).__name__ for v in params]
+    return None
+
+
+def _fingerprint(statement: str) -> str:
+    return " ".join(statement.split())
+
+
+def _rotate(now: float) -> None:
+    global _current, _previous, _window_started
+    if now - _window_started >= WINDOW_SECONDS:
+        _previous, _current = _current, {}
+        _window_started = now
+
+
+def top(n: int = 20) -> list[dict]:
+    merged: dict[str, dict] = {}
+    for store in (_previous, _current):
+        for fp, stat in store.items():
+            item = stat.as_dict()
+            prev = merged.get(fp)
+            if prev:
+                item["count"] += prev["count"]
+                item["total_ms"] = round(item["total_ms"] + prev["total_ms"], 1)
+                item["max_ms"] = max(item["max_ms"], prev["max_ms"])
+                item["avg_ms"] = round(item["total_ms"] / item["count"], 1)
+                item["plan"] = item["plan"] or prev["plan"]
+            merged[fp] = item
+    return sorted(merged.values(), key=lambda it: it["total_ms"], reverse=True)[:n]
+
+
+def _async_engine(sync_engine):
+    """AsyncEngine из api.db, которому принадлежит sync_engine соединения (None — чужой)."""
+    for engine in (*db.shard_engines, *db.replica_engines):
+        if engine.sync_engine is sync_engine:
+            return engine
+    return None
+
+
+async def _capture_plan(engine, fingerprint: str, statement: str, params: Any) -> None:
+    global _explain_in_flight
+    try:
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(slowlog_skip=True)
+            rows = (await conn.exec_driver_sql("EXPLAIN " + statement, params or None)).all()
+            await conn.rollback()
+        plan = "\n".join(r[0] for r in rows)
+        _plan_cache[(str(engine.url), fingerprint)] = (time.monotonic(), plan)
+        stat = _current.get(fingerprint) or _previous.get(fingerprint)
+        if stat is not None:
+            stat.plan = plan
+    except Exception as exc:
+        logger.warning("slow query explain failed: %s", exc)
+    finally:
+        _explain_in_flight = False
+
+
+def _maybe_explain(conn, fingerprint: str, statement: str, params: Any, stat: SlowStat) -> None:
+    global _explain_in_flight
+    if _explain_in_flight or conn.dialect.name != "postgresql":
+        return
+    if not statement.lstrip().upper().startswith("SELECT") or random.random() >= EXPLAIN_SAMPLE:
+        return
+    # план — на той же БД, где запрос был медленным
+    engine = _async_engine(conn.engine)
+    if engine is None:
+        return
+    cached = _plan_cache.get((str(engine.url), fingerprint))
+    now = time.monotonic()
+    if cached and now - cached[0] < EXPLAIN_MIN_INTERVAL:
+        stat.plan = cached[1]
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    # план снимаем на отдельном соединении уже после ответа: запрос пользователя не ждёт
+    _explain_in_flight = True
+    task = loop.create_task(_capture_plan(engine, fingerprint, statement, params))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["slowlog_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("slowlog_start", None)
+    if started is not None:
+        _record(conn, statement, parameters, (time.perf_counter() - started) * 1000)
+
+
+def _on_batch(conn, statements: list[tuple[str, Any]], seconds: float) -> None:
+    for statement, parameters in statements:
+        _record(conn, statement, parameters, seconds * 1000)
+
+
+def _record(conn, statement: str, parameters: Any, elapsed_ms: float) -> None:
+    if elapsed_ms < SLOW_QUERY_MS or conn.get_execution_options().get("slowlog_skip"):
+        return
+    now = time.monotonic()
+    _rotate(now)
+    fingerprint = _fingerprint(statement)
+    stat = _current.get(fingerprint)
+    if stat is None:
+        if len(_current) >= MAX_FINGERPRINTS:
+            return
+        stat = _current[fingerprint] = SlowStat(fingerprint)
+    request = current_request.get()
+    stat.count += 1
+    stat.total_ms += elapsed_ms
+    stat.max_ms = max(stat.max_ms, elapsed_ms)
+    stat.route = request.route if request is not None else "background"
+    stat.param_shape = param_shape(parameters)
+    stat.last_seen = time.time()
+    logger.warning(
+        "slow query %.1fms route=%s params=%s sql=%s",
+        elapsed_ms, stat.route, stat.param_shape, fingerprint[:500],
+    )
+    _maybe_explain(conn, fingerprint, statement, parameters, stat)
+
+
+def install(engine=db.engine) -> None:
+    if SLOW_QUERY_MS <= 0:
+        return
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    if _on_batch not in pipeline.batch_listeners:  # общий список для всех движков
+        pipeline.batch_listeners.append(_on_batch)
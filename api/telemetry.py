@@ -0,0 +1,111 @@
+"""Клиентская телеметрия: агрегация таймингов в памяти и периодический сброс роллапов в БД."""
+from typing import Optional, List
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from pydantic import BaseModel
+
+from .db import AsyncSessionLocal
+from .metrics import Histogram
+from .models import TelemetryRollup
+
+
+logger = logging.getLogger("uvicorn.error")
+
+# Границы бакетов (мс); последний бакет — всё, что больше
+BUCKETS_MS: tuple[int, ...] = (50, 100, 200, 300, 500, 750, 1000, 1500, 2500, 4000, 8000)
+METRICS = frozenset({"first_scene", "choose", "choose_rtt", "image_load"})
+NET_TYPES = frozenset({"slow-2g", "2g", "3g", "4g", "wifi", "ethernet", "cellular", "unknown"})
+MAX_EVENTS_PER_BATCH = 200
+MAX_SERIES = 20000  # защита памяти от кардинальности (story, scene, net)
+MAX_VALUE_MS = 120_000
+FLUSH_SECONDS = int(os.getenv("TELEMETRY_FLUSH_SECONDS", "60"))
+
+
+class TelemetryEventIn(BaseModel):
+    m: str
+    ms: float
+    story: str = ""
+    scene: str = ""
+    net: str = "unknown"
+
+
+class TelemetryIn(BaseModel):
+    events: List[TelemetryEventIn] = []
+
+
+SeriesKey = tuple[str, str, str, str]  # (metric, story, scene, net)
+
+
+class TelemetryAggregator:
+    """Гистограммы по (metric, story, scene, net) между сбросами в БД."""
+
+    def __init__(self) -> None:
+        self._series: dict[SeriesKey, Histogram] = {}
+        self._period_start = datetime.now(tz=timezone.utc)
+        self.dropped = 0
+
+    def record(self, event: TelemetryEventIn) -> None:
+        if event.m not in METRICS:
+            self.dropped += 1
+            return
+        net = event.net if event.net in NET_TYPES else "unknown"
+        key = (event.m, event.story[:100], event.scene[:100], net)
+        hist = self._series.get(key)
+        if hist is None:
+            if len(self._series) >= MAX_SERIES:
+                self.dropped += 1
+                return
+            hist = self._series[key] = Histogram(BUCKETS_MS)
+        hist.observe(min(max(0.0, event.ms), MAX_VALUE_MS))
+
+    def drain(self) -> tuple[datetime, dict[SeriesKey, Histogram]]:
+        series, period_start = self._series, self._period_start
+        self._series = {}
+        self._period_start = datetime.now(tz=timezone.utc)
+        return period_start, series
+
+
+aggregator = TelemetryAggregator()
+
+
+def ingest(batch: TelemetryIn) -> int:
+    events = batch.events[:MAX_EVENTS_PER_BATCH]
+    for event in events:
+        aggregator.record(event)
+    return len(events)
+
+
+async def flush_rollups() -> int:
+    """Записать накопленные гистограммы одной транзакцией (строка на серию, а не на событие)."""
+    period_start, series = aggregator.drain()
+    if not series:
+        return 0
+    async with AsyncSessionLocal() as session:
+        session.add_all(
+            TelemetryRollup(
+                period_start=period_start.isoformat(timespec="seconds"),
+                metric=metric,
+                story_code=story,
+                scene_code=scene,
+                net=net,
+                count=hist.count,
+                sum_ms=int(hist.sum),
+                buckets=json.dumps(hist.counts),
+            )
+            for (metric, story, scene, net), hist in series.items()
+        )
+        await session.commit()
+    return len(series)
+
+
+async def flush_loop(interval: Optional[int] = None) -> None:
+    while True:
+        await asyncio.sleep(interval or FLUSH_SECONDS)
+        try:
+            await flush_rollups()
+        except Exception:
+            logger.exception("telemetry flush failed")
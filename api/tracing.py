@@ -0,0 +1,337 @@
+"""Трассировка в модели OpenTelemetry: спаны запросов, хелперов и SQL.
+
+TRACE_SAMPLE_RATIO — доля трассируемых запросов; входящий traceparent с флагом sampled
+трассируется всегда (TRACE_ENABLED=1 включает только такой режим при нулевой доле).
+Экспорт — батчами из фонового потока в формате OTLP/JSON:
+TRACE_EXPORT=file пишет строки в TRACE_FILE (подходит для otlpjsonfile-ресивера коллектора),
+TRACE_EXPORT=otlp шлёт POST на OTEL_EXPORTER_OTLP_ENDPOINT/v1/traces.
+
+Несэмплированный запрос не создаёт ни одного объекта спана: хелперы и SQL-хуки видят
+пустой contextvar и сразу выходят.
+"""
+from typing import Any, Optional
+import os
+import json
+import time
+import queue
+import random
+import logging
+import tempfile
+import threading
+import functools
+import inspect
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+import httpx
+from sqlalchemy import event
+
+from . import db, pipeline
+
+
+logger = logging.getLogger("uvicorn.error")
+
+SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "0"))
+ENABLED = SAMPLE_RATIO > 0 or os.getenv("TRACE_ENABLED") == "1"
+EXPORT = os.getenv("TRACE_EXPORT", "file")
+TRACE_FILE = Path(os.getenv("TRACE_FILE") or Path(tempfile.gettempdir()) / "romance-traces.jsonl")
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://127.0.0.1:4318").rstrip("/")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "romance-api")
+MAX_QUEUE = 10_000
+BATCH_SIZE = 512
+FLUSH_SECONDS = 1.0
+
+# Виды спанов OTLP
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = 1, 2, 3
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], kind: int = KIND_INTERNAL) -> None:
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes: dict[str, Any] = {}
+        self.error: Optional[str] = None
+
+    def end(self) -> None:
+        self.end_ns = time.time_ns()
+        _exporter.submit(self)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_attr(k, v) for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 0},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _attr(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class _Exporter:
+    """Очередь готовых спанов + фоновый поток, который батчами пишет их в файл или OTLP."""
+
+    def __init__(self) -> None:
+        self._queue: queue.Queue[Optional[Span]] = queue.Queue(maxsize=MAX_QUEUE)
+        self._thread: Optional[threading.Thread] = None
+        self.dropped = 0
+
+    def submit(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        client = httpx.Client(timeout=5.0) if EXPORT == "otlp" else None
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            batch = [first] if first is not None else []
+            stopping = first is None
+            deadline = time.monotonic() + FLUSH_SECONDS
+            while not stopping and len(batch) < BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+            if not batch:
+                continue
+            try:
+                self._export(batch, client)
+            except Exception as exc:
+                logger.warning("trace export failed (%s spans): %s", len(batch), exc)
+        if client is not None:
+            client.close()
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Дописать накопленный батч и остановить поток (при остановке приложения)."""
+        thread, self._thread = self._thread, None
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(None)  # сигнал остановки; ждём, даже если очередь полна
+        thread.join(timeout)
+
+    def _export(self, batch: list[Span], client: Optional[httpx.Client]) -> None:
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_attr("service.name", SERVICE_NAME)]},
+                "scopeSpans": [{"scope": {"name": "api.tracing"}, "spans": [s.to_otlp() for s in batch]}],
+            }]
+        }
+        if client is not None:
+            client.post(f"{OTLP_ENDPOINT}/v1/traces", json=payload).raise_for_status()
+        else:
+            with TRACE_FILE.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+
+
+_exporter = _Exporter()
+
+
+def shutdown() -> None:
+    _exporter.close()
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, kind: int = KIND_INTERNAL, **attributes):
+    """Дочерний спан текущего (no-op, если запрос не сэмплирован)."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent.span_id, kind)
+    child.attributes.update(attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.error = type(exc).__name__
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def traced(name: Optional[str] = None):
+    """Декоратор: оборачивает sync/async функцию в спан с её именем."""
+
+    def decorator(fn):
+        span_name = name or fn.__name__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if _current.get() is None:
+                    return await fn(*args, **kwargs)
+                with span(span_name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return fn(*args, **kwargs)
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def _parse_traceparent(value: bytes) -> Optional[tuple[str, str, bool]]:
+    # W3C: 00-<trace_id 32hex>-<parent_id 16hex>-<flags 2hex>
+    try:
+        version, trace_id, parent_id, flags = value.decode("latin-1").split("-")
+        int(trace_id, 16), int(parent_id, 16)
+        sampled = bool(int(flags, 16) & 1)
+    except ValueError:
+        return None
+    if len(trace_id) != 32 or len(parent_id) != 16:
+        return None
+    return trace_id, parent_id, sampled
+
+
+class TracingMiddleware:
+    """Корневой серверный спан запроса; имя — шаблон роута, известный после маршрутизации."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        incoming = None
+        for key, value in scope.get("headers") or ():
+            if key == b"traceparent":
+                incoming = _parse_traceparent(value)
+                break
+        if incoming is not None:
+            trace_id, parent_id, sampled = incoming
+        else:
+            trace_id, parent_id, sampled = os.urandom(16).hex(), None, False
+        if not sampled and not (SAMPLE_RATIO > 0 and random.random() < SAMPLE_RATIO):
+            return await self.app(scope, receive, send)
+
+        root = Span(scope.get("method", "HTTP"), trace_id, parent_id, KIND_SERVER)
+        root.attributes["http.method"] = scope.get("method", "")
+        root.attributes["url.path"] = scope.get("path", "")
+        token = _current.set(root)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                root.attributes["http.status_code"] = message["status"]
+                message["headers"] = list(message.get("headers") or []) + [
+                    (b"traceparent", f"00-{trace_id}-{root.span_id}-01".encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as exc:
+            root.error = type(exc).__name__
+            raise
+        finally:
+            _current.reset(token)
+            route = getattr(scope.get("route"), "path", None)
+            if route:
+                root.name = f"{root.name} {route}"
+                root.attributes["http.route"] = route
+            root.end()
+
+
+def _sql_span(conn, statement: str, parent: Span) -> Span:
+    sql_span = Span(statement.split(None, 1)[0].upper() if statement else "SQL", parent.trace_id, parent.span_id, KIND_CLIENT)
+    sql_span.attributes["db.system"] = conn.dialect.name
+    sql_span.attributes["db.statement"] = " ".join(statement.split())[:1000]
+    return sql_span
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    parent = _current.get()
+    if parent is not None:
+        conn.info["trace_span"] = _sql_span(conn, statement, parent)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    sql_span = conn.info.pop("trace_span", None)
+    if sql_span is not None:
+        sql_span.end()
+
+
+def _on_batch(conn, statements: list[tuple[str, Any]], seconds: float) -> None:
+    # пакет api/pipeline.py: запросы ушли вместе, у каждого спана — начало и конец пакета
+    parent = _current.get()
+    if parent is None:
+        return
+    start_ns = time.time_ns() - int(seconds * 1e9)
+    for statement, _ in statements:
+        sql_span = _sql_span(conn, statement, parent)
+        sql_span.start_ns = start_ns
+        sql_span.attributes["db.batch_size"] = len(statements)
+        sql_span.end()
+
+
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    sql_span = conn.info.pop("trace_span", None) if conn is not None else None
+    if sql_span is not None:
+        sql_span.error = type(exception_context.original_exception).__name__
+        sql_span.end()
+
+
+def install(app, engine=db.engine) -> None:
+    if not ENABLED:
+        return
+    app.add_middleware(TracingMiddleware)
+    instrument_engine(engine)
+
+
+def instrument_engine(engine) -> None:
+    """SQL-спаны для дополнительного движка (шарды, реплики)."""
+    if not ENABLED:
+        return
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine.sync_engine, "handle_error", _handle_error)
+    if _on_batch not in pipeline.batch_listeners:  # общий список для всех движков
+        pipeline.batch_listeners.append(_on_batch)
@@ -0,0 +1,190 @@
+"""Запросы одного пользователя выполняются по очереди.
+
+Двойной тап по выбору или /api/state во время /api/choose — две транзакции за одни и те же
+строки wallet и progress: ожидание блокировок строк, повторы, при разном порядке — deadlock.
+Вместо этого:
+
+- в воркере — asyncio.Lock на tg_id (FIFO). Берётся в _get_or_create_user и держится до
+  конца запроса (UserLockMiddleware), так что запросы пользователя идут строго по очереди;
+- между воркерами — pg_advisory_xact_lock(tg_id) в начале каждой транзакции сессии запроса
+  (только Postgres). Блокировка транзакционная: снимается на COMMIT/ROLLBACK и безопасна
+  за PgBouncer; её ожидание ограничено statement_timeout (api/admission.py);
+- одинаковые GET /api/state (пользователь, история, язык), пришедшие, пока такой же ждёт
+  очереди или выполняется, получают его результат. Мутирующий запрос закрывает окно:
+  чтение, пришедшее после него, встаёт за ним в очередь.
+
+Ключ — tg_id, а не users.id: он известен до первого запроса к БД и по нему же выбирается
+шард. USER_LOCK=0 выключает всё, USER_LOCK_ADVISORY=0 — только блокировку в Postgres
+(например, если балансировщик и так закрепляет пользователя за воркером).
+"""
+import os
+import time
+import asyncio
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+
+USER_LOCK = os.getenv("USER_LOCK", "1") == "1"
+USER_LOCK_ADVISORY = os.getenv("USER_LOCK_ADVISORY", "1") == "1"
+
+# Подписчики на ожидание очереди пользователя, секунды (см. api/metrics.py)
+wait_listeners: list[Callable[[float], None]] = []
+
+_SESSION_KEY = "user_lock_tg_id"
+_ADVISORY_LOCK = text("SELECT pg_advisory_xact_lock(:key)")
+
+T = TypeVar("T")
+
+
+class _User:
+    __slots__ = ("lock", "refs", "reads")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.refs = 0  # запросы, которые держат или ждут lock либо ждут общее чтение
+        self.reads: dict[tuple, asyncio.Future] = {}
+
+
+class _Held:
+    """Очереди, занятые текущим запросом (живут в contextvar на время запроса)."""
+
+    __slots__ = ("write", "users")
+
+    def __init__(self, write: bool) -> None:
+        self.write = write
+        self.users: list[tuple[int, _User]] = []
+
+
+_users: dict[int, _User] = {}
+_held: ContextVar[Optional[_Held]] = ContextVar("user_lock_held", default=None)
+_stats = {"waiting": 0, "coalesced": 0}
+
+
+def _ref(tg_id: int) -> _User:
+    user = _users.get(tg_id)
+    if user is None:
+        user = _users[tg_id] = _User()
+    user.refs += 1
+    return user
+
+
+def _unref(tg_id: int, user: _User) -> None:
+    user.refs -= 1
+    if not user.refs and _users.get(tg_id) is user:
+        del _users[tg_id]
+
+
+def _notify(seconds: float) -> None:
+    for listener in wait_listeners:
+        listener(seconds)
+
+
+async def hold(session: AsyncSession, tg_id: int) -> None:
+    """Встать в очередь запросов пользователя до конца HTTP-запроса.
+
+    Вызывать до первого запроса сессии: её транзакции тоже берут блокировку в Postgres.
+    """
+    if not USER_LOCK:
+        return
+    if USER_LOCK_ADVISORY:
+        session.info[_SESSION_KEY] = tg_id
+    held = _held.get()
+    if held is None or any(t == tg_id for t, _ in held.users):
+        return  # вне HTTP-запроса (tools/) или очередь уже занята этим запросом
+    user = _ref(tg_id)
+    if held.write:
+        user.reads.clear()
+    started = time.perf_counter()
+    _stats["waiting"] += 1
+    try:
+        await user.lock.acquire()
+    except BaseException:
+        _unref(tg_id, user)
+        raise
+    finally:
+        _stats["waiting"] -= 1
+    held.users.append((tg_id, user))
+    _notify(time.perf_counter() - started)
+
+
+async def coalesce(tg_id: int, key: tuple, compute: Callable[[], Awaitable[T]]) -> T:
+    """compute(), если такое же чтение пользователя не ждёт очереди и не выполняется; иначе его результат."""
+    if not USER_LOCK or _held.get() is None:
+        return await compute()
+    user = _ref(tg_id)
+    future: Optional[asyncio.Future] = None
+    try:
+        while (leader := user.reads.get(key)) is not None:
+            try:
+                ok, value = await asyncio.shield(leader)
+            except asyncio.CancelledError:
+                if not leader.cancelled():
+                    raise
+                continue  # ведущий отменён (дедлайн, отключение клиента) — считаем сами
+            _stats["coalesced"] += 1
+            if ok:
+                return value
+            raise value
+        future = asyncio.get_running_loop().create_future()
+        user.reads[key] = future
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_result((False, exc))
+            raise
+        future.set_result((True, value))
+        return value
+    finally:
+        if future is not None and user.reads.get(key) is future:
+            del user.reads[key]
+        _unref(tg_id, user)
+
+
+class UserLockMiddleware:
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not USER_LOCK:
+            return await self.app(scope, receive, send)
+        held = _Held(write=scope.get("method") not in ("GET", "HEAD"))
+        token = _held.set(held)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _held.reset(token)
+            for tg_id, user in held.users:
+                user.lock.release()
+                _unref(tg_id, user)
+
+
+def _after_begin(session, transaction, connection) -> None:
+    tg_id = session.info.get(_SESSION_KEY)
+    if tg_id is None or connection.dialect.name != "postgresql":
+        return
+    started = time.perf_counter()
+    connection.execute(_ADVISORY_LOCK, {"key": tg_id})
+    _notify(time.perf_counter() - started)
+
+
+def install(app) -> None:
+    from . import metrics
+
+    if not event.contains(Session, "after_begin", _after_begin):
+        event.listen(Session, "after_begin", _after_begin)
+    metrics.register_value(
+        "romance_user_lock_waiting", "Requests waiting for an earlier request of the same user.", lambda: _stats["waiting"]
+    )
+    metrics.register_value("romance_user_lock_users", "Users with requests queued or in flight.", lambda: len(_users))
+    metrics.register_value(
+        "romance_user_lock_coalesced_total", "GET /api/state answered with a concurrent identical request's result.",
+        lambda: _stats["coalesced"], "counter",
+    )
+    app.add_middleware(UserLockMiddleware)
@@ -1,9 +1,18 @@
-﻿import React, { useEffect, useState } from 'react'
+﻿import React, { useEffect, useRef, useState } from 'react'
 import axios from 'axios'
+import { initTelemetry, track, afterPaint } from './telemetry.js'
 
 // В проде (в туннеле/на сервере) используем текущий origin, локально — переменную окружения
 const API_BASE = import.meta.env.VITE_API_URL || window.location.origin
 
+// Выбор без платных/премиум гейтов можно отрисовать до ответа сервера
+const canRenderOptimistically = (choice, target, wallet) => {
+  if (!choice.leads_to || !target) return false // концовки считаются по heat на сервере
+  if (choice.gem_cost > 0 || choice.is_premium || choice.requires_item) return false
+  if (target.scene.is_premium) return false
+  return (wallet?.energy ?? 0) >= (target.scene.energy_cost || 0)
+}
+
 export default function App() {
   const [tgData, setTgData] = useState(null)
   const [userId, setUserId] = useState('12345') // локально шлём в X-Debug-Tg-Id
@@ -14,8 +23,16 @@ export default function App() {
   const [grantMsg, setGrantMsg] = useState('')
   const [ageAgree, setAgeAgree] = useState(false)
   const [showMenu, setShowMenu] = useState(false)
+  // Кэш контента сцен: `${story}:${lang}:${scene}` -> { scene, choices }
+  const sceneCache = useRef(new Map())
+  const bundles = useRef(new Set())
+  // Телеметрия: первый экран, tap-to-render, загрузка картинки сцены
+  const firstSceneTracked = useRef(false)
+  const pendingTap = useRef(null)
+  const sceneShownAt = useRef(0)
 
   useEffect(() => {
+    initTelemetry(API_BASE)
     // Telegram initData (когда будем открывать из бота)
     if (window.Telegram?.WebApp) {
       try {
@@ -42,17 +59,90 @@ export default function App() {
     }
   }
 
-  const choose = async (choiceCode) => {
+  useEffect(() => {
+    if (!state) return
+    const labels = { story: storyCode, scene: state.scene.code }
+    sceneShownAt.current = performance.now()
+    if (!firstSceneTracked.current) {
+      firstSceneTracked.current = true
+      afterPaint(() => track('first_scene', performance.now(), labels)) // от начала навигации
+    }
+    const tap = pendingTap.current
+    if (tap) {
+      pendingTap.current = null
+      afterPaint(() => track('choose', performance.now() - tap, labels))
+    }
+  }, [state])
+
+  const cacheKey = (sceneCode) => `${storyCode}:${lang}:${sceneCode}`
+
+  const storeScenes = (scenes) => {
+    for (const item of scenes || []) sceneCache.current.set(cacheKey(item.scene.code), item)
+  }
+
+  // Бандл истории целиком (service worker отдаёт его из кэша при повторных открытиях)
+  useEffect(() => {
+    if (!state) return
+    const key = `${storyCode}:${lang}`
+    if (bundles.current.has(key)) return
+    bundles.current.add(key)
+    axios.get(`${API_BASE}/api/content/bundle?story=${storyCode}&lang=${lang}`, { headers })
+      .then(({ data }) => storeScenes(data.scenes))
+      .catch(() => bundles.current.delete(key))
+  }, [state, lang])
+
+  // Предзагрузка контента всех leads_to текущей сцены
+  useEffect(() => {
+    if (!state) return
+    sceneCache.current.set(cacheKey(state.scene.code), { scene: state.scene, choices: state.choices })
+    const missing = [...new Set(state.choices.map(ch => ch.leads_to).filter(Boolean))]
+      .filter(code => !sceneCache.current.has(cacheKey(code)))
+    if (!missing.length) return
+    const url = `${API_BASE}/api/content/scenes?story=${storyCode}&lang=${lang}&codes=${missing.join(',')}`
+    axios.get(url, { headers }).then(({ data }) => {
+      // premium-сцены сервер не отдаёт — помечаем, чтобы не запрашивать повторно
+      for (const code of missing) sceneCache.current.set(cacheKey(code), null)
+      storeScenes(data.scenes)
+    }).catch(() => {}) // best effort
+  }, [state, lang])
+
+  // Прогрев картинок ближайших сцен (попадут в кэш браузера / service worker)
+  useEffect(() => {
+    if (!state) return
+    for (const code of new Set(state.choices.map(ch => ch.leads_to).filter(Boolean))) {
+      const item = sceneCache.current.get(cacheKey(code))
+      if (item?.scene.image_url) new Image().src = item.scene.image_url
+    }
+  }, [state, lang])
+
+  const choose = async (choice) => {
+    const prev = state
+    const tapAt = performance.now()
+    pendingTap.current = tapAt
+    const target = choice.leads_to ? sceneCache.current.get(cacheKey(choice.leads_to)) : null
+    if (canRenderOptimistically(choice, target, state?.wallet)) {
+      setState({
+        ...state,
+        scene: target.scene,
+        choices: target.choices,
+        wallet: { ...state.wallet, energy: state.wallet.energy - (target.scene.energy_cost || 0) }
+      })
+    }
     setLoading(true)
     try {
       const { data } = await axios.post(`${API_BASE}/api/choose`, {
         story_code: storyCode,
-        choice_code: choiceCode,
+        choice_code: choice.code,
         lang
       }, { headers })
-      setState(data)
+      track('choose_rtt', performance.now() - tapAt, { story: storyCode, scene: data.scene.code })
+      setState(data) // сервер — источник истины
     } catch (e) {
-      const detail = e?.response?.data?.detail
+      const raw = e?.response?.data?.detail
+      const detail = typeof raw === 'object' && raw ? raw.code : raw
+      // откат оптимистичного перехода (energy/gems/premium/item_required и прочие отказы)
+      pendingTap.current = null
+      setState(prev)
       if (detail === 'gems_required') {
         alert('Нужно больше 💎')
       } else if (detail === 'energy_required') {
@@ -119,7 +209,9 @@ export default function App() {
           </div>
 
           {state.scene.image_url ? (
-            <img src={state.scene.image_url} alt="scene" style={{ width: '100%', borderRadius: 8, marginBottom: 12 }}/>
+            <img src={state.scene.image_url} alt="scene"
+              onLoad={() => track('image_load', performance.now() - sceneShownAt.current, { story: storyCode, scene: state.scene.code })}
+              style={{ width: '100%', borderRadius: 8, marginBottom: 12 }}/>
           ) : null}
 
           <div style={{ whiteSpace: 'pre-wrap', marginBottom: 12 }}>{state.scene.text}</div>
@@ -129,7 +221,7 @@ export default function App() {
               const needsItem = !!ch.requires_item && !(state.items||[]).includes(ch.requires_item)
               return (
                 <div key={ch.code} style={{ display: 'flex', gap: 8, alignItems: 'center' }}>
-                  <button onClick={() => choose(ch.code)} disabled={loading || needsItem}
+                  <button onClick={() => choose(ch)} disabled={loading || needsItem}
                     style={{ padding: '10px 14px', borderRadius: 8, border: '1px solid #ddd', textAlign: 'left', opacity: needsItem ? .6 : 1 }}>
                     {ch.label}
                     {!!ch.gem_cost && <span> • {ch.gem_cost}💎</span>}
@@ -0,0 +1,139 @@
+// Service worker Mini App. Собирается плагином в vite.config.js:
+// __PRECACHE__ и __VERSION__ подставляются списком файлов сборки и их хэшем.
+const VERSION = __VERSION__
+const PRECACHE = __PRECACHE__
+
+const SHELL_CACHE = `shell-${VERSION}`
+const CONTENT_CACHE = 'content-v1'
+const IMAGE_CACHE = 'images-v1'
+
+// LRU-лимиты динамических кэшей: контент — в записях, картинки — в байтах
+const CONTENT_MAX_ENTRIES = 24
+const IMAGE_MAX_BYTES = 50 * 1024 * 1024
+// размер тела картинки в записи кэша (для лимита в байтах)
+const SIZE_HEADER = 'x-sw-bytes'
+
+self.addEventListener('install', (event) => {
+  event.waitUntil(
+    caches.open(SHELL_CACHE)
+      .then(cache => cache.addAll(PRECACHE))
+      .then(() => self.skipWaiting())
+  )
+})
+
+self.addEventListener('activate', (event) => {
+  const keep = [SHELL_CACHE, CONTENT_CACHE, IMAGE_CACHE]
+  event.waitUntil(
+    caches.keys()
+      .then(names => Promise.all(names.filter(n => !keep.includes(n)).map(n => caches.delete(n))))
+      .then(() => self.clients.claim())
+  )
+})
+
+// cache.keys() отдаёт записи в порядке вставки: при обновлении переставляем запись в конец,
+// при переполнении удаляем самые старые — получается LRU без отдельного индекса.
+// (SWR перезаписывает запись при каждом обращении, так что «обращение» = «обновление».)
+const touch = async (cache, request, response) => {
+  await cache.delete(request)
+  await cache.put(request, response)
+}
+
+const trim = async (cache, maxEntries) => {
+  const keys = await cache.keys()
+  for (let i = 0; i < keys.length - maxEntries; i++) {
+    await cache.delete(keys[i])
+  }
+}
+
+// Способы записи в кэш для staleWhileRevalidate
+const putPlain = (cache, key, response) => cache.put(key, response)
+
+const putWithEntryLimit = (maxEntries) => async (cache, key, response) => {
+  await touch(cache, key, response)
+  await trim(cache, maxEntries)
+}
+
+// url -> байт в порядке LRU. Живёт в памяти SW; после его перезапуска восстанавливается
+// из заголовков записей кэша.
+let imageSizes = null
+
+const loadSizes = async (cache) => {
+  const sizes = new Map()
+  for (const request of await cache.keys()) {
+    const cached = await cache.match(request)
+    sizes.set(request.url, Number(cached && cached.headers.get(SIZE_HEADER)) || 0)
+  }
+  return sizes
+}
+
+const putWithByteLimit = (maxBytes) => async (cache, key, response) => {
+  const body = await response.blob()
+  if (body.size > maxBytes) return
+  const headers = new Headers(response.headers)
+  headers.set(SIZE_HEADER, String(body.size))
+  imageSizes = imageSizes || loadSizes(cache)
+  const sizes = await imageSizes
+  await touch(cache, key, new Response(body, { status: response.status, statusText: response.statusText, headers }))
+  const url = new URL(typeof key === 'string' ? key : key.url, self.location.href).href
+  sizes.delete(url)
+  sizes.set(url, body.size)
+  let total = 0
+  for (const size of sizes.values()) total += size
+  for (const [oldUrl, size] of sizes) {
+    if (total <= maxBytes) break
+    await cache.delete(oldUrl)
+    sizes.delete(oldUrl)
+    total -= size
+  }
+}
+
+// Хэшированные ассеты неизменяемы: cache-first
+const cacheFirst = async (request) => {
+  const cache = await caches.open(SHELL_CACHE)
+  const cached = await cache.match(request)
+  if (cached) return cached
+  const response = await fetch(request)
+  if (response.ok) await cache.put(request, response.clone())
+  return response
+}
+
+// Нехэшированные ресурсы: отдаём из кэша и обновляем в фоне. Кэшируются только успешные
+// ответы: у opaque неизвестны ни статус, ни размер
+const staleWhileRevalidate = async (event, cacheName, store, key = event.request) => {
+  const { request } = event
+  const cache = await caches.open(cacheName)
+  const cached = await cache.match(key)
+  const network = fetch(request).then(async (response) => {
+    if (response.ok) await store(cache, key, response.clone())
+    return response
+  })
+  if (cached) {
+    event.waitUntil(network.catch(() => {}))
+    return cached
+  }
+  return network
+}
+
+self.addEventListener('fetch', (event) => {
+  const { request } = event
+  if (request.method !== 'GET') return
+  const url = new URL(request.url)
+  const sameOrigin = url.origin === self.location.origin
+
+  if (request.destination === 'image') {
+    event.respondWith(staleWhileRevalidate(event, IMAGE_CACHE, putWithByteLimit(IMAGE_MAX_BYTES)))
+    return
+  }
+  if (!sameOrigin) return
+
+  if (url.pathname.startsWith('/assets/')) {
+    event.respondWith(cacheFirst(request))
+  } else if (url.pathname.startsWith('/api/content/')) {
+    event.respondWith(staleWhileRevalidate(event, CONTENT_CACHE, putWithEntryLimit(CONTENT_MAX_ENTRIES)))
+  } else if (url.pathname === '/' || url.pathname === '/index.html') {
+    // оболочка: index.html не хэшируется; query от Telegram не плодит копии
+    event.respondWith(staleWhileRevalidate(event, SHELL_CACHE, putPlain, '/'))
+  }
+  // остальное (/api/*, /docs, /metrics, прочие переходы) — только сеть:
+  // состояние пользователя не кэшируем, чужая страница не должна заменить оболочку
+})
@@ -0,0 +1,36 @@
+// Клиентские тайминги: копим в памяти и отправляем батчем через sendBeacon
+// (при уходе в фон / закрытии Mini App). Агрегация — на сервере, /api/telemetry.
+const MAX_QUEUE = 50
+
+let endpoint = null
+let queue = []
+
+const netType = () => navigator.connection?.effectiveType || navigator.connection?.type || 'unknown'
+
+export const flush = () => {
+  if (!endpoint || !queue.length) return
+  const body = JSON.stringify({ events: queue })
+  queue = []
+  const blob = new Blob([body], { type: 'application/json' })
+  if (navigator.sendBeacon?.(endpoint, blob)) return
+  fetch(endpoint, { method: 'POST', body, keepalive: true, headers: { 'Content-Type': 'application/json' } })
+    .catch(() => {})
+}
+
+export const track = (metric, ms, { story = '', scene = '' } = {}) => {
+  if (!endpoint || !Number.isFinite(ms)) return
+  queue.push({ m: metric, ms: Math.round(ms), story, scene, net: netType() })
+  if (queue.length >= MAX_QUEUE) flush()
+}
+
+export const initTelemetry = (apiBase) => {
+  if (endpoint) return
+  endpoint = `${apiBase}/api/telemetry`
+  document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden') flush()
+  })
+  window.addEventListener('pagehide', flush)
+}
+
+// Время до отрисовки: ждём следующий кадр после коммита React
+export const afterPaint = (fn) => requestAnimationFrame(() => setTimeout(fn, 0))
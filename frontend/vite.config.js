@@ -1,6 +1,25 @@
 ﻿import { defineConfig } from 'vite'
+import { createHash } from 'node:crypto'
+import { readFileSync } from 'node:fs'
+import { fileURLToPath } from 'node:url'
+
+// Собирает src/sw.js в dist/sw.js со списком файлов сборки для precache
+const serviceWorker = () => ({
+  name: 'romance-service-worker',
+  apply: 'build',
+  generateBundle(_, bundle) {
+    const files = Object.keys(bundle).filter(f => !f.endsWith('.map'))
+    const precache = ['/', ...files.filter(f => f !== 'index.html').map(f => `/${f}`)]
+    const version = createHash('sha256').update(files.sort().join('\n')).digest('hex').slice(0, 12)
+    const source = readFileSync(fileURLToPath(new URL('./src/sw.js', import.meta.url)), 'utf-8')
+      .replace('__VERSION__', JSON.stringify(version))
+      .replace('__PRECACHE__', JSON.stringify(precache))
+    this.emitFile({ type: 'asset', fileName: 'sw.js', source })
+  }
+})
 
 export default defineConfig({
+  plugins: [serviceWorker()],
   server: {
     port: 5173,
     host: true
@@ -0,0 +1,16 @@
+"""Тесты гоняют API в процессе на отдельной БД: TEST_DATABASE_URL или временный SQLite.
+
+БД разработки из .env не трогаем: переменная задаётся до первого импорта api.db.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+os.environ["DATABASE_URL"] = os.getenv("TEST_DATABASE_URL") or (
+    f"sqlite+aiosqlite:///{Path(tempfile.mkdtemp(prefix='romance-tests-')) / 'romance.db'}"
+)
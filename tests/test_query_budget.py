@@ -0,0 +1,44 @@
+"""Бюджет SQL-запросов горячих эндпоинтов (tools/query_budget.py, tests/query_budgets.json).
+
+Лишний запрос или round-trip, например N+1 по подписям, — провал с местами вызова в api/.
+На Postgres (TEST_DATABASE_URL) в счёт входят pg_advisory_xact_lock и SET LOCAL.
+"""
+import asyncio
+
+import pytest
+
+from tools import query_budget, story_import
+from api import db
+
+STORY = "office_flirt"
+TG_ID = 900000001
+
+
+async def _measure() -> dict[str, query_budget.QueryLog]:
+    try:
+        await story_import.import_story(str(query_budget.ROOT / "content" / "stories" / STORY / "story.yaml"))
+        return dict(await query_budget.measure(STORY, TG_ID))
+    finally:
+        for engine in (*db.shard_engines, *db.replica_engines):
+            await engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def measured() -> dict[str, query_budget.QueryLog]:
+    return asyncio.run(_measure())
+
+
+@pytest.fixture(scope="module")
+def budgets() -> dict[str, tuple[int, int]]:
+    dialect = db.engine.dialect.name
+    budgets = query_budget.load_budgets(dialect)
+    if budgets is None:
+        pytest.fail(f"no {dialect} budgets in tests/query_budgets.json: record them with python tools/query_budget.py --update")
+    return budgets
+
+
+@pytest.mark.parametrize("endpoint", query_budget.ENDPOINTS)
+def test_query_budget(measured, budgets, endpoint):
+    assert endpoint in measured, f"{endpoint} was not measured"
+    problems = query_budget.check_budget(endpoint, measured[endpoint], budgets)
+    assert not problems, "\n".join(problems)
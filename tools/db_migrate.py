@@ -0,0 +1,37 @@
+"""Применить схему БД (таблицы, индексы) и отметить версию в schema_version.
+
+API при старте только сверяет версию (DB_SCHEMA=verify), поэтому запускать перед
+выкаткой новой версии — один раз, до рестарта воркеров:
+
+    python tools/db_migrate.py
+"""
+import asyncio
+import os
+import platform
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+os.environ.setdefault("DB_STATEMENT_TIMEOUT_MS", "0")  # DDL и перенос данных идут дольше запросов API
+
+from api import schema
+from api.db import engine
+
+if platform.system() == "Windows":
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+
+async def main() -> None:
+    version = await schema.migrate()
+    await engine.dispose()
+    print(f"schema version {version}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
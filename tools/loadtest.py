@@ -0,0 +1,260 @@
+"""Нагрузочный прогон: тысячи виртуальных пользователей Telegram проходят истории.
+
+Каждый пользователь получает initData, подписанный тестовым BOT_TOKEN (тот же токен
+должен быть у API), открывает /api/state, подтверждает возраст и идёт по бесплатным
+выборам через /api/choose с паузами «на чтение». Часть пользователей покупает предметы
+из магазина истории и перезапускает историю, дойдя до конца.
+
+В конце — пропускная способность, p50/p95/p99 по эндпоинтам, разбивка ошибок и число
+SQL на запрос (разница /metrics до и после прогона; нужен METRICS_TOKEN, если задан).
+
+    BOT_TOKEN=123:test python tools/loadtest.py --users 2000 --duration 120
+    python tools/loadtest.py --in-process --users 50 --duration 10   # без сервера, для проверки
+
+API должен смотреть в локальный Postgres с импортированными историями.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from urllib.parse import urlencode
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+LOAD_TG_BASE = 20_000_000_000  # виртуальные tg_id не пересекаются с реальными и с plan_check
+LANGS = ("ru", "en", "es", "de", "fr")
+
+
+def sign_init_data(bot_token: str, tg_id: int, lang: str) -> str:
+    """initData в формате Telegram WebApp, подписанный как это делает клиент Telegram."""
+    user = json.dumps({"id": tg_id, "first_name": f"load{tg_id % 100000}", "language_code": lang}, separators=(",", ":"))
+    pairs = {"auth_date": str(int(time.time())), "query_id": f"load{tg_id}", "user": user}
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(pairs.items()))
+    secret_key = hashlib.sha256(("WebAppData" + bot_token).encode()).digest()
+    pairs["hash"] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(pairs)
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latency: dict[str, list[float]] = defaultdict(list)
+        self.errors: Counter[tuple[str, str]] = Counter()
+        self.failures = 0  # 5xx и сетевые ошибки; 4xx (нет энергии/камней) — ожидаемое поведение
+        self.users_done = 0
+        self.endings = 0
+
+    def record(self, endpoint: str, elapsed: float, resp: "httpx.Response | None", error: str = "") -> None:
+        self.latency[endpoint].append(elapsed)
+        if resp is None or resp.status_code >= 500:
+            self.failures += 1
+        if resp is None:
+            self.errors[(endpoint, error)] += 1
+        elif resp.status_code >= 400:
+            try:
+                detail = resp.json().get("detail")
+            except ValueError:
+                detail = None
+            if isinstance(detail, dict):
+                detail = detail.get("code")
+            self.errors[(endpoint, f"{resp.status_code} {detail or ''}".strip())] += 1
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, stats: Stats, args, tg_id: int, rng: random.Random) -> None:
+        self.client = client
+        self.stats = stats
+        self.args = args
+        self.rng = rng
+        self.lang = rng.choice(LANGS)
+        self.story = rng.choice(args.stories)
+        self.buyer = rng.random() < args.buy_ratio
+        self.restarter = rng.random() < args.restart_ratio
+        self.headers = {"X-Telegram-Init-Data": sign_init_data(args.bot_token, tg_id, self.lang)}
+
+    async def call(self, method: str, path: str, endpoint: str, **kwargs) -> "httpx.Response | None":
+        start = time.perf_counter()
+        try:
+            resp = await self.client.request(method, path, headers=self.headers, **kwargs)
+        except httpx.HTTPError as exc:
+            self.stats.record(endpoint, time.perf_counter() - start, None, type(exc).__name__)
+            return None
+        self.stats.record(endpoint, time.perf_counter() - start, resp)
+        return resp
+
+    async def think(self) -> None:
+        # время чтения сцены: логнормальное, медиана ≈ think-median
+        await asyncio.sleep(min(self.args.think_median * self.rng.lognormvariate(0, 0.6), self.args.think_median * 6))
+
+    async def run(self, deadline: float) -> None:
+        resp = await self.call("GET", f"/api/state?story={self.story}&lang={self.lang}", "GET /api/state")
+        if resp is None or resp.status_code != 200:
+            return
+        state = resp.json()
+        await self.call("POST", "/api/age/confirm", "POST /api/age/confirm", json={"agree": True})
+        while time.monotonic() < deadline:
+            await self.think()
+            if self.buyer and state.get("shop") and self.rng.random() < 0.15:
+                offer = [it for it in state["shop"] if not it["owned"]]
+                if offer:
+                    item = self.rng.choice(offer)
+                    resp = await self.call(
+                        "POST", "/api/item/buy", "POST /api/item/buy",
+                        json={"story_code": self.story, "item_code": item["code"], "price_gems": item["price_gems"], "lang": self.lang},
+                    )
+                    if resp is not None and resp.status_code == 200:
+                        state = resp.json()
+                    continue
+            items = set(state.get("items") or [])
+            free = [
+                ch for ch in state.get("choices", [])
+                if not (ch["gem_cost"] or ch["is_premium"]) and (not ch["requires_item"] or ch["requires_item"] in items)
+            ]
+            if not free:
+                self.stats.endings += 1
+                if not self.restarter:
+                    break
+                resp = await self.call("POST", "/api/restart", "POST /api/restart", json={"story_code": self.story, "lang": self.lang})
+            else:
+                choice = self.rng.choice(free)
+                resp = await self.call(
+                    "POST", "/api/choose", "POST /api/choose",
+                    json={"story_code": self.story, "choice_code": choice["code"], "lang": self.lang},
+                )
+            if resp is None:
+                continue
+            if resp.status_code == 200:
+                state = resp.json()
+            elif resp.status_code == 400:
+                # нет энергии/камней — перечитываем состояние, как это сделал бы клиент
+                resp = await self.call("GET", f"/api/state?story={self.story}&lang={self.lang}", "GET /api/state")
+                if resp is not None and resp.status_code == 200:
+                    state = resp.json()
+        self.stats.users_done += 1
+
+
+def parse_statement_metrics(text: str) -> dict[str, tuple[float, float]]:
+    """route -> (sum, count) из romance_db_statements_per_request."""
+    out: dict[str, list[float]] = defaultdict(lambda: [0.0, 0.0])
+    for line in text.splitlines():
+        if not line.startswith("romance_db_statements_per_request_"):
+            continue
+        name, _, value = line.rpartition(" ")
+        kind = name.split("{", 1)[0].rsplit("_", 1)[-1]
+        if kind not in ("sum", "count"):
+            continue
+        route = name.split('route="', 1)[1].split('"', 1)[0]
+        out[route][0 if kind == "sum" else 1] = float(value)
+    return {route: (v[0], v[1]) for route, v in out.items()}
+
+
+async def scrape_statements(client: httpx.AsyncClient, token: str) -> dict[str, tuple[float, float]]:
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    try:
+        resp = await client.get("/metrics", headers=headers)
+    except httpx.HTTPError:
+        return {}
+    return parse_statement_metrics(resp.text) if resp.status_code == 200 else {}
+
+
+def report(stats: Stats, elapsed: float, before: dict, after: dict) -> None:
+    total = sum(len(v) for v in stats.latency.values())
+    errors = sum(stats.errors.values())
+    print(f"\n{total} requests in {elapsed:.1f}s = {total / elapsed:.1f} req/s; "
+          f"{errors} errors ({stats.failures} 5xx/transport); users finished {stats.users_done}, endings reached {stats.endings}")
+    print(f"\n{'endpoint':<24}{'count':>8}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'sql/req':>9}")
+    for endpoint, values in sorted(stats.latency.items()):
+        values.sort()
+        route = endpoint.split(" ", 1)[1]
+        sql = ""
+        if route in after:
+            s = after[route][0] - before.get(route, (0, 0))[0]
+            c = after[route][1] - before.get(route, (0, 0))[1]
+            sql = f"{s / c:.1f}" if c else ""
+        print(
+            f"{endpoint:<24}{len(values):>8}{len(values) / elapsed:>8.1f}"
+            f"{percentile(values, 0.50) * 1000:>9.1f}{percentile(values, 0.95) * 1000:>9.1f}"
+            f"{percentile(values, 0.99) * 1000:>9.1f}{values[-1] * 1000:>9.1f}{sql:>9}"
+        )
+    if stats.errors:
+        print("\nerrors:")
+        for (endpoint, kind), count in stats.errors.most_common():
+            print(f"  {count:>7}  {endpoint:<24} {kind}")
+
+
+async def run(args) -> int:
+    if not args.bot_token:
+        print("BOT_TOKEN (or --bot-token) is required: virtual users sign initData with it")
+        return 2
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    if args.in_process:
+        os.environ["BOT_TOKEN"] = args.bot_token
+        from api.main import app
+        transport = httpx.ASGITransport(app=app)
+        client = httpx.AsyncClient(transport=transport, base_url="http://load", timeout=args.timeout)
+    else:
+        client = httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout)
+
+    stats = Stats()
+    rng = random.Random(args.seed)
+    async with client:
+        before = await scrape_statements(client, args.metrics_token)
+        start = time.monotonic()
+        deadline = start + args.duration
+        tasks = []
+        for i in range(args.users):
+            user = VirtualUser(client, stats, args, LOAD_TG_BASE + args.tg_offset + i, random.Random(rng.random()))
+            tasks.append(asyncio.create_task(user.run(deadline)))
+            if args.ramp:
+                await asyncio.sleep(args.ramp / args.users)  # равномерный разгон
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - start
+        after = await scrape_statements(client, args.metrics_token)
+    report(stats, elapsed, before, after)
+    return 1 if stats.failures > args.max_error_ratio * sum(len(v) for v in stats.latency.values()) else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8080")
+    parser.add_argument("--in-process", action="store_true", help="гонять api.main:app через ASGITransport")
+    parser.add_argument("--bot-token", default=os.getenv("BOT_TOKEN", ""))
+    parser.add_argument("--metrics-token", default=os.getenv("METRICS_TOKEN", ""))
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=60.0, help="секунд после старта первого пользователя")
+    parser.add_argument("--ramp", type=float, default=10.0, help="за сколько секунд запустить всех")
+    parser.add_argument("--think-median", type=float, default=3.0, help="медиана паузы между действиями, с")
+    parser.add_argument("--stories", type=lambda s: s.split(","), default=["office_flirt", "campus_arc1_v7"])
+    parser.add_argument("--buy-ratio", type=float, default=0.2, help="доля пользователей, которые покупают")
+    parser.add_argument("--restart-ratio", type=float, default=0.3, help="доля, перезапускающая историю в конце")
+    parser.add_argument("--connections", type=int, default=200, help="HTTP-соединений к API")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--tg-offset", type=int, default=0, help="сдвиг tg_id (свежие пользователи)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-error-ratio", type=float, default=0.01, help="доля 5xx/сетевых ошибок, выше которой код выхода 1")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
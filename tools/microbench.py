@@ -0,0 +1,179 @@
+"""Микробенчмарки CPU-кусков, которые выполняются на каждый запрос или импорт.
+
+Для каждого кейса подбирается число повторов (~0.2 с на замер), берётся минимум из
+--repeat замеров — это стоимость одного вызова без шума планировщика. Результаты
+сравниваются с tools/microbench_baseline.json (пишется с --update-baseline); рост
+больше --tolerance — код выхода 1. Базовая линия лежит в репозитории; времена зависят от
+машины, поэтому на другой машине сначала перезапишите её с --update-baseline на старом коде.
+
+    python tools/microbench.py [--filter state] [--repeat 7] [--update-baseline]
+
+БД не нужна: хелперы вызываются на объектах в памяти.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from pathlib import Path
+from typing import Callable
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+os.environ.setdefault("BOT_TOKEN", "123456:microbench")
+
+from api import main as api_main
+from api.main import ChoiceOut, SceneOut, ShopItemOut, StateOut, WalletOut
+from api.models import Wallet
+from tools import story_import
+from tools.loadtest import sign_init_data
+
+
+BASELINE_PATH = Path(__file__).with_name("microbench_baseline.json")
+STORIES_DIR = ROOT / "content" / "stories"
+
+
+def _choices(n: int) -> list[ChoiceOut]:
+    return [
+        ChoiceOut(
+            code=f"choice_{i}",
+            label="Подойти ближе и сказать что-нибудь смешное" if i % 2 else "Промолчать",
+            leads_to=f"scene_{i:03d}",
+            gem_cost=5 if i % 4 == 3 else 0,
+            heat_points=i % 3,
+            requires_item="whip" if i % 5 == 4 else None,
+            is_premium=i % 6 == 5,
+        )
+        for i in range(n)
+    ]
+
+
+def _state(n: int) -> StateOut:
+    return StateOut(
+        scene=SceneOut(
+            code="scene_001",
+            image_url="/content/stories/office_flirt/scene_001.webp",
+            is_premium=False,
+            energy_cost=1,
+            text="Университетский спорткомплекс. " * 12,
+        ),
+        choices=_choices(n),
+        wallet=WalletOut(energy=5, gems=40, is_premium=False),
+        age_confirmed=True,
+        items=["tshirt_your"],
+        next_energy_in=1200,
+        shop=[ShopItemOut(code=c, price_gems=p, owned=c == "tshirt_your") for c, p in api_main.ITEM_CATALOG["office_flirt"].items()],
+    )
+
+
+def _fastapi_serialize(state: StateOut) -> bytes:
+    # то же, что делает FastAPI для response_model: dump в json-режиме + JSONResponse.render
+    return json.dumps(
+        state.model_dump(mode="json"), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def build_cases() -> dict[str, Callable[[], object]]:
+    cases: dict[str, Callable[[], object]] = {}
+
+    init_data = sign_init_data(os.environ["BOT_TOKEN"], 123456789, "ru")
+    cases["verify_init_data"] = lambda: api_main._verify_telegram_init_data(init_data)
+    bad = init_data.replace("hash=", "hash=0")
+    cases["verify_init_data_bad_hash"] = lambda: api_main._verify_telegram_init_data(bad)
+
+    now = int(time.time())
+    wallet = Wallet(user_id=1, energy=3, gems=0, last_energy_at=str(now - 3 * 3600))
+
+    def regen():
+        wallet.energy = 3
+        wallet.last_energy_at = str(now - 3 * 3600)
+        return api_main._regenerate_energy(wallet, now)
+
+    cases["regenerate_energy"] = regen
+
+    for n in (2, 4, 8):
+        cases[f"choice_out_x{n}"] = lambda n=n: _choices(n)
+        cases[f"state_out_build_x{n}"] = lambda n=n: _state(n)
+        state = _state(n)
+        cases[f"state_out_json_x{n}"] = lambda state=state: _fastapi_serialize(state)
+        cases[f"state_out_dump_json_x{n}"] = lambda state=state: state.model_dump_json()
+
+    for heat in (0, 2, 5):
+        cases[f"route_ending_heat{heat}"] = lambda heat=heat: api_main._route_ending(heat)
+
+    for story_dir in sorted(STORIES_DIR.iterdir()):
+        path = story_dir / "story.yaml"
+        if path.exists():
+            cases[f"yaml_load_{story_dir.name}"] = lambda path=str(path): story_import.load_story(path)
+    return cases
+
+
+def measure(fn: Callable[[], object], repeat: int, target: float = 0.2) -> float:
+    """Секунд на вызов: минимум из repeat замеров по number вызовов."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= target / 10 or number >= 10_000_000:
+            break
+        number *= 10
+    number = max(1, int(number * target / max(elapsed, 1e-9)))
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def _fmt(seconds: float) -> str:
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} ms"
+    if seconds >= 1e-6:
+        return f"{seconds * 1e6:.2f} us"
+    return f"{seconds * 1e9:.0f} ns"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="", help="подстрока имени кейса")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимый рост времени на вызов")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results: dict[str, float] = {}
+    for name, fn in build_cases().items():
+        if args.filter and args.filter not in name:
+            continue
+        fn()  # прогрев: ленивые импорты, кэши pydantic
+        results[name] = measure(fn, args.repeat)
+
+    if args.update_baseline:
+        baseline = json.loads(BASELINE_PATH.read_text(encoding="utf-8")) if BASELINE_PATH.exists() else {}
+        baseline.update({name: {"seconds": value, "python": platform.python_version()} for name, value in results.items()})
+        BASELINE_PATH.write_text(json.dumps(baseline, indent=2, sort_keys=True), encoding="utf-8")
+        print(f"baseline written: {BASELINE_PATH} ({len(results)} cases)")
+    baseline = json.loads(BASELINE_PATH.read_text(encoding="utf-8")) if BASELINE_PATH.exists() else {}
+
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name, {}).get("seconds")
+        delta = f"{(value / base - 1) * 100:+6.1f}%" if base else "     new"
+        print(f"{name:<32}{_fmt(value):>12}  {delta}")
+        if base and value > base * (1 + args.tolerance):
+            regressions.append(f"{name}: {_fmt(value)} > baseline {_fmt(base)} (+{args.tolerance:.0%})")
+    if regressions:
+        print("\nRegressions:")
+        print("\n".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""Проверка планов запросов горячего пути на объёмных данных (только Postgres).
+
+1) досеивает в локальную БД синтетических пользователей с прогрессом/инвентарём
+   (при шардировании — каждого на свой шард по карте shard_buckets);
+2) проигрывает сценарий (state → age → несколько choose → item/buy → restart),
+   записывая все SQL, которые выполняет API;
+3) для каждого уникального запроса делает EXPLAIN (ANALYZE, BUFFERS) в откатываемой
+   транзакции и сообщает о Seq Scan по большим таблицам и росте стоимости
+   относительно tools/plan_baseline.json (на шарде игрока сценария).
+
+Базовая линия планов хранится в tools/plan_baseline.json рядом со скриптом. Стоимости
+зависят от версии Postgres и объёма данных, поэтому файл пишется с --update-baseline на
+эталонной БД (тот же --users) и коммитится вместе с изменением схемы или запросов. Пока
+его нет, проверяются только Seq Scan по большим таблицам.
+
+    python tools/plan_check.py [--users 200000] [--skip-seed] [--update-baseline]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+os.environ.setdefault("ENABLE_DEV_ENDPOINTS", "1")
+# в сценарии — только запросы обработчиков, без SET LOCAL statement_timeout (api/admission.py)
+os.environ.setdefault("REQUEST_DEADLINE_SECONDS", "0")
+
+import httpx
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+load_dotenv()
+
+from api import schema, shards
+from api.db import engine, shard_engines
+from api.main import app
+from tools.query_budget import record_queries, RecordedStatement
+
+
+BASELINE_PATH = Path(__file__).with_name("plan_baseline.json")
+SEED_TG_BASE = 10_000_000_000  # синтетические tg_id не пересекаются с реальными
+PLAY_TG_ID = 900000002
+
+
+async def ensure_indexes() -> None:
+    # таблицы + индексы, которых create_all не добавляет в существующие таблицы
+    await schema.migrate()
+
+
+async def seed(users: int) -> None:
+    have = 0
+    for shard_engine in shard_engines:
+        async with shard_engine.connect() as conn:
+            have += (
+                await conn.execute(text("SELECT count(*) FROM users WHERE tg_id > :base"), {"base": SEED_TG_BASE})
+            ).scalar_one()
+    if have >= users:
+        print(f"seed: {have} synthetic users already present")
+        return
+    print(f"seed: inserting {users - have} users ...")
+    for shard, shard_engine in enumerate(shard_engines):
+        await _seed_shard(shard, shard_engine, {"base": SEED_TG_BASE, "start": have + 1, "stop": users})
+    for shard_engine in shard_engines:
+        async with shard_engine.connect() as conn:
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text("ANALYZE"))
+
+
+async def _seed_shard(shard: int, shard_engine, params: dict) -> None:
+    mine = ""
+    if shards.enabled():
+        # только пользователи, чьи бакеты живут на этом шарде
+        mine = " WHERE (:base + g) % :buckets_total = ANY(:buckets)"
+        params = {**params, "buckets_total": shards.SHARD_BUCKETS, "buckets": shards.buckets_on(shard)}
+    async with shard_engine.begin() as conn:
+        await conn.execute(text(
+            "INSERT INTO users (tg_id, lang, is_premium) "
+            "SELECT :base + g, (ARRAY['ru','en','es','de','fr'])[1 + g % 5], g % 20 = 0 "
+            f"FROM generate_series(:start, :stop) g{mine}"
+        ), params)
+        synthetic = "u.tg_id > :base + :start - 1"
+        await conn.execute(text(
+            "INSERT INTO wallet (user_id, energy, gems) "
+            f"SELECT u.id, u.id % 8, (u.id * 7) % 120 FROM users u WHERE {synthetic}"
+        ), params)
+        await conn.execute(text(
+            "INSERT INTO progress (user_id, story_id, current_scene) "
+            f"SELECT u.id, s.id, s.start_scene FROM users u CROSS JOIN stories s WHERE {synthetic}"
+        ), params)
+        await conn.execute(text(
+            "INSERT INTO progress_meta (user_id, story_id, heat_score) "
+            f"SELECT u.id, s.id, u.id % 4 FROM users u CROSS JOIN stories s WHERE {synthetic}"
+        ), params)
+        await conn.execute(text(
+            "INSERT INTO age_consent (user_id, confirmed_at) "
+            f"SELECT u.id, 'now' FROM users u WHERE {synthetic} AND u.id % 5 <> 0"
+        ), params)
+        await conn.execute(text(
+            "INSERT INTO user_items (user_id, story_id, item_code) "
+            f"SELECT u.id, s.id, 'tshirt_your' FROM users u CROSS JOIN stories s WHERE {synthetic} AND u.id % 3 = 0"
+        ), params)
+        await conn.execute(text(
+            "INSERT INTO gem_unlocks (user_id, story_id, scene_code) "
+            f"SELECT u.id, s.id, 'scene_004' FROM users u CROSS JOIN stories s WHERE {synthetic} AND u.id % 4 = 0"
+        ), params)
+
+
+async def play(story: str, steps: int, target) -> list[RecordedStatement]:
+    headers = {"X-Debug-Tg-Id": str(PLAY_TG_ID)}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://plan") as client:
+        await client.post("/api/dev/grant", json={"energy": 50, "gems": 100}, headers=headers)
+        with record_queries(target) as log:
+            state = (await client.get(f"/api/state?story={story}", headers=headers)).json()
+            await client.post("/api/age/confirm", json={"agree": True}, headers=headers)
+            for _ in range(steps):
+                free = [
+                    ch for ch in state.get("choices", [])
+                    if not (ch["gem_cost"] or ch["is_premium"] or ch["requires_item"])
+                ]
+                if not free:
+                    break
+                resp = await client.post(
+                    "/api/choose", json={"story_code": story, "choice_code": free[0]["code"]}, headers=headers
+                )
+                if resp.status_code != 200:
+                    break
+                state = resp.json()
+            await client.post(
+                "/api/item/buy", json={"story_code": story, "item_code": "plan_probe", "price_gems": 0}, headers=headers
+            )
+            await client.post("/api/restart", json={"story_code": story}, headers=headers)
+    unique: dict[str, RecordedStatement] = {}
+    for st in log.statements:
+        if isinstance(st.params, (list, tuple)) and st.params and isinstance(st.params[0], dict):
+            continue  # executemany — EXPLAIN не применим
+        unique.setdefault(st.sql, st)
+    return list(unique.values())
+
+
+def _walk(node: dict):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _walk(child)
+
+
+def statement_key(st: RecordedStatement) -> str:
+    return hashlib.sha1(st.sql.encode()).hexdigest()[:12]
+
+
+async def explain_all(statements: list[RecordedStatement], large_rows: int, target) -> dict[str, dict]:
+    results: dict[str, dict] = {}
+    async with target.connect() as conn:
+        sizes = dict(
+            (
+                await conn.execute(text(
+                    "SELECT relname, reltuples::bigint FROM pg_class "
+                    "WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace"
+                ))
+            ).all()
+        )
+        trans = await conn.begin()
+        try:
+            for st in statements:
+                key = statement_key(st)
+                entry = {"site": st.site, "sql": " ".join(st.sql.split())}
+                try:
+                    async with conn.begin_nested():
+                        plan = (
+                            await conn.exec_driver_sql(
+                                "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + st.sql, st.params or None
+                            )
+                        ).scalar_one()
+                except Exception as exc:
+                    entry["error"] = str(exc).splitlines()[0]
+                    results[key] = entry
+                    continue
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                root = plan[0]["Plan"]
+                entry["total_cost"] = root["Total Cost"]
+                entry["actual_ms"] = plan[0].get("Execution Time")
+                entry["seq_scans"] = sorted({
+                    node["Relation Name"]
+                    for node in _walk(root)
+                    if node.get("Node Type") == "Seq Scan" and sizes.get(node.get("Relation Name"), 0) >= large_rows
+                })
+                results[key] = entry
+        finally:
+            await trans.rollback()  # ANALYZE выполняет DML — ничего не сохраняем
+    return results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    problems = []
+    for key, entry in sorted(results.items(), key=lambda kv: kv[1]["site"]):
+        where = f"[{key}] {entry['site']}"
+        if "error" in entry:
+            print(f"skip  {where}: {entry['error']}")
+            continue
+        print(f"{entry['total_cost']:>10.2f}  {entry.get('actual_ms') or 0:>7.3f}ms  {where}")
+        for table in entry["seq_scans"]:
+            problems.append(f"{where}: Seq Scan on large table {table}\n    {entry['sql']}")
+        base = baseline.get(key)
+        if base and "total_cost" in base:
+            limit = base["total_cost"] * (1 + tolerance) + 1.0
+            if entry["total_cost"] > limit:
+                problems.append(
+                    f"{where}: cost {entry['total_cost']:.2f} > baseline {base['total_cost']:.2f} (+{tolerance:.0%})"
+                )
+    return problems
+
+
+async def run(args) -> int:
+    if engine.dialect.name != "postgresql":
+        print("plan_check needs PostgreSQL (EXPLAIN ANALYZE / pg_class)")
+        return 2
+    await ensure_indexes()
+    if shards.enabled():
+        await shards.load_map()
+    if not args.skip_seed:
+        await seed(args.users)
+    target = shard_engines[shards.shard_of(PLAY_TG_ID)]  # запросы игрока идут на его шард
+    statements = await play(args.story, args.steps, target)
+    results = await explain_all(statements, args.large_rows, target)
+
+    if args.update_baseline:
+        BASELINE_PATH.write_text(json.dumps(results, ensure_ascii=False, indent=2, sort_keys=True), encoding="utf-8")
+        print(f"baseline written: {BASELINE_PATH} ({len(results)} statements)")
+        return 0
+    baseline = json.loads(BASELINE_PATH.read_text(encoding="utf-8")) if BASELINE_PATH.exists() else {}
+    if not baseline:
+        print("no baseline yet: run with --update-baseline to record one")
+    problems = compare(results, baseline, args.tolerance)
+    if problems:
+        print("\nPlan regressions:")
+        print("\n".join(problems))
+        return 1
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--story", default="office_flirt")
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--steps", type=int, default=8, help="сколько choose в сценарии")
+    parser.add_argument("--large-rows", type=int, default=10_000, help="таблица считается большой от N строк")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="допустимый рост стоимости плана")
+    parser.add_argument("--skip-seed", action="store_true")
+    parser.add_argument("--update-baseline", action="store_true")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
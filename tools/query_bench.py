@@ -0,0 +1,160 @@
+"""CPU горячих чтений: ORM-сущности против готовых Core-запросов api/queries.py.
+
+micro — для каждого чтения N раз выполняет два варианта, каждый раз в новой сессии, как в
+запросе API. orm — прежний вид: select(Model) собирается на каждый вызов, результат
+загружается в identity map. core — константа из api/queries.py, выполняется через
+соединение сессии и возвращает Row. Печатается время и CPU процесса на вызов.
+
+load — --requests пар GET /api/state + POST /api/choose подряд через ASGI-приложение в
+процессе. Печатается CPU процесса на запрос. Сравнивать два коммита: запустить на каждом.
+
+    python tools/query_bench.py micro --iterations 2000
+    python tools/query_bench.py load --requests 500
+
+Работает на DATABASE_URL (SQLite или Postgres) с импортированными историями; пишет
+пользователей с tg_id от BENCH_TG_BASE.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+os.environ.setdefault("ENABLE_DEV_ENDPOINTS", "1")
+
+import httpx
+from dotenv import load_dotenv
+from sqlalchemy import select
+
+load_dotenv()
+
+import api.main as api_main
+from api import queries
+from api.db import AsyncSessionLocal, engine
+from api.models import Choice, Scene, Story, UserItem
+
+
+BENCH_TG_BASE = 70_000_000_000
+STORY = "office_flirt"
+
+
+async def timed(fn: Callable[[], Awaitable[object]], iterations: int) -> tuple[float, float]:
+    """(секунд, CPU-секунд) на вызов; каждый вызов — в своей сессии."""
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(iterations):
+        await fn()
+    return (time.perf_counter() - wall) / iterations, (time.process_time() - cpu) / iterations
+
+
+async def run_micro(args) -> int:
+    async with AsyncSessionLocal() as session:
+        user, _ = await api_main._get_or_create_user(session, BENCH_TG_BASE, "ru")
+        story = await api_main._get_story(session, STORY)
+        scene = await api_main._get_scene_by_code(session, story.id, story.start_scene)
+        choice = (await queries.all_rows(session, queries.STATE_CHOICES, {"story_id": story.id, "scene_code": scene.code}))[0]
+    user_id = user.id
+
+    def orm(build):
+        async def call():
+            async with AsyncSessionLocal() as session:
+                return (await session.execute(build())).scalars().all()
+        return call
+
+    def core(statement, params):
+        async def call():
+            async with AsyncSessionLocal() as session:
+                return await queries.all_rows(session, statement, params)
+        return call
+
+    cases = {
+        "story_by_code": (
+            orm(lambda: select(Story).where(Story.code == STORY)),
+            core(queries.STORY_BY_CODE, {"code": STORY}),
+        ),
+        "scene_by_code": (
+            orm(lambda: select(Scene).where(Scene.story_id == story.id, Scene.code == scene.code)),
+            core(queries.SCENE_BY_CODE, {"story_id": story.id, "scene_code": scene.code}),
+        ),
+        "choice_by_code": (
+            orm(lambda: select(Choice).where(Choice.scene_id == scene.id, Choice.code == choice.code)),
+            core(queries.CHOICE_BY_CODE, {"scene_id": scene.id, "choice_code": choice.code}),
+        ),
+        "choices_of_scenes": (
+            orm(lambda: select(Choice).where(Choice.scene_id.in_([scene.id])).order_by(Choice.id)),
+            core(queries.CONTENT_CHOICES, {"scene_ids": [scene.id]}),
+        ),
+        "has_item": (
+            orm(lambda: select(UserItem).where(
+                UserItem.user_id == user_id, UserItem.story_id == story.id, UserItem.item_code == "whip"
+            )),
+            core(queries.HAS_ITEM, {"user_id": user_id, "story_id": story.id, "item_code": "whip"}),
+        ),
+        "story_scenes": (
+            orm(lambda: select(Scene).where(Scene.story_id == story.id, Scene.is_premium.is_(False)).order_by(Scene.id)),
+            core(queries.CONTENT_SCENES, {"story_id": story.id}),
+        ),
+    }
+    print(f"{args.iterations} calls per variant, {engine.dialect.name}")
+    print(f"{'case':<18}{'orm us':>10}{'core us':>10}{'orm cpu':>10}{'core cpu':>10}{'cpu saved':>11}")
+    for name, (orm_call, core_call) in cases.items():
+        if args.filter and args.filter not in name:
+            continue
+        await orm_call()
+        await core_call()  # прогрев кэша компиляции
+        orm_wall, orm_cpu = await timed(orm_call, args.iterations)
+        core_wall, core_cpu = await timed(core_call, args.iterations)
+        saved = (1 - core_cpu / orm_cpu) * 100 if orm_cpu else 0.0
+        print(
+            f"{name:<18}{orm_wall * 1e6:>10.1f}{core_wall * 1e6:>10.1f}"
+            f"{orm_cpu * 1e6:>10.1f}{core_cpu * 1e6:>10.1f}{saved:>10.1f}%"
+        )
+    return 0
+
+
+async def run_load(args) -> int:
+    transport = httpx.ASGITransport(app=api_main.app)
+    headers = {"X-Debug-Tg-Id": str(BENCH_TG_BASE + 1)}
+    counts = {"GET /api/state": 0, "POST /api/choose": 0}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.post("/api/dev/grant", json={"energy": 10 * args.requests, "gems": 10 * args.requests}, headers=headers)
+        await client.get(f"/api/state?story={STORY}", headers=headers)  # прогрев
+        wall, cpu = time.perf_counter(), time.process_time()
+        for _ in range(args.requests):
+            state = (await client.get(f"/api/state?story={STORY}", headers=headers)).json()
+            counts["GET /api/state"] += 1
+            free = [c["code"] for c in state["choices"] if not (c["is_premium"] or c["requires_item"])]
+            if free:
+                await client.post("/api/choose", json={"story_code": STORY, "choice_code": free[0]}, headers=headers)
+                counts["POST /api/choose"] += 1
+            else:
+                await client.post("/api/restart", json={"story_code": STORY}, headers=headers)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    total = sum(counts.values())
+    print(f"{total} requests ({counts}), {engine.dialect.name}")
+    print(f"wall {wall / total * 1000:.2f} ms/request, CPU {cpu / total * 1000:.2f} ms/request")
+    return 0
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    micro = sub.add_parser("micro", help="ORM против Core по каждому чтению")
+    micro.add_argument("--iterations", type=int, default=2000)
+    micro.add_argument("--filter", default="", help="подстрока имени кейса")
+    load = sub.add_parser("load", help="CPU на запрос API")
+    load.add_argument("--requests", type=int, default=500, help="пар state+choose")
+    args = parser.parse_args()
+    try:
+        return await (run_micro if args.cmd == "micro" else run_load)(args)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
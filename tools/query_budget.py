@@ -0,0 +1,217 @@
+"""Бюджет SQL-запросов на эндпоинт.
+
+Вешает before_cursor_execute на api.db.engine, прогоняет сценарий через ASGI-приложение
+в процессе и сверяет число запросов и round-trip'ов с tests/query_budgets.json — бюджетом
+для диалекта БД (sqlite, postgresql). Считается всё, что уходит в БД при настройках API из
+tools/run_prod.py, включая pg_advisory_xact_lock (api/userlock.py) и SET LOCAL
+statement_timeout (api/admission.py). При превышении печатает места вызова (файл:строка
+в api/) каждого запроса и завершает процесс с кодом 1. Тот же сценарий проверяет
+tests/test_query_budget.py.
+
+    python tools/query_budget.py [--story office_flirt] [--tg-id 900000001] [--update]
+
+--update записывает фактические значения как бюджет текущего диалекта: для postgresql —
+прогоном на Postgres. Нужна БД с импортированной историей (python tools/story_import.py).
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import traceback
+from collections import Counter
+from typing import Any, NamedTuple, Optional
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+os.environ.setdefault("ENABLE_DEV_ENDPOINTS", "1")
+# лимиты БД как у API (tools/run_prod.py): от них зависит, когда admission делает SET LOCAL
+os.environ.setdefault("DB_STATEMENT_TIMEOUT_MS", "5000")
+os.environ.setdefault("DB_POOL_TIMEOUT", "5")
+
+import httpx
+from dotenv import load_dotenv
+from greenlet import getcurrent
+from sqlalchemy import event
+
+load_dotenv()
+
+from api import pipeline
+from api.db import engine
+from api.main import app
+
+
+API_DIR = ROOT / "api"
+
+# Максимум (statements, round-trips) на один вызов в установившемся режиме по диалектам:
+# пользователь, кошелёк и прогресс уже существуют. Значения — фактические (--update):
+# любой лишний запрос, например N+1 по подписям, — провал.
+BUDGETS_PATH = ROOT / "tests" / "query_budgets.json"
+ENDPOINTS = ("GET /api/state", "POST /api/choose", "POST /api/restart", "POST /api/item/buy", "POST /api/age/confirm")
+
+
+def load_budgets(dialect: str) -> Optional[dict[str, tuple[int, int]]]:
+    """Бюджеты диалекта; None — ещё не записаны (--update на такой БД)."""
+    budgets = json.loads(BUDGETS_PATH.read_text(encoding="utf-8")).get(dialect)
+    return None if budgets is None else {endpoint: tuple(limits) for endpoint, limits in budgets.items()}
+
+
+def save_budgets(dialect: str, results: list[tuple[str, "QueryLog"]]) -> None:
+    data = json.loads(BUDGETS_PATH.read_text(encoding="utf-8")) if BUDGETS_PATH.exists() else {}
+    data[dialect] = {endpoint: [len(log.statements), log.round_trips] for endpoint, log in results}
+    BUDGETS_PATH.write_text(json.dumps(data, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+
+
+class RecordedStatement(NamedTuple):
+    sql: str
+    params: Any
+    site: str
+
+
+@dataclass
+class QueryLog:
+    statements: list[RecordedStatement] = field(default_factory=list)
+    transactions: int = 0  # BEGIN/COMMIT/ROLLBACK — отдельные round-trip'ы
+    batched: int = 0  # запросов, ушедших пакетом api/pipeline.py сверх первого в пакете
+
+    @property
+    def round_trips(self) -> int:
+        return len(self.statements) + self.transactions - self.batched
+
+
+def _call_site() -> str:
+    """Ближайший кадр стека внутри api/ (кроме самой инфраструктуры БД).
+
+    Async-драйвер выполняет SQL в дочернем greenlet'е, поэтому смотрим и стек
+    родителя — там лежат корутины обработчиков.
+    """
+    frames = traceback.extract_stack()
+    parent = getcurrent().parent
+    if parent is not None and parent.gr_frame is not None:
+        frames = traceback.extract_stack(parent.gr_frame) + frames
+    for frame in reversed(frames):
+        path = Path(frame.filename)
+        if API_DIR in path.parents and path.name not in ("db.py", "metrics.py", "pipeline.py"):
+            return f"{path.relative_to(ROOT)}:{frame.lineno} in {frame.name}"
+    return "<unknown>"
+
+
+@contextmanager
+def record_queries(target=engine):
+    """Записывать все SQL, выполненные на target внутри блока."""
+    log = QueryLog()
+    sync_engine = target.sync_engine
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        log.statements.append(RecordedStatement(statement, parameters, _call_site()))
+
+    def on_tx(conn, *args):
+        log.transactions += 1
+
+    def on_batch(conn, statements, seconds):
+        site = _call_site()
+        log.statements.extend(RecordedStatement(sql, params, site) for sql, params in statements)
+        log.batched += len(statements) - 1
+
+    event.listen(sync_engine, "before_cursor_execute", on_execute)
+    for name in ("begin", "commit", "rollback"):
+        event.listen(sync_engine, name, on_tx)
+    pipeline.batch_listeners.append(on_batch)
+    try:
+        yield log
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", on_execute)
+        for name in ("begin", "commit", "rollback"):
+            event.remove(sync_engine, name, on_tx)
+        pipeline.batch_listeners.remove(on_batch)
+
+
+def check_budget(endpoint: str, log: QueryLog, budgets: dict[str, tuple[int, int]]) -> list[str]:
+    """Список нарушений бюджета (пустой — всё в порядке)."""
+    max_statements, max_round_trips = budgets[endpoint]
+    problems = []
+    if len(log.statements) > max_statements:
+        problems.append(f"{endpoint}: {len(log.statements)} statements > budget {max_statements}")
+    if log.round_trips > max_round_trips:
+        problems.append(f"{endpoint}: {log.round_trips} round-trips > budget {max_round_trips}")
+    if problems:
+        sites = Counter(st.site for st in log.statements)
+        problems.extend(f"    {count}x {site}" for site, count in sites.most_common())
+    return problems
+
+
+async def measure(story: str, tg_id: int) -> list[tuple[str, QueryLog]]:
+    """Прогнать сценарий и вернуть журнал запросов каждого замеренного вызова."""
+    headers = {"X-Debug-Tg-Id": str(tg_id)}
+    transport = httpx.ASGITransport(app=app)
+    results: list[tuple[str, QueryLog]] = []
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://budget") as client:
+
+        async def call(method: str, path: str, **kwargs) -> httpx.Response:
+            with record_queries() as log:
+                resp = await client.request(method, path, headers=headers, **kwargs)
+            if resp.status_code >= 500:
+                raise RuntimeError(f"{method} {path}: {resp.status_code} {resp.text}")
+            results.append((f"{method} {path.split('?')[0]}", log))
+            return resp
+
+        # прогрев: первые вызовы создают пользователя/прогресс/согласие — их не меряем
+        await client.get(f"/api/state?story={story}", headers=headers)
+        await client.post("/api/dev/grant", json={"energy": 50, "gems": 100}, headers=headers)
+        await client.post("/api/age/confirm", json={"agree": True}, headers=headers)
+
+        await call("POST", "/api/age/confirm", json={"agree": True})
+        state = (await call("GET", f"/api/state?story={story}")).json()
+        free = [
+            ch for ch in state.get("choices", [])
+            if not (ch["gem_cost"] or ch["is_premium"] or ch["requires_item"])
+        ]
+        if free:
+            await call("POST", "/api/choose", json={"story_code": story, "choice_code": free[0]["code"]})
+        else:
+            print("warning: no free choice in current scene, /api/choose not measured")
+        await call("POST", "/api/item/buy", json={"story_code": story, "item_code": "budget_probe", "price_gems": 0})
+        await call("POST", "/api/restart", json={"story_code": story})
+    return results
+
+
+async def run(story: str, tg_id: int, update: bool) -> int:
+    results = await measure(story, tg_id)
+    dialect = engine.dialect.name
+    for endpoint, log in results:
+        print(f"{endpoint:<24} statements={len(log.statements):<3} round_trips={log.round_trips}")
+    if update:
+        save_budgets(dialect, results)
+        print(f"{dialect} budgets written: {BUDGETS_PATH}")
+        return 0
+    budgets = load_budgets(dialect)
+    if budgets is None:
+        print(f"no {dialect} budgets in {BUDGETS_PATH}: run with --update on this database")
+        return 1
+    problems: list[str] = []
+    for endpoint, log in results:
+        problems.extend(check_budget(endpoint, log, budgets))
+    if problems:
+        print("\nQuery budget exceeded:")
+        print("\n".join(problems))
+        return 1
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--story", default="office_flirt")
+    parser.add_argument("--tg-id", type=int, default=900000001)
+    parser.add_argument("--update", action="store_true", help="записать фактические значения как бюджет диалекта")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.story, args.tg_id, args.update)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Воспроизведение записанного трафика (api/capture.py) против локальной сборки.
+
+    # 1) засеять локальную БД состоянием пользователей из записи и прогнать в 10x
+    python tools/replay.py run /tmp/capture/*.jsonl --seed --speed 10 --label before --out before.json
+    # 2) то же на новой сборке
+    python tools/replay.py run /tmp/capture/*.jsonl --seed --speed 10 --label after --out after.json
+    # 3) сравнить
+    python tools/replay.py compare before.json after.json
+
+Каждому псевдониму сопоставляется синтетический tg_id (REPLAY_TG_BASE + n); запросы
+подписываются --bot-token (как в loadtest) или идут с X-Debug-Tg-Id. Порядок и интервалы
+сохраняются, поэтому двойные тапы и шторма переоткрытий воспроизводятся как были;
+--speed 0 — без пауз, но запросы одного пользователя идут по очереди. --seed пишет в БД из DATABASE_URL — ту же, что у API
+(при DATABASE_SHARD_URLS — каждого пользователя на его шард по карте shard_buckets).
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from tools.loadtest import percentile, sign_init_data
+
+
+REPLAY_TG_BASE = 30_000_000_000
+PER_USER_TABLES = ("user_items", "gem_unlocks", "age_consent", "progress_meta", "progress", "wallet")
+
+
+def load_capture(patterns: list[str], limit: int = 0) -> list[dict]:
+    records = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, encoding="utf-8") as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    records = [r for r in records if r.get("r") and r.get("u") != "anon"]
+    records.sort(key=lambda r: r["t"])
+    return records[:limit] if limit else records
+
+
+def _story_of(record: dict, default_story: str) -> str:
+    return (record.get("b") or {}).get("story_code") or (record.get("q") or {}).get("story") or default_story
+
+
+async def seed(records: list[dict], tg_ids: dict[str, int]) -> None:
+    """Привести пользователей к состоянию на момент их первого запроса в записи."""
+    from api import shards
+    from api.db import shard_engines
+    from api.main import DEFAULT_STORY_CODE
+
+    first: dict[tuple[str, str], dict] = {}
+    for record in records:
+        if "state" in record or record.get("r") == "/api/choose":
+            first.setdefault((record["u"], _story_of(record, DEFAULT_STORY_CODE)), record)
+
+    if shards.enabled():
+        await shards.load_map()
+    by_shard: dict[int, dict[str, int]] = defaultdict(dict)
+    for pseudo, tg_id in tg_ids.items():
+        by_shard[shards.shard_of(tg_id)][pseudo] = tg_id
+    for shard, shard_tg_ids in sorted(by_shard.items()):
+        shard_first = {key: record for key, record in first.items() if key[0] in shard_tg_ids}
+        await _seed_shard(shard_engines[shard], shard_first, shard_tg_ids)
+    print(f"seeded {len(tg_ids)} users, {len(first)} user/story states")
+
+
+async def _seed_shard(bind, first: dict[tuple[str, str], dict], tg_ids: dict[str, int]) -> None:
+    from sqlalchemy import delete, select, text
+    from api.db import AsyncSessionLocal
+    from api.models import AgeConsent, Choice, Progress, ProgressMeta, Scene, Story, User, UserItem, Wallet
+
+    async with AsyncSessionLocal(bind=bind) as session:
+        stories = {s.code: s for s in (await session.execute(select(Story))).scalars().all()}
+        user_ids = list((await session.execute(select(User.id).where(User.tg_id.in_(list(tg_ids.values()))))).scalars())
+        if user_ids:
+            for table in PER_USER_TABLES:
+                await session.execute(text(f"DELETE FROM {table} WHERE user_id IN ({','.join(map(str, user_ids))})"))
+            await session.execute(delete(User).where(User.id.in_(user_ids)))
+            await session.commit()
+
+        users: dict[str, User] = {}
+        for pseudo, tg_id in tg_ids.items():
+            user = User(tg_id=tg_id, lang="ru", is_premium=False)
+            session.add(user)
+            users[pseudo] = user
+        await session.flush()
+
+        seeded_wallets: set[str] = set()
+        now = datetime.now(timezone.utc).isoformat()
+        for (pseudo, story_code), record in first.items():
+            story = stories.get(story_code)
+            if story is None:
+                continue
+            user = users[pseudo]
+            state = record.get("state") or {}
+            scene_code = state.get("scene") if record.get("r") != "/api/choose" else None
+            if scene_code is None and record.get("r") == "/api/choose":
+                # до первого выбора пользователь стоял в сцене, которой принадлежит этот выбор
+                scene_code = (
+                    await session.execute(
+                        select(Scene.code).join(Choice, Choice.scene_id == Scene.id).where(
+                            Scene.story_id == story.id, Choice.code == (record.get("b") or {}).get("choice_code")
+                        ).limit(1)
+                    )
+                ).scalar_one_or_none()
+            session.add(Progress(user_id=user.id, story_id=story.id, current_scene=scene_code or story.start_scene))
+            session.add(ProgressMeta(user_id=user.id, story_id=story.id, heat_score=0))
+            for item in state.get("items") or []:
+                session.add(UserItem(user_id=user.id, story_id=story.id, item_code=item))
+            if pseudo not in seeded_wallets:
+                seeded_wallets.add(pseudo)
+                user.is_premium = bool(state.get("premium"))
+                session.add(Wallet(user_id=user.id, energy=state.get("energy", 7), gems=state.get("gems", 0)))
+                if state.get("age", True):
+                    session.add(AgeConsent(user_id=user.id, confirmed_at=now))
+        for pseudo, user in users.items():
+            if pseudo not in seeded_wallets:
+                session.add(Wallet(user_id=user.id, energy=7, gems=0))
+        await session.commit()
+
+
+async def replay(records: list[dict], tg_ids: dict[str, int], args) -> list[dict]:
+    client = httpx.AsyncClient(
+        base_url=args.base_url,
+        timeout=args.timeout,
+        limits=httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections),
+    )
+    results: list[dict] = []
+
+    def headers_for(pseudo: str) -> dict:
+        tg_id = tg_ids[pseudo]
+        if args.bot_token:
+            return {"X-Telegram-Init-Data": sign_init_data(args.bot_token, tg_id, "ru")}
+        return {"X-Debug-Tg-Id": str(tg_id)}
+
+    async def fire(record: dict, previous: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await previous
+        start = time.perf_counter()
+        try:
+            resp = await client.request(
+                record["m"], record["p"], params=record.get("q") or None,
+                json=record.get("b") if record["m"] != "GET" else None,
+                headers=headers_for(record["u"]),
+            )
+            status_code: Optional[int] = resp.status_code
+        except httpx.HTTPError:
+            status_code = None
+        results.append({
+            "route": f"{record['m']} {record['r']}",
+            "ms": (time.perf_counter() - start) * 1000,
+            "status": status_code,
+            "captured_status": record["s"],
+            "captured_ms": record["ms"],
+        })
+
+    async with client:
+        t0 = records[0]["t"]
+        start = time.monotonic()
+        tasks = []
+        last_by_user: dict[str, asyncio.Task] = {}
+        for record in records:
+            previous = None
+            if args.speed > 0:
+                delay = (record["t"] - t0) / args.speed - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                previous = last_by_user.get(record["u"])  # без пауз: пользователи параллельно, запросы одного — по порядку
+            task = last_by_user[record["u"]] = asyncio.create_task(fire(record, previous))
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+    return results
+
+
+def summarize(results: list[dict]) -> dict[str, dict]:
+    by_route: dict[str, list[dict]] = defaultdict(list)
+    for r in results:
+        by_route[r["route"]].append(r)
+    summary = {}
+    for route, items in sorted(by_route.items()):
+        ms = sorted(r["ms"] for r in items)
+        summary[route] = {
+            "count": len(items),
+            "p50": percentile(ms, 0.50),
+            "p95": percentile(ms, 0.95),
+            "p99": percentile(ms, 0.99),
+            "errors": sum(1 for r in items if r["status"] is None or r["status"] >= 500),
+            "status_mismatch": sum(1 for r in items if r["status"] != r["captured_status"]),
+        }
+    return summary
+
+
+async def cmd_run(args) -> int:
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        print("no captured requests")
+        return 2
+    pseudonyms = sorted({r["u"] for r in records})
+    tg_ids = {p: REPLAY_TG_BASE + i for i, p in enumerate(pseudonyms)}
+    if args.seed:
+        await seed(records, tg_ids)
+    span = records[-1]["t"] - records[0]["t"]
+    print(f"replaying {len(records)} requests from {len(pseudonyms)} users ({span:.0f}s captured, speed {args.speed or 'max'})")
+    started = time.monotonic()
+    results = await replay(records, tg_ids, args)
+    elapsed = time.monotonic() - started
+    summary = summarize(results)
+    print(f"{'route':<28}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'5xx':>6}{'status≠':>9}")
+    for route, s in summary.items():
+        print(f"{route:<28}{s['count']:>7}{s['p50']:>9.1f}{s['p95']:>9.1f}{s['p99']:>9.1f}{s['errors']:>6}{s['status_mismatch']:>9}")
+    print(f"done in {elapsed:.1f}s")
+    if args.out:
+        Path(args.out).write_text(
+            json.dumps({"label": args.label, "elapsed": elapsed, "summary": summary}, indent=2), encoding="utf-8"
+        )
+    return 0
+
+
+def cmd_compare(args) -> int:
+    a = json.loads(Path(args.before).read_text(encoding="utf-8"))
+    b = json.loads(Path(args.after).read_text(encoding="utf-8"))
+    print(f"{'route':<28}" + "".join(f"{q + ' ' + a['label']:>14}{q + ' ' + b['label']:>14}{'Δ':>9}" for q in ("p50", "p95", "p99")))
+    for route in sorted(set(a["summary"]) | set(b["summary"])):
+        sa, sb = a["summary"].get(route), b["summary"].get(route)
+        if not sa or not sb:
+            print(f"{route:<28} only in {'before' if sa else 'after'}")
+            continue
+        row = f"{route:<28}"
+        for q in ("p50", "p95", "p99"):
+            delta = (sb[q] / sa[q] - 1) * 100 if sa[q] else 0.0
+            row += f"{sa[q]:>14.1f}{sb[q]:>14.1f}{delta:>+8.1f}%"
+        print(row)
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    run = sub.add_parser("run", help="воспроизвести запись")
+    run.add_argument("capture", nargs="+", help="файлы/глобы capture-*.jsonl")
+    run.add_argument("--base-url", default="http://127.0.0.1:8080")
+    run.add_argument("--bot-token", default=os.getenv("BOT_TOKEN", ""))
+    run.add_argument("--speed", type=float, default=1.0, help="множитель скорости; 0 — без пауз")
+    run.add_argument("--seed", action="store_true", help="засеять БД состоянием пользователей из записи")
+    run.add_argument("--limit", type=int, default=0)
+    run.add_argument("--connections", type=int, default=200)
+    run.add_argument("--timeout", type=float, default=30.0)
+    run.add_argument("--label", default="run")
+    run.add_argument("--out", default="")
+    compare = sub.add_parser("compare", help="сравнить два результата run --out")
+    compare.add_argument("before")
+    compare.add_argument("after")
+    args = parser.parse_args()
+    if args.cmd == "compare":
+        sys.exit(cmd_compare(args))
+    sys.exit(asyncio.run(cmd_run(args)))
+
+
+if __name__ == "__main__":
+    main()
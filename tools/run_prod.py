@@ -0,0 +1,154 @@
+"""Продовый запуск API: gunicorn-мастер + N uvicorn-воркеров (uvloop + httptools).
+
+Приложение импортируется в мастере до fork (preload): прочитанные при импорте данные и
+код делятся воркерами copy-on-write, а gc.freeze() не даёт сборщику мусора «трогать» эти
+страницы. На Windows или без gunicorn — uvicorn с несколькими воркерами, без preload.
+
+Настройки (env):
+    HOST=0.0.0.0  PORT=8080
+    WEB_CONCURRENCY       воркеров (по умолчанию — число ядер)
+    KEEPALIVE_SECONDS=75  keep-alive (больше, чем у балансировщика перед нами)
+    BACKLOG=2048          очередь listen()
+    GRACEFUL_TIMEOUT=30   сколько ждать завершения запросов при остановке/рестарте
+    WORKER_TIMEOUT=60     убить зависший воркер
+    MAX_REQUESTS=0        перезапуск воркера после N запросов (+ MAX_REQUESTS_JITTER)
+    FORWARDED_ALLOW_IPS=127.0.0.1  кому верить в X-Forwarded-*
+    PRELOAD=1
+    DB_STATEMENT_TIMEOUT_MS=5000, DB_POOL_TIMEOUT=5  лимиты БД для API (в tools/ — 0 и 30, см. api/db.py)
+
+    python tools/run_prod.py
+"""
+import gc
+import os
+import platform
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Короткие лимиты БД — только для процесса API: воркер отвечает 503, а не копит очередь
+# (api/admission.py). Инструменты с долгими COPY/ANALYZE/DDL живут с умолчаниями api/db.py.
+os.environ.setdefault("DB_STATEMENT_TIMEOUT_MS", "5000")
+os.environ.setdefault("DB_POOL_TIMEOUT", "5")
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8080"))
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "0")) or (os.cpu_count() or 1)
+KEEPALIVE_SECONDS = int(os.getenv("KEEPALIVE_SECONDS", "75"))
+BACKLOG = int(os.getenv("BACKLOG", "2048"))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT", "60"))
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", "0"))
+MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+PRELOAD = os.getenv("PRELOAD", "1") == "1"
+
+
+def _fast_impl(module: str, fallback: str) -> str:
+    try:
+        __import__(module)
+    except ImportError:
+        return fallback
+    return module
+
+
+try:
+    from uvicorn.workers import UvicornWorker  # нужен gunicorn
+except ImportError:
+    UvicornWorker = None
+
+if UvicornWorker is not None:
+
+    class RomanceWorker(UvicornWorker):
+        CONFIG_KWARGS = {
+            "loop": _fast_impl("uvloop", "asyncio"),
+            "http": _fast_impl("httptools", "h11"),
+            "access_log": False,  # access-лог пишет api/logs.py (LOG_ACCESS=1), без блокировки loop'а
+            "timeout_graceful_shutdown": GRACEFUL_TIMEOUT,
+        }
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # UvicornWorker переключает uvicorn.* на синхронные обработчики gunicorn — возвращаем очередь
+            import logging
+            from api import logs
+
+            logs.route_uvicorn_loggers()
+            logging.getLogger("uvicorn.access").propagate = False  # access_log=False выше
+
+
+def run_gunicorn() -> None:
+    from gunicorn.app.base import BaseApplication
+
+    def post_fork(server, worker):
+        # соединения, открытые мастером при preload, не должны делиться между процессами
+        from api.db import replica_engines, shard_engines
+
+        for e in (*shard_engines, *replica_engines):  # shard_engines[0] — основной engine
+            e.sync_engine.dispose(close=False)
+
+    class Application(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": f"{HOST}:{PORT}",
+                "workers": WORKERS,
+                "worker_class": "tools.run_prod.RomanceWorker",
+                "keepalive": KEEPALIVE_SECONDS,
+                "backlog": BACKLOG,
+                "graceful_timeout": GRACEFUL_TIMEOUT,
+                "timeout": WORKER_TIMEOUT,
+                "max_requests": MAX_REQUESTS,
+                "max_requests_jitter": MAX_REQUESTS_JITTER,
+                "forwarded_allow_ips": FORWARDED_ALLOW_IPS,
+                "preload_app": PRELOAD,
+                "post_fork": post_fork,
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from api.main import app
+
+            # всё, что создано к этому моменту, — общие страницы воркеров: убираем из поколений GC
+            gc.collect()
+            gc.freeze()
+            return app
+
+    Application().run()
+
+
+def run_uvicorn() -> None:
+    import uvicorn
+
+    uvicorn.run(
+        "api.main:app",
+        host=HOST,
+        port=PORT,
+        workers=WORKERS,
+        loop=_fast_impl("uvloop", "asyncio"),
+        http=_fast_impl("httptools", "h11"),
+        access_log=False,
+        timeout_keep_alive=KEEPALIVE_SECONDS,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        backlog=BACKLOG,
+        limit_max_requests=MAX_REQUESTS or None,
+        forwarded_allow_ips=FORWARDED_ALLOW_IPS,
+    )
+
+
+def main() -> None:
+    if platform.system() != "Windows" and _fast_impl("gunicorn", "") == "gunicorn":
+        run_gunicorn()
+    else:
+        run_uvicorn()
+
+
+if __name__ == "__main__":
+    main()
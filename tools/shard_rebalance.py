@@ -0,0 +1,159 @@
+"""Карта шардов и онлайн-перенос бакетов пользователей (api/shards.py).
+
+    python tools/shard_rebalance.py status
+    python tools/shard_rebalance.py move --buckets 0-15,40 --to 2
+    python tools/shard_rebalance.py spread            # поровну на все шарды из env
+
+Перенос одного бакета:
+1. бакет помечается moving, затем пауза --settle секунд. За это время воркеры
+   перечитывают карту (не позже SHARD_MAP_MAX_AGE_SECONDS, иначе отвечают 503
+   shard_map_stale) и дописывают начатые запросы (не дольше REQUEST_DEADLINE_SECONDS).
+   Поэтому по умолчанию пауза — их сумма плюс секунда; env должен совпадать с API.
+   Новые запросы пользователей бакета получают 503 + Retry-After.
+2. пользователи бакета копируются на новый шард (id пользователей — новые);
+3. карта переключается на новый шард (active);
+4. строки бакета удаляются со старого шарда.
+Прерванный перенос безопасно повторить той же командой.
+
+Шарды берутся из DATABASE_URL (шард 0) и DATABASE_SHARD_URLS. Новый шард сначала
+получает схему и контент (tools/db_migrate.py, tools/story_import.py), потом — бакеты.
+Локально несколько Postgres поднимаются так:
+    docker compose -f infra/docker-compose.yml -f infra/docker-compose.shards.yml up -d
+"""
+import argparse
+import asyncio
+import os
+import platform
+import sys
+from pathlib import Path
+from typing import Optional
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+os.environ.setdefault("DB_STATEMENT_TIMEOUT_MS", "0")  # DDL и перенос данных идут дольше запросов API
+
+from sqlalchemy import func, select
+
+from api import admission, db, shards
+from api.models import ShardBucket, User
+
+if platform.system() == "Windows":
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+
+def parse_buckets(spec: str) -> list[int]:
+    buckets: list[int] = []
+    for part in spec.split(","):
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            buckets.extend(range(int(lo), int(hi) + 1))
+        elif part.strip():
+            buckets.append(int(part))
+    return buckets
+
+
+async def current_map() -> dict[int, tuple[int, str]]:
+    async with db.engine.connect() as conn:
+        rows = (await conn.execute(select(ShardBucket.bucket, ShardBucket.shard, ShardBucket.state))).all()
+    return {bucket: (shard, state) for bucket, shard, state in rows}
+
+
+async def cmd_status(args) -> int:
+    mapping = await current_map()
+    if not mapping:
+        print("shard_buckets is empty: run tools/db_migrate.py")
+        return 2
+    for index, shard_engine in enumerate(db.shard_engines):
+        async with shard_engine.connect() as conn:
+            users = (await conn.execute(select(func.count()).select_from(User))).scalar_one()
+        owned = sum(1 for shard, _ in mapping.values() if shard == index)
+        print(f"shard {index}: {owned:>4} buckets {users:>9} users  {shard_engine.url.render_as_string(hide_password=True)}")
+    moving = sorted(b for b, (_, state) in mapping.items() if state == "moving")
+    if moving:
+        print(f"moving: {moving}")
+    return 0
+
+
+def default_settle() -> Optional[float]:
+    """Пауза после moving, после которой в старый шард бакета уже никто не пишет."""
+    if not admission.REQUEST_DEADLINE:
+        return None  # запросы без дедлайна: безопасной паузы нет, только явный --settle
+    return shards.SHARD_MAP_MAX_AGE + admission.REQUEST_DEADLINE + 1
+
+
+async def move_bucket(bucket: int, target: int, settle: float) -> None:
+    source, state = (await current_map())[bucket]
+    if source == target and state == "active":
+        return
+    await shards.set_bucket(bucket, source, "moving")
+    await asyncio.sleep(settle)
+    if source != target:
+        copied = await shards.copy_bucket(bucket, source, target)
+    else:
+        copied = 0  # пометка moving без переноса (прерванный запуск на тот же шард)
+    await shards.set_bucket(bucket, target, "active")
+    if source != target:
+        await shards.delete_bucket(bucket, source)
+    print(f"bucket {bucket}: shard {source} -> {target}, {copied} users")
+
+
+async def cmd_move(args) -> int:
+    if not 0 <= args.to < len(db.shard_engines):
+        print(f"--to must be in 0..{len(db.shard_engines) - 1}")
+        return 2
+    for bucket in parse_buckets(args.buckets):
+        await move_bucket(bucket, args.to, args.settle)
+    return 0
+
+
+async def cmd_spread(args) -> int:
+    mapping = await current_map()
+    shard_count = len(db.shard_engines)
+    target_per_shard = -(-len(mapping) // shard_count)
+    owned: dict[int, list[int]] = {i: [] for i in range(shard_count)}
+    for bucket, (shard, _) in sorted(mapping.items()):
+        owned.setdefault(shard, []).append(bucket)
+    # лишние бакеты перегруженных шардов — на недогруженные; остальные не трогаем
+    surplus = [b for shard, buckets in owned.items() for b in buckets[target_per_shard:]]
+    moves = []
+    for shard in range(shard_count):
+        while len(owned[shard]) < target_per_shard and surplus:
+            bucket = surplus.pop()
+            owned[shard].append(bucket)
+            moves.append((bucket, shard))
+    print(f"{len(moves)} buckets to move")
+    for bucket, shard in moves:
+        await move_bucket(bucket, shard, args.settle)
+    return 0
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("status", help="бакеты и пользователи по шардам")
+    move = sub.add_parser("move", help="перенести бакеты на шард")
+    move.add_argument("--buckets", required=True, help="например 0-15,40")
+    move.add_argument("--to", type=int, required=True)
+    spread = sub.add_parser("spread", help="разложить бакеты поровну")
+    for p in (move, spread):
+        p.add_argument("--settle", type=float, default=default_settle(),
+                       help="пауза после moving, с (≥ SHARD_MAP_MAX_AGE_SECONDS + REQUEST_DEADLINE_SECONDS)")
+    args = parser.parse_args()
+    if args.cmd != "status" and args.settle is None:
+        print("REQUEST_DEADLINE_SECONDS=0: requests have no deadline, pass --settle explicitly")
+        return 2
+    handler = {"status": cmd_status, "move": cmd_move, "spread": cmd_spread}[args.cmd]
+    try:
+        return await handler(args)
+    finally:
+        for shard_engine in db.shard_engines:
+            await shard_engine.dispose()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
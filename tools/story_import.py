@@ -3,6 +3,7 @@ import asyncio
 import os
 import sys
 import yaml
+from typing import Optional
 from pathlib import Path
 
 # --- гарантируем, что корень проекта в sys.path ---
@@ -11,11 +12,14 @@ if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
 # ---------------------------------------------------
 
+os.environ.setdefault("DB_STATEMENT_TIMEOUT_MS", "0")  # DDL и перенос данных идут дольше запросов API
+
 from sqlalchemy import select, delete
 from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
 
-from api.db import engine, AsyncSessionLocal, Base
+from api import schema, shards
+from api.db import AsyncSessionLocal
 from api.models import Story, Scene, SceneI18n, Choice, ChoiceI18n
 
 # Windows: psycopg async требует Selector event loop
@@ -29,20 +33,27 @@ except Exception:
 load_dotenv()
 STORY_PATH = os.path.join("content", "stories", "office_flirt", "story.yaml")
 
-async def import_story():
-    # 1) создать таблицы, если их ещё нет
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+def load_story(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+
+async def import_story(path: str = STORY_PATH):
+    # 1) создать таблицы, если их ещё нет (и отметить версию схемы для DB_SCHEMA=verify)
+    await schema.migrate()
 
     # 2) прочитать YAML
-    if not os.path.exists(STORY_PATH):
-        print(f"Story file not found: {STORY_PATH}")
+    data = load_story(path)
+    if data is None:
+        print(f"Story file not found: {path}")
         return
-    with open(STORY_PATH, "r", encoding="utf-8") as f:
-        data = yaml.safe_load(f)
 
     async with AsyncSessionLocal() as session:
-        # 3) удалить старую историю (аккуратно дочерние сущности)
+        # 3) удалить сцены старой версии (аккуратно дочерние сущности). Сама история остаётся
+        # с тем же id: прогресс, предметы и анлоки пользователей ссылаются на него, а воркеры
+        # держат его в кэше историй
         old = (await session.execute(select(Story).where(Story.code == data["code"]))).scalar_one_or_none()
         if old:
             scene_ids = [s.id for s in (await session.execute(select(Scene).where(Scene.story_id == old.id))).scalars().all()]
@@ -53,12 +64,13 @@ async def import_story():
                     await session.execute(delete(Choice).where(Choice.id.in_(choice_ids)))
                 await session.execute(delete(SceneI18n).where(SceneI18n.scene_id.in_(scene_ids)))
                 await session.execute(delete(Scene).where(Scene.id.in_(scene_ids)))
-            await session.execute(delete(Story).where(Story.id == old.id))
-            await session.commit()
-
-        # 4) создать Story
-        st = Story(code=data["code"], start_scene=data["start_scene"])
-        session.add(st); await session.flush()
+            old.start_scene = data["start_scene"]
+            st = old
+        else:
+            # 4) создать Story
+            st = Story(code=data["code"], start_scene=data["start_scene"])
+            session.add(st)
+        await session.flush()
 
         # 5) сцены + тексты + выборы
         for s in data.get("scenes", []):
@@ -86,8 +98,14 @@ async def import_story():
                 for lang, label in c.get("label", {}).items():
                     session.add(ChoiceI18n(choice_id=choice.id, lang=lang, label=label))
 
+        # 6) прогресс на сценах, которых в новой версии нет, — на старт истории
+        await session.flush()
+        await session.execute(shards.reset_stale_progress(st.id, st.start_scene))
         await session.commit()
-        print("Story imported:", data["code"])
+    # 7) та же история с теми же id — на остальные шарды (DATABASE_SHARD_URLS)
+    await shards.replicate_story(data["code"])
+    print("Story imported:", data["code"])
 
 if __name__ == "__main__":
-    asyncio.run(import_story())
+    # python tools/story_import.py [path/to/story.yaml]
+    asyncio.run(import_story(sys.argv[1] if len(sys.argv) > 1 else STORY_PATH))
@@ -0,0 +1,293 @@
+"""Синтетические данные для проверок на масштабе. Всё детерминировано по --seed.
+
+story — YAML истории в формате content/stories/*/story.yaml: слои сцен с ветвлением,
+премиум-ветки, выборы за 💎, предметы (requires_item и выдающие give_*), 5 языков.
+Выборы последнего слоя ведут в роутер концовок (ending_soft/hot/max).
+
+    python tools/synth.py story --code synth_big --scenes 3000 --branching 3 --seed 7
+    python tools/story_import.py content/stories/synth_big/story.yaml
+
+users — массовая загрузка пользователей через COPY (только Postgres): кошелёк, согласие,
+прогресс по 1–N историям (глубина — геометрическое распределение: большинство
+отваливается в начале), предметы и разблокировки за 💎. При шардировании
+(DATABASE_SHARD_URLS) каждый пользователь пишется на свой шард по карте shard_buckets.
+
+    python tools/synth.py users --count 2000000 --seed 7 [--chunk 50000]
+
+tg_id синтетических пользователей начинаются с SYNTH_TG_BASE и не пересекаются с
+plan_check/loadtest/replay. Повторный запуск с тем же --offset дописывать не будет.
+"""
+import argparse
+import asyncio
+import math
+import random
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import yaml
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+SYNTH_TG_BASE = 40_000_000_000
+LANGS = ("ru", "en", "es", "de", "fr")
+LANG_WEIGHTS = (0.55, 0.2, 0.1, 0.08, 0.07)
+WORDS = {
+    "ru": "она улыбается тихо смотрит коридор вечер кофе дождь офис взгляд шаг ближе смеётся дверь".split(),
+    "en": "she smiles quietly looks hallway evening coffee rain office glance step closer laughs door".split(),
+    "es": "ella sonríe mira pasillo tarde café lluvia oficina mirada paso cerca ríe puerta".split(),
+    "de": "sie lächelt leise schaut flur abend kaffee regen büro blick schritt näher lacht tür".split(),
+    "fr": "elle sourit doucement regarde couloir soir café pluie bureau regard pas proche rit porte".split(),
+}
+ENDINGS = ("ending_soft", "ending_hot", "ending_max")
+
+
+def _sentence(rng: random.Random, lang: str, words: int) -> str:
+    text = " ".join(rng.choice(WORDS[lang]) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+
+def _i18n(rng: random.Random, words: int) -> dict[str, str]:
+    return {lang: _sentence(rng, lang, words) for lang in LANGS}
+
+
+def generate_story(code: str, scenes: int, branching: int, premium_ratio: float, gem_ratio: float,
+                   item_count: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    items = [f"item_{i:02d}" for i in range(item_count)]
+    # слои: ширина растёт до branching^k, но общая длина истории остаётся ~scenes
+    layers: list[list[str]] = []
+    made = 0
+    width = 1
+    while made < scenes:
+        size = min(width, scenes - made)
+        layers.append([f"s{made + i:05d}" for i in range(size)])
+        made += size
+        width = min(width * branching, max(8, scenes // 20))
+    premium_scenes = {c for layer in layers[2:] for c in layer if rng.random() < premium_ratio}
+
+    out_scenes = []
+    for depth, layer in enumerate(layers):
+        last = depth == len(layers) - 1
+        for scene_code in layer:
+            choices = []
+            for n in range(rng.randint(max(1, branching - 1), branching + 1)):
+                choice = {"code": f"c{n}", "label": _i18n(rng, 3)}
+                if not last:
+                    choice["leads_to"] = rng.choice(layers[depth + 1])
+                    if choice["leads_to"] in premium_scenes:
+                        choice["is_premium"] = True
+                if rng.random() < gem_ratio:
+                    choice["gem_cost"] = rng.choice((3, 5, 6, 10))
+                if items and rng.random() < 0.05:
+                    choice["requires_item"] = rng.choice(items)
+                elif items and rng.random() < 0.03:
+                    choice["code"] = f"give_{rng.choice(items)}"
+                if rng.random() < 0.3:
+                    choice["heat_points"] = rng.randint(1, 2)
+                choices.append(choice)
+            # у каждой сцены есть хотя бы один бесплатный путь вперёд
+            free = choices[0]
+            for key in ("gem_cost", "requires_item", "is_premium"):
+                free.pop(key, None)
+            if not last and free["leads_to"] in premium_scenes:
+                free["leads_to"] = next((c for c in layers[depth + 1] if c not in premium_scenes), free["leads_to"])
+            seen: set[str] = set()
+            for choice in choices:
+                if choice["code"] in seen:
+                    choice["code"] = f"{choice['code']}_{len(seen)}"
+                seen.add(choice["code"])
+            out_scenes.append({
+                "code": scene_code,
+                "image_url": "",
+                "energy_cost": 0 if depth == 0 else 1,
+                "is_premium": scene_code in premium_scenes,
+                "text": _i18n(rng, rng.randint(12, 40)),
+                "choices": choices,
+            })
+    for ending in ENDINGS:
+        out_scenes.append({
+            "code": ending, "image_url": "", "energy_cost": 0, "is_premium": False,
+            "text": _i18n(rng, 25), "choices": [],
+        })
+    return {
+        "code": code,
+        "start_scene": layers[0][0],
+        "items": [
+            {"code": item, "type": "gift", "heat_bonus": 0,
+             "i18n": {lang: {"name": item, "description": _sentence(rng, lang, 5)} for lang in LANGS}}
+            for item in items
+        ],
+        "scenes": out_scenes,
+    }
+
+
+def cmd_story(args) -> None:
+    story = generate_story(args.code, args.scenes, args.branching, args.premium_ratio, args.gem_ratio, args.items, args.seed)
+    out = Path(args.out or ROOT / "content" / "stories" / args.code / "story.yaml")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with out.open("w", encoding="utf-8") as f:
+        yaml.safe_dump(story, f, allow_unicode=True, sort_keys=False, width=1000)
+    choices = sum(len(s["choices"]) for s in story["scenes"])
+    print(f"{out}: {len(story['scenes'])} scenes, {choices} choices, {len(story['items'])} items")
+
+
+def _poisson(rng: random.Random, lam: float) -> int:
+    # Кнут: для маленьких lam достаточно
+    limit, k, p = math.exp(-lam), 0, rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+
+async def _story_catalog(conn) -> list[dict]:
+    from sqlalchemy import text
+
+    stories = []
+    for story_id, code in (await conn.execute(text("SELECT id, code FROM stories ORDER BY id"))).all():
+        scenes = list((await conn.execute(
+            text("SELECT code FROM scenes WHERE story_id = :sid AND NOT is_premium ORDER BY id"), {"sid": story_id}
+        )).scalars())
+        gem_scenes = list((await conn.execute(text(
+            "SELECT DISTINCT s.code FROM scenes s JOIN choices c ON c.scene_id = s.id "
+            "WHERE s.story_id = :sid AND c.gem_cost > 0"
+        ), {"sid": story_id})).scalars())
+        items = list((await conn.execute(text(
+            "SELECT DISTINCT c.requires_item FROM choices c JOIN scenes s ON s.id = c.scene_id "
+            "WHERE s.story_id = :sid AND c.requires_item IS NOT NULL"
+        ), {"sid": story_id})).scalars())
+        if scenes:
+            stories.append({"id": story_id, "code": code, "scenes": scenes, "gem_scenes": gem_scenes, "items": items})
+    return stories
+
+
+async def cmd_users(args) -> int:
+    from sqlalchemy import text
+    from api import shards
+    from api.db import engine, shard_engines
+
+    if engine.dialect.name != "postgresql":
+        print("synth users needs PostgreSQL (COPY)")
+        return 2
+    if shards.enabled():
+        await shards.load_map()
+        if shards.moving_buckets():
+            print("some shard buckets are being moved: retry after tools/shard_rebalance.py finishes")
+            return 1
+    rng = random.Random(args.seed)
+    tg_base = SYNTH_TG_BASE + args.offset
+    async with engine.connect() as conn:
+        # контент одинаков на всех шардах (те же id), каталог — с шарда 0
+        stories = await _story_catalog(conn)
+    if not stories:
+        print("no stories in DB: import some first (tools/story_import.py)")
+        return 2
+    have = 0
+    next_ids = []  # id пользователей свои на каждом шарде
+    for shard_engine in shard_engines:
+        async with shard_engine.connect() as conn:
+            have += (await conn.execute(
+                text("SELECT count(*) FROM users WHERE tg_id >= :lo AND tg_id < :hi"),
+                {"lo": tg_base, "hi": tg_base + args.count},
+            )).scalar_one()
+            next_ids.append((await conn.execute(text("SELECT coalesce(max(id), 0) + 1 FROM users"))).scalar_one())
+    if have:
+        print(f"{have} users already present in tg_id range [{tg_base}, {tg_base + args.count}); use another --offset")
+        return 1
+
+    now = "2025-01-01T00:00:00+00:00"
+    done = 0
+    while done < args.count:
+        size = min(args.chunk, args.count - done)
+        tables = ("users", "wallet", "age_consent", "progress", "progress_meta", "user_items", "gem_unlocks")
+        by_shard: list[dict[str, list[tuple]]] = [{t: [] for t in tables} for _ in shard_engines]
+        for i in range(size):
+            tg_id = tg_base + done + i
+            shard = shards.shard_of(tg_id)
+            rows = by_shard[shard]
+            uid = next_ids[shard]
+            next_ids[shard] += 1
+            premium = rng.random() < 0.03
+            rows["users"].append((uid, tg_id, rng.choices(LANGS, LANG_WEIGHTS)[0], premium))
+            energy = 7 if rng.random() < 0.6 else rng.randint(0, 6)
+            gems = 0 if rng.random() < 0.7 else min(500, int(rng.lognormvariate(2.5, 1.0)))
+            rows["wallet"].append((uid, energy, gems, None, None))
+            if rng.random() < 0.85:
+                rows["age_consent"].append((uid, now))
+            played = [stories[0]] + [s for s in stories[1:] if rng.random() < 0.3]
+            for story in played:
+                scenes = story["scenes"]
+                depth = min(len(scenes) - 1, int(rng.expovariate(1.0 / max(1.0, len(scenes) * args.depth))))
+                rows["progress"].append((uid, story["id"], scenes[depth]))
+                rows["progress_meta"].append((uid, story["id"], rng.randint(0, max(0, depth // 3))))
+                if story["items"]:
+                    for item in rng.sample(story["items"], min(len(story["items"]), _poisson(rng, 0.3))):
+                        rows["user_items"].append((uid, story["id"], item))
+                if story["gem_scenes"]:
+                    for scene in rng.sample(story["gem_scenes"], min(len(story["gem_scenes"]), _poisson(rng, 0.2))):
+                        rows["gem_unlocks"].append((uid, story["id"], scene))
+
+        for shard_engine, rows in zip(shard_engines, by_shard):
+            if not rows["users"]:
+                continue
+            async with shard_engine.begin() as conn:
+                raw = await conn.get_raw_connection()
+                pg = raw.driver_connection
+                async with pg.cursor() as cur:
+                    for table, columns in (
+                        ("users", "id, tg_id, lang, is_premium"),
+                        ("wallet", "user_id, energy, gems, premium_until, last_energy_at"),
+                        ("age_consent", "user_id, confirmed_at"),
+                        ("progress", "user_id, story_id, current_scene"),
+                        ("progress_meta", "user_id, story_id, heat_score"),
+                        ("user_items", "user_id, story_id, item_code"),
+                        ("gem_unlocks", "user_id, story_id, scene_code"),
+                    ):
+                        async with cur.copy(f"COPY {table} ({columns}) FROM STDIN") as copy:
+                            for row in rows[table]:
+                                await copy.write_row(row)
+        done += size
+        print(f"users: {done}/{args.count}")
+
+    for shard_engine in shard_engines:
+        async with shard_engine.begin() as conn:
+            await conn.execute(text("SELECT setval(pg_get_serial_sequence('users', 'id'), (SELECT max(id) FROM users))"))
+        async with shard_engine.connect() as conn:
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text("ANALYZE"))
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    story = sub.add_parser("story", help="сгенерировать YAML истории")
+    story.add_argument("--code", default="synth_story")
+    story.add_argument("--scenes", type=int, default=1000)
+    story.add_argument("--branching", type=int, default=3)
+    story.add_argument("--premium-ratio", type=float, default=0.1, help="доля премиум-сцен")
+    story.add_argument("--gem-ratio", type=float, default=0.1, help="доля выборов за 💎")
+    story.add_argument("--items", type=int, default=8)
+    story.add_argument("--seed", type=int, default=1)
+    story.add_argument("--out", default="", help="по умолчанию content/stories/<code>/story.yaml")
+    users = sub.add_parser("users", help="загрузить синтетических пользователей (COPY)")
+    users.add_argument("--count", type=int, default=1_000_000)
+    users.add_argument("--chunk", type=int, default=50_000, help="пользователей на транзакцию")
+    users.add_argument("--depth", type=float, default=0.15, help="средняя глубина прохождения, доля сцен")
+    users.add_argument("--offset", type=int, default=0, help="сдвиг диапазона tg_id")
+    users.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.cmd == "story":
+        cmd_story(args)
+        return
+    sys.exit(asyncio.run(cmd_users(args)))
+
+
+if __name__ == "__main__":
+    main()